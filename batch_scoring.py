@@ -0,0 +1,300 @@
+# Batch wildfire-probability scoring over the gridded archive, spread over every core with a process pool.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# The (hours x grid cells) domain is cut into shards: blocks of hours_per_shard hours (aligned to the epoch, so a
+# shard's key doesn't depend on the range asked for) times tiles of the grid. A shard always covers every hour of its
+# block, scoring NaN where an hour has no input, so scoring part of a block never drops the scores of another part. The parent stacks the input features
+# of every shard still to do into one memory-mapped .npy file; workers open it read-only and slice out their shard, so
+# nothing bigger than a few integers and a path is pickled between processes. Each shard's scores are written to
+# their own file, and a SQLite checkpoint table records every finished shard with a fingerprint of its inputs, so a
+# rerun (after a crash, or to extend the range) skips the shards that are already done.
+#
+# Layout under a base directory (DATA_DERIVED_DIR/probability):
+#   <base>/checkpoints.sqlite                    one row per finished shard
+#   <base>/shards/2024070100_r0000_c0064.npz     one shard: 'hours' (epoch seconds) and a float32 (hours, rows, cols)
+#                                                'probability' array
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from metrics import NULL_METRICS
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS shards ("
+    "key TEXT NOT NULL PRIMARY KEY, hour0 INTEGER NOT NULL, "  # hour0 is the block start, seconds since 1970-01-01
+    "row0 INTEGER NOT NULL, n_rows INTEGER NOT NULL, col0 INTEGER NOT NULL, n_cols INTEGER NOT NULL, "
+    "fingerprint TEXT NOT NULL, path TEXT NOT NULL, n_valid INTEGER NOT NULL, max_probability REAL, "
+    "finished_at REAL NOT NULL) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS shards_hour0 ON shards (hour0)",
+]
+
+# Until a model is trained on fire occurrence, probability is a logistic function of the fire-weather indices that
+# grid_fire_weather() writes. The coefficients put an FFWI of 50 with an HDW of 200 at even odds; they rank
+# cells and hours sensibly but are not calibrated probabilities. Pass other coefficients, or another score function,
+# to BatchScorer to swap the model out.
+DEFAULT_COEFFICIENTS = {"intercept": -4.0, "fosberg_ffwi": 0.06, "hot_dry_windy": 0.005}
+SHARD_FILE_FORMAT = "%Y%m%d%H"
+
+
+def logistic_score(features, coefficients):
+    """
+    :param features: dictionary of index name -> float32 array, all the same shape
+    :param coefficients: dictionary of 'intercept' and index name -> weight
+    :return: float32 array of probabilities, NaN wherever an index the model uses is missing
+    """
+    z = None
+    for name, weight in coefficients.items():
+        if name == "intercept":
+            continue
+        term = np.float32(weight) * features[name]
+        z = term if z is None else z + term
+    z = np.float32(coefficients.get("intercept", 0)) + z
+    return (np.float32(1) / (np.float32(1) + np.exp(-z))).astype(np.float32)
+
+
+def _hash(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _score_shard(features_path, names, i0, n_hours, row0, row1, col0, col1, hour_seconds, score_fn, coefficients,
+                 out_path):
+    """
+    Runs in a worker process: scores one shard straight out of the memory-mapped features and writes it
+    :return: (number of cells scored, highest probability or None) tuple
+    """
+    features = np.load(features_path, mmap_mode="r")
+    block = {name: np.array(features[k, i0:i0 + n_hours, row0:row1, col0:col1]) for k, name in enumerate(names)}
+    probability = score_fn(block, coefficients).astype(np.float32)
+    # written under a name of its own and renamed, so a shard file is either whole or absent
+    tmp_path = "{}.{}.part".format(out_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, hours=hour_seconds, probability=probability)
+    os.replace(tmp_path, out_path)
+    valid = np.isfinite(probability)
+    return int(valid.sum()), float(probability[valid].max()) if valid.any() else None
+
+
+class BatchScorer:
+    """
+    Scores every grid cell and hour of a range from the fire-weather grids in a GridStore, one shard per worker task.
+    See the top of this file for how the work is split and checkpointed.
+    """
+    def __init__(self, base_dir, grid_store, source="fire_weather", coefficients=None, score_fn=logistic_score,
+                 hours_per_shard=24 * 7, tile=(64, 64), logger=None, metrics=None):
+        """
+        :param base_dir: string giving the full path of the directory results and checkpoints go in
+        :param grid_store: gridding.GridStore holding the input grids
+        :param source: string giving the GridStore source the features are read from
+        :param coefficients: optional dictionary passed to score_fn. Defaults to DEFAULT_COEFFICIENTS; its keys other
+                             than 'intercept' name the features read
+        :param score_fn: module-level function taking (features dictionary, coefficients) and returning an array of
+                         probabilities the shape of each feature. It's sent to the workers by name, so it can't be a
+                         lambda or a nested function
+        :param hours_per_shard: integer giving the hours in each shard's time block
+        :param tile: (rows, cols) tuple giving each shard's share of the grid
+        :param logger: optional logging.Logger
+        :param metrics: optional metrics.Metrics
+        """
+        self.base_dir = base_dir
+        self.shard_dir = os.path.join(base_dir, "shards")
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.grid_store = grid_store
+        self.grid = grid_store.grid
+        self.source = source
+        self.coefficients = dict(DEFAULT_COEFFICIENTS if coefficients is None else coefficients)
+        self.features = [name for name in self.coefficients if name != "intercept"]
+        self.score_fn = score_fn
+        self.hours_per_shard = int(hours_per_shard)
+        self.tile = (int(tile[0]), int(tile[1]))
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.db_path = os.path.join(base_dir, "checkpoints.sqlite")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def _model_fingerprint(self):
+        return _hash("{}.{}".format(self.score_fn.__module__, self.score_fn.__qualname__),
+                     json.dumps(self.coefficients, sort_keys=True), self.grid.to_dict(), self.source)
+
+    def _input_stamps(self, hours):
+        """
+        :return: list of (size, mtime) of each hour's input file, or None where there isn't one; a re-derived input
+                 changes its stamp and so re-scores its shards
+        """
+        stamps = []
+        for hour in hours:
+            try:
+                st = os.stat(self.grid_store.path(self.source, hour))
+                stamps.append((st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stamps.append(None)
+        return stamps
+
+    def plan(self, hours):
+        """
+        Splits hours into shards. Each shard covers every hour of its time block, not just the hours asked for
+        :param hours: datetime64[h] array of hours
+        :return: list of shard dictionaries (key, hour0, hours, row0, row1, col0, col1, fingerprint, path), ordered by
+                 time block then tile
+        """
+        seconds = np.asarray(hours).astype("datetime64[h]").astype("datetime64[s]").astype(np.int64)
+        block_seconds = 3600 * self.hours_per_shard
+        model = self._model_fingerprint()
+        ny, nx = self.grid.shape
+        shards = []
+        for hour0 in np.unique(seconds - seconds % block_seconds):
+            block_hours = hour0 + 3600 * np.arange(self.hours_per_shard, dtype=np.int64)
+            block_stamps = list(zip(block_hours.tolist(),
+                                    self._input_stamps(block_hours.astype("datetime64[s]").astype("datetime64[h]"))))
+            stamp = np.datetime64(int(hour0), "s").astype(object).strftime(SHARD_FILE_FORMAT)
+            for row0 in range(0, ny, self.tile[0]):
+                for col0 in range(0, nx, self.tile[1]):
+                    row1, col1 = min(row0 + self.tile[0], ny), min(col0 + self.tile[1], nx)
+                    key = "{}_r{:04d}_c{:04d}".format(stamp, row0, col0)
+                    shards.append({"key": key, "hour0": int(hour0), "hours": block_hours, "row0": row0,
+                                   "row1": row1, "col0": col0, "col1": col1,
+                                   "fingerprint": _hash(model, row0, row1, col0, col1, block_stamps),
+                                   "path": os.path.join(self.shard_dir, key + ".npz")})
+        return shards
+
+    def _finished(self, shards):
+        """
+        :return: set of the keys of shards already scored from the same inputs
+        """
+        keys = [s["key"] for s in shards]
+        done = {}
+        with self._connect() as conn:
+            for i in range(0, len(keys), 500):  # stay under SQLite's bound-parameter limit
+                batch = keys[i:i + 500]
+                done.update(conn.execute("SELECT key, fingerprint FROM shards WHERE key IN ({})".format(
+                    ",".join("?" * len(batch))), batch).fetchall())
+        return {s["key"] for s in shards if done.get(s["key"]) == s["fingerprint"] and os.path.exists(s["path"])}
+
+    def _stack_features(self, hours, path):
+        """
+        Writes the features for a list of hours to a memory-mapped (features, hours, ny, nx) float32 .npy file, NaN
+        wherever an hour or a feature is missing
+        """
+        stacked = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                            shape=(len(self.features), len(hours)) + self.grid.shape)
+        stacked[...] = np.nan
+        for i, hour in enumerate(hours.astype("datetime64[h]")):
+            fields = self.grid_store.read(self.source, hour)
+            if fields is None:
+                continue
+            for k, name in enumerate(self.features):
+                if name in fields:
+                    stacked[k, i] = fields[name]
+        stacked.flush()
+        del stacked
+
+    def run(self, hours, max_workers=None, force=False):
+        """
+        Scores every shard of hours that isn't already checkpointed
+        :param hours: datetime64[h] array of hours to score
+        :param max_workers: optional integer giving the number of worker processes. Defaults to one per core
+        :param force: whether to re-score shards even if they're checkpointed
+        :return: dictionary with 'shards', 'scored', 'skipped' and 'failed' (list of shard keys) entries
+        """
+        shards = self.plan(hours)
+        finished = set() if force else self._finished(shards)
+        todo = [s for s in shards if s["key"] not in finished]
+        summary = {"shards": len(shards), "scored": 0, "skipped": len(shards) - len(todo), "failed": []}
+        if not todo:
+            self.logger.info("all {} shard(s) already scored".format(len(shards)))
+            return summary
+
+        # every block with any shard left to do goes into the features file, in block order, so each shard's hours
+        # are one contiguous run of it
+        blocks = sorted({s["hour0"] for s in todo})
+        block_hours = {s["hour0"]: s["hours"] for s in todo}
+        hours_needed = np.concatenate([block_hours[b] for b in blocks])
+        first_index = {}
+        position = 0
+        for b in blocks:
+            first_index[b] = position
+            position += len(block_hours[b])
+
+        features_path = os.path.join(self.base_dir, "features.{}.npy".format(os.getpid()))
+        started = time.perf_counter()
+        try:
+            with self.metrics.timer("score_stack_seconds"):
+                self._stack_features(hours_needed.astype("datetime64[s]"), features_path)
+            self.logger.info("scoring {} of {} shard(s) over {} hour(s); {} already done".format(
+                len(todo), len(shards), len(hours_needed), summary["skipped"]))
+
+            # spawned rather than forked: the caller may have threads (loggers, HTTP pools) that don't survive a fork
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool, self._connect() as conn:
+                futures = {pool.submit(_score_shard, features_path, self.features, first_index[s["hour0"]],
+                                       len(s["hours"]), s["row0"], s["row1"], s["col0"], s["col1"], s["hours"],
+                                       self.score_fn, self.coefficients, s["path"]): s for s in todo}
+                for future in as_completed(futures):
+                    s = futures[future]
+                    try:
+                        n_valid, max_probability = future.result()
+                    except Exception as e:
+                        self.logger.error("shard {} failed: {}".format(s["key"], e))
+                        self.metrics.count("score_shard_failures_total")
+                        summary["failed"].append(s["key"])
+                        continue
+                    # checkpointed as each shard lands, so an interrupted run keeps what it finished
+                    conn.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (s["key"], s["hour0"], s["row0"], s["row1"] - s["row0"], s["col0"],
+                                  s["col1"] - s["col0"], s["fingerprint"], s["path"], n_valid, max_probability,
+                                  time.time()))
+                    conn.commit()
+                    self.metrics.count("score_shards_total")
+                    summary["scored"] += 1
+        finally:
+            if os.path.exists(features_path):
+                os.remove(features_path)
+        self.metrics.observe("score_run_seconds", time.perf_counter() - started)
+        self.logger.info("scored {} shard(s) in {:.1f} s; {} failed".format(summary["scored"],
+                                                                           time.perf_counter() - started,
+                                                                           len(summary["failed"])))
+        return summary
+
+    def read(self, hours):
+        """
+        Stitches scored shards back into whole-grid maps
+        :param hours: datetime64[h] array of hours
+        :return: float32 (hours, ny, nx) array of probabilities in the order of the sorted, unique hours; NaN wherever
+                 nothing has been scored
+        """
+        hours = np.unique(np.asarray(hours).astype("datetime64[h]"))
+        seconds = hours.astype("datetime64[s]").astype(np.int64)
+        out = np.full((len(hours),) + self.grid.shape, np.nan, dtype=np.float32)
+        if len(hours) == 0:
+            return out
+        block_seconds = 3600 * self.hours_per_shard
+        with self._connect() as conn:
+            rows = conn.execute("SELECT path, row0, n_rows, col0, n_cols FROM shards WHERE hour0 >= ? AND hour0 <= ?",
+                                (int(seconds[0] - seconds[0] % block_seconds), int(seconds[-1]))).fetchall()
+        for path, row0, n_rows, col0, n_cols in rows:
+            if not os.path.exists(path):
+                continue
+            with np.load(path) as f:
+                shard_hours, probability = f["hours"], f["probability"]
+            i = np.searchsorted(seconds, shard_hours)
+            hit = (i < len(seconds)) & (seconds[np.minimum(i, len(seconds) - 1)] == shard_hours)
+            out[i[hit], row0:row0 + n_rows, col0:col0 + n_cols] = probability[hit]
+        return out
@@ -0,0 +1,289 @@
+# Offline benchmarks for wile's pull, parse and storage paths, run against the local stand-ins in standins.py.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Usage, from the repository root:
+#   python benchmarks/run_benchmarks.py                               # every scenario, default sizes
+#   python benchmarks/run_benchmarks.py --stations 2000 --hist-days 14 --latency 0.2 --output bench.json
+#   python benchmarks/run_benchmarks.py --baseline bench.json         # exit 1 if anything got slower or bigger
+#
+# Scenarios:
+#   synoptic_rt    wile.pull_synoptic_rt() over every stand-in station
+#   synoptic_hist  wile.pull_synoptic_hist() over hist_days of timeseries, without the fetch cache
+#   ldas           wile.pull_ldas_rt() over ldas_days subset jobs
+#   parse          synoptic_decode of one timeseries payload already in memory
+#   storage        parquet and SQLite writes of that payload once decoded
+# Each run happens in a fresh process against a fresh base directory, so every run starts cold and the peak
+# resident memory reported is that run's own. Request latencies come from the metrics module's JSON-lines events.
+# A scenario that raises, crashes or runs past --timeout is reported as failed and the script exits 1.
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import standins  # noqa: E402  (needs the path set up above)
+
+SCENARIOS = ("synoptic_rt", "synoptic_hist", "ldas", "parse", "storage")
+HIST_END = datetime(2024, 7, 1)  # fixed, so runs are comparable from one day to the next
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KiB on Linux
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def _request_events(metrics_dir):
+    """
+    :return: (list of request latencies in seconds, total bytes transferred) read back from the metrics events
+    """
+    latencies, n_bytes = [], 0
+    for path in glob.glob(os.path.join(metrics_dir, "*.jsonl")):
+        with open(path) as f:
+            for line in f:
+                event = json.loads(line)
+                if event["metric"] == "request_seconds":
+                    latencies.append(event["value"])
+                elif event["metric"] == "request_bytes_total":
+                    n_bytes += event["value"]
+    return latencies, n_bytes
+
+
+def _make_wile(url, base_dir):
+    import wildfire_probability_estimator
+    return wildfire_probability_estimator.wile("bench", syn_api_root=url + "/v2/",
+                                               gesdisc_svc_url=url + "/service/subset/jsonwsp", base_dir=base_dir,
+                                               logger_level=30, print_to_console=False, record_metrics=True,
+                                               metrics_formats=("jsonl",))
+
+
+def _timeseries_payload(url, opts):
+    import requests
+    end = HIST_END
+    start = end - timedelta(days=opts["parse_days"])
+    resp = requests.get(url + "/v2/stations/timeseries",
+                        params={"START": start.strftime("%Y%m%d%H%M"), "END": end.strftime("%Y%m%d%H%M")})
+    return resp.json()["STATION"], len(resp.content)
+
+
+def _measure(name, url, opts):
+    """
+    Runs one scenario in this (fresh) process
+    :return: dictionary of its measurements
+    """
+    base_dir = tempfile.mkdtemp(prefix="wile_bench_")
+    result = {"scenario": name}
+    if name in ("parse", "storage"):
+        import synoptic_decode
+        stations, n_bytes = _timeseries_payload(url, opts)
+        baseline_rss = _peak_rss_mb()
+        started = time.perf_counter()
+        df = synoptic_decode.decode_observations(stations)
+        stations_df = synoptic_decode.decode_stations(stations)
+        if name == "storage":
+            import columnar_store
+            import obs_store
+            parse_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            columnar_store.write_partitioned(df, os.path.join(base_dir, "parquet"), partition_cols=("date", "variable"))
+            obs_store.ObservationStore(os.path.join(base_dir, "obs.sqlite")).upsert_observations(df, stations_df)
+            result["parse_seconds"] = parse_seconds
+        result.update(seconds=time.perf_counter() - started, rows=len(df), bytes=n_bytes, latencies=[])
+    else:
+        wpe = _make_wile(url, base_dir)
+        baseline_rss = _peak_rss_mb()
+        started = time.perf_counter()
+        if name == "synoptic_rt":
+            df = wpe.pull_synoptic_rt(derive=False)
+            rows = len(df)
+        elif name == "synoptic_hist":
+            start = HIST_END - timedelta(days=opts["hist_days"])
+            df = wpe.pull_synoptic_hist(start=start.strftime(wpe.SYN_TIME_FORMAT),
+                                        end=HIST_END.strftime(wpe.SYN_TIME_FORMAT), use_cache=False)
+            rows = len(df)
+        else:
+            import gesdisc
+            # the stand-in takes any login; a session of our own keeps the real auth files in ~ out of it
+            wpe._earthdata_session = gesdisc.EarthdataSession("bench", "bench", os.path.join(base_dir, "cookies.txt"))
+            start = datetime(2015, 8, 1)
+            end = start + timedelta(days=opts["ldas_days"]) - timedelta(milliseconds=1)
+            rows = len(wpe.pull_ldas_rt(start=gesdisc.format_gesdisc_time(start), end=gesdisc.format_gesdisc_time(end)))
+        seconds = time.perf_counter() - started
+        wpe.close()
+        latencies, n_bytes = _request_events(wpe.METRICS.out_dir)
+        result.update(seconds=seconds, rows=rows, bytes=n_bytes, latencies=latencies)
+    result["peak_rss_mb"] = _peak_rss_mb()
+    result["baseline_rss_mb"] = baseline_rss
+    return result
+
+
+def _run_scenario(name, url, opts, result_queue):
+    """
+    Child process entry point: always puts either the measurements or the error on result_queue, so the parent never
+    waits on a scenario that died
+    """
+    try:
+        result = _measure(name, url, opts)
+    except BaseException:
+        result = {"scenario": name, "error": traceback.format_exc()}
+    result_queue.put(result)
+
+
+def run(name, url, opts):
+    """
+    Runs a scenario opts['repeat'] times, each in a fresh process
+    :return: dictionary summarizing the runs: median wall time, throughput, latency percentiles, peak memory; or, if
+             any run failed, a dictionary with the scenario name and an 'error' string
+    """
+    ctx = multiprocessing.get_context("spawn")  # a clean interpreter every time, so memory numbers aren't inherited
+    runs = []
+    for _ in range(opts["repeat"]):
+        result_queue = ctx.Queue()
+        proc = ctx.Process(target=_run_scenario, args=(name, url, opts, result_queue))
+        proc.start()
+        try:
+            result = result_queue.get(timeout=opts["timeout"])
+        except queue.Empty:
+            # crashed without a word (killed, segfault, out of memory) or still going past the timeout
+            proc.terminate()
+            proc.join()
+            return {"scenario": name, "error": "no result after {} s; exit code {}".format(opts["timeout"],
+                                                                                        proc.exitcode)}
+        proc.join(timeout=60)
+        if "error" in result:
+            return result
+        if proc.exitcode != 0:
+            return {"scenario": name, "error": "exited with code {}".format(proc.exitcode)}
+        runs.append(result)
+    seconds = statistics.median(r["seconds"] for r in runs)
+    latencies = [v for r in runs for v in r["latencies"]]
+    summary = {"scenario": name,
+               "runs": len(runs),
+               "seconds": seconds,
+               "rows": runs[0]["rows"],
+               "rows_per_s": runs[0]["rows"] / seconds if seconds else None,
+               "mb_per_s": runs[0]["bytes"] / 2 ** 20 / seconds if seconds else None,
+               "requests": len(latencies) // len(runs),
+               "p50_ms": None, "p90_ms": None, "p99_ms": None,
+               "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+               "rss_growth_mb": max(r["peak_rss_mb"] - r["baseline_rss_mb"] for r in runs)}
+    for q in (50, 90, 99):
+        p = _percentile(latencies, q)
+        summary["p{}_ms".format(q)] = p * 1000 if p is not None else None
+    if "parse_seconds" in runs[0]:
+        summary["parse_seconds"] = statistics.median(r["parse_seconds"] for r in runs)
+    return summary
+
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else "-"
+
+
+def report(results):
+    failed = [r for r in results if "error" in r]
+    results = [r for r in results if "error" not in r]
+    print("{:<14} {:>8} {:>10} {:>10} {:>8} {:>6} {:>8} {:>8} {:>8} {:>9} {:>9}".format(
+        "scenario", "seconds", "rows", "rows/s", "MB/s", "reqs", "p50 ms", "p90 ms", "p99 ms", "peak MB", "growth MB"))
+    for r in results:
+        print("{:<14} {:>8} {:>10} {:>10} {:>8} {:>6} {:>8} {:>8} {:>8} {:>9} {:>9}".format(
+            r["scenario"], _fmt(r["seconds"], ".2f"), r["rows"], _fmt(r["rows_per_s"], ".0f"),
+            _fmt(r["mb_per_s"], ".1f"), r["requests"], _fmt(r["p50_ms"], ".0f"), _fmt(r["p90_ms"], ".0f"),
+            _fmt(r["p99_ms"], ".0f"), _fmt(r["peak_rss_mb"], ".0f"), _fmt(r["rss_growth_mb"], ".0f")))
+    for r in failed:
+        print("FAILED {}: {}".format(r["scenario"], r["error"].rstrip()))
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Compares wall time and memory growth with an earlier --output file
+    :return: list of strings describing each regression beyond tolerance
+    """
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = baseline.get(r["scenario"])
+        if old is None or "error" in old or "error" in r:
+            continue
+        for key in ("seconds", "rss_growth_mb"):
+            # memory growth under a few MB is noise
+            floor = 5 if key == "rss_growth_mb" else 0
+            if r[key] > max(old[key] * (1 + tolerance), old[key] + floor):
+                regressions.append("{}: {} went from {:.3f} to {:.3f}".format(r["scenario"], key, old[key], r[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark wile against local stand-ins for Synoptic and GES DISC")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated, from " + ", ".join(SCENARIOS))
+    parser.add_argument("--stations", type=int, default=1000, help="stations in the stand-in region (default: 1000)")
+    parser.add_argument("--interval", type=int, default=5, help="minutes between timeseries timesteps (default: 5)")
+    parser.add_argument("--hist-days", type=int, default=7, help="days pulled by synoptic_hist (default: 7)")
+    parser.add_argument("--parse-days", type=int, default=1, help="days in the parse/storage payload (default: 1)")
+    parser.add_argument("--ldas-days", type=int, default=4, help="subset jobs (one per day) in ldas (default: 4)")
+    parser.add_argument("--granules", type=int, default=4, help="granules per subset job (default: 4)")
+    parser.add_argument("--granule-mb", type=float, help="pad every granule to this size")
+    parser.add_argument("--job-seconds", type=float, default=0.0, help="how long each subset job runs (default: 0)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response (default: 0.05)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="most seconds of random extra latency")
+    parser.add_argument("--recorded-dir", help="replay recorded latest.json/timeseries.json from this directory")
+    parser.add_argument("--granule-template", default=standins.find_granule_template(REPO_DIR),
+                        help="granule to serve (default: the first data/*.he5)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario; the median is reported (default: 3)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with an earlier --output file; exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown/growth vs the baseline")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds one run may take (default: 900)")
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenario(s): " + ", ".join(sorted(unknown)))
+    if "ldas" in scenarios and args.granule_template is None:
+        parser.error("the ldas scenario needs a granule to serve: pass --granule-template")
+    opts = {"hist_days": args.hist_days, "parse_days": args.parse_days, "ldas_days": args.ldas_days,
+            "repeat": args.repeat, "timeout": args.timeout}
+
+    with standins.StandinServer(n_stations=args.stations, interval_minutes=args.interval, latency=args.latency,
+                                jitter=args.jitter, recorded_dir=args.recorded_dir,
+                                granule_template=args.granule_template, granules_per_job=args.granules,
+                                granule_bytes=int(args.granule_mb * 2 ** 20) if args.granule_mb else None,
+                                job_seconds=args.job_seconds) as server:
+        results = [run(name, server.url, opts) for name in scenarios]
+
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"when": datetime.utcnow().isoformat(), "config": vars(args), "results": results}, f, indent=2)
+    regressions = []
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+    if regressions or any("error" in r for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
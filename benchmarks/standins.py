@@ -0,0 +1,320 @@
+# Local stand-ins for the Synoptic and GES DISC APIs, so pulls can be benchmarked without tokens, credentials or a
+# network. Responses are synthetic (or recorded responses replayed and scaled up), with configurable latency and size.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Endpoints, all under one local HTTP server:
+#   GET  /v2/stations/metadata      station list
+#   GET  /v2/stations/latest        one value per station and variable
+#   GET  /v2/stations/timeseries    every timestep between START and END, interval_minutes apart
+#   POST /service/subset/jsonwsp    GES DISC subset / GetStatus / GetResult
+#   GET  /data/<label>              granule downloads
+# The server runs in a process of its own (StandinServer.start()), so encoding responses doesn't compete with the
+# code being measured for the GIL.
+
+import glob
+import json
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# observation key -> (mean, amplitude) of the synthetic diurnal cycle
+SERIES = {"air_temp_set_1": (18.0, 8.0),
+          "relative_humidity_set_1": (45.0, 20.0),
+          "dew_point_temperature_set_1d": (6.0, 3.0),
+          "sea_level_pressure_set_1d": (1013.0, 4.0),
+          "precip_accum_set_1": (2.0, 2.0),
+          "wind_speed_set_1": (12.0, 6.0)}
+UNITS = {"air_temp": "Celsius", "relative_humidity": "%", "dew_point_temperature": "Celsius",
+         "sea_level_pressure": "Millibars", "precip_accum": "Millimeters", "wind_speed": "km/h"}
+CA_BBOX = (-124.5, 32.5, -114.0, 42.1)
+SYN_TIME_FORMAT = "%Y%m%d%H%M"
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def find_granule_template(base_dir):
+    """
+    :return: string giving the path of a real MLS granule under base_dir/data to serve, or None if there isn't one
+    """
+    paths = sorted(glob.glob(os.path.join(base_dir, "data", "*.he5")))
+    return paths[0] if paths else None
+
+
+class SynopticStandin:
+    """
+    Generates synoptic responses. Values follow a diurnal cycle offset per station; they only need to decode like
+    the real thing, not to be meteorologically sensible. Value arrays are encoded once per length and reused, so
+    building even a large response is mostly string joins.
+    """
+    def __init__(self, n_stations=500, interval_minutes=5, recorded_dir=None, seed=0):
+        """
+        :param n_stations: integer giving the number of stations in the region
+        :param interval_minutes: integer giving the minutes between timesteps in timeseries responses
+        :param recorded_dir: optional directory holding recorded responses named latest.json and/or timeseries.json.
+                             Their stations are replayed, repeated under new STIDs up to n_stations
+        :param seed: integer seeding station placement
+        """
+        rng = np.random.default_rng(seed)
+        self.n_stations = n_stations
+        self.interval = timedelta(minutes=interval_minutes)
+        self.stids = ["BNCH{:05d}".format(i) for i in range(n_stations)]
+        self.lat = rng.uniform(CA_BBOX[1], CA_BBOX[3], n_stations)
+        self.lon = rng.uniform(CA_BBOX[0], CA_BBOX[2], n_stations)
+        self._encoded = {}  # (key, n) -> JSON array text
+        self._lock = threading.Lock()
+        self.recorded = {}  # endpoint -> list of encoded station objects
+        for name in ("latest", "timeseries"):
+            path = os.path.join(recorded_dir, name + ".json") if recorded_dir else None
+            if path and os.path.exists(path):
+                with open(path) as f:
+                    self.recorded[name] = self._scale(json.load(f)["STATION"])
+
+    def _scale(self, stations):
+        encoded = []
+        for i in range(self.n_stations):
+            station = dict(stations[i % len(stations)])
+            if i >= len(stations):
+                station["STID"] = "{}_{}".format(station["STID"], i // len(stations))
+            encoded.append(json.dumps(station))
+        return encoded
+
+    def _header(self, i):
+        return ('"STID": "{}", "NAME": "Bench station {}", "LATITUDE": "{:.4f}", "LONGITUDE": "{:.4f}", '
+                '"ELEVATION": "{}", "STATUS": "ACTIVE", "QC_FLAGGED": false'
+                .format(self.stids[i], i, self.lat[i], self.lon[i], 100 + i % 2000))
+
+    def _values(self, key, n):
+        with self._lock:
+            text = self._encoded.get((key, n))
+        if text is None:
+            mean, amplitude = SERIES[key]
+            values = mean + amplitude * np.sin(np.arange(n) * 2 * math.pi / max(n, 1))
+            if key.startswith("precip_accum"):
+                values = np.cumsum(np.abs(values)) / 10
+            text = "[" + ",".join("{:.2f}".format(v) for v in values) + "]"
+            with self._lock:
+                self._encoded[(key, n)] = text
+        return text
+
+    def _selected(self, args):
+        if "stid" in args:
+            wanted = set(args["stid"].split(","))
+            return [i for i, s in enumerate(self.stids) if s in wanted]
+        return list(range(self.n_stations))
+
+    def _response(self, stations):
+        return ('{"SUMMARY": {"RESPONSE_CODE": 1, "NUMBER_OF_OBJECTS": ' + str(len(stations)) + '}, "UNITS": ' +
+                json.dumps(UNITS) + ', "STATION": [' + ",".join(stations) + "]}").encode()
+
+    def metadata(self, args):
+        return self._response(["{" + self._header(i) + "}" for i in self._selected(args)])
+
+    def latest(self, args):
+        if "latest" in self.recorded:
+            return self._response(self.recorded["latest"])
+        now = datetime.utcnow().replace(second=0, microsecond=0).strftime(ISO_FORMAT)
+        stations = []
+        for i in self._selected(args):
+            obs = ", ".join('"{}": {{"value": {:.2f}, "date_time": "{}"}}'.format(
+                key.replace("_set_", "_value_"), mean + (i % 7), now) for key, (mean, _) in SERIES.items())
+            stations.append("{" + self._header(i) + ', "OBSERVATIONS": {' + obs + "}}")
+        return self._response(stations)
+
+    def timeseries(self, args):
+        if "timeseries" in self.recorded:
+            return self._response(self.recorded["timeseries"])
+        start = datetime.strptime(args["START"], SYN_TIME_FORMAT)
+        end = datetime.strptime(args["END"], SYN_TIME_FORMAT)
+        times = []
+        t = start
+        while t <= end:
+            times.append(t.strftime(ISO_FORMAT))
+            t += self.interval
+        if not times:
+            return ('{"SUMMARY": {"RESPONSE_CODE": 2, "RESPONSE_MESSAGE": "No stations found for this request."}, '
+                    '"STATION": []}').encode()
+        dates = '"date_time": ' + json.dumps(times)
+        obs = ", ".join('"{}": {}'.format(key, self._values(key, len(times))) for key in SERIES)
+        body = ', "OBSERVATIONS": {' + dates + ", " + obs + "}}"
+        return self._response(["{" + self._header(i) + body for i in self._selected(args)])
+
+
+class GesdiscStandin:
+    """
+    Imitates the GES DISC subset service: jobs finish job_seconds after they're submitted (straight away if 0), and
+    each one's results list granules_per_job granules, all served from one template file padded to granule_bytes.
+    """
+    def __init__(self, granule_template, granules_per_job=4, granule_bytes=None, job_seconds=0.0):
+        """
+        :param granule_template: string giving the path of a real granule to serve, so downloaded granules can be
+                                 opened and cataloged like real ones
+        :param granules_per_job: integer giving the number of granules each job returns
+        :param granule_bytes: optional integer giving the size to pad every granule to
+        :param job_seconds: float giving how long each job stays Running
+        """
+        with open(granule_template, "rb") as f:
+            self.granule = f.read()
+        if granule_bytes and granule_bytes > len(self.granule):
+            self.granule += b"\0" * (granule_bytes - len(self.granule))  # HDF5 ignores anything past its end of file
+        self.granules_per_job = granules_per_job
+        self.job_seconds = job_seconds
+        self.jobs = {}  # job ID -> (submitted at, start string)
+        self._lock = threading.Lock()
+
+    def _status(self, job_id):
+        submitted, _ = self.jobs[job_id]
+        elapsed = time.monotonic() - submitted
+        if elapsed >= self.job_seconds:
+            return {"jobId": job_id, "Status": "Succeeded", "PercentCompleted": 100, "message": "Complete"}
+        return {"jobId": job_id, "Status": "Running", "PercentCompleted": int(100 * elapsed / self.job_seconds)}
+
+    def call(self, request, base_url):
+        method = request.get("methodname")
+        args = request.get("args", {})
+        if method == "subset":
+            with self._lock:
+                job_id = "bench{:06d}".format(len(self.jobs))
+                self.jobs[job_id] = (time.monotonic(), args.get("start", "2015-08-01T00:00:00.000Z"))
+            result = self._status(job_id)
+            if result["Status"] != "Succeeded":
+                result["Status"] = "Accepted"
+        elif method == "GetStatus":
+            result = self._status(args["jobId"])
+        elif method == "GetResult":
+            job_id = args["jobId"]
+            day = datetime.strptime(self.jobs[job_id][1][:10], "%Y-%m-%d")
+            items = [{"label": "README.pdf", "link": base_url + "/docs/README.pdf"}]
+            for k in range(self.granules_per_job):
+                label = "MLS-Aura_L2GP-Temperature_v04-22-c01_{}d{:03d}.{}{:03d}.SUB.he5".format(
+                    day.year, day.timetuple().tm_yday, job_id, k)
+                items.append({"label": label, "link": base_url + "/data/" + label,
+                              "start": day.strftime(ISO_FORMAT), "end": (day + timedelta(days=1)).strftime(ISO_FORMAT)})
+            first = int(args.get("startIndex", 0))
+            count = int(args.get("count", len(items)))
+            result = {"items": items[first:first + count], "totalResults": len(items), "itemsPerPage": count}
+        else:
+            return {"type": "jsonwsp/fault", "fault": {"code": "client", "string": "unknown method " + str(method)}}
+        return {"type": "jsonwsp/response", "version": "1.0", "methodname": method, "result": result}
+
+
+def _make_handler(synoptic, gesdisc, latency, jitter):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body, content_type="application/json"):
+            time.sleep(latency + random.uniform(0, jitter))
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            args = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            endpoints = {"/v2/stations/metadata": synoptic.metadata, "/v2/stations/latest": synoptic.latest,
+                         "/v2/stations/timeseries": synoptic.timeseries}
+            if url.path in endpoints:
+                self._send(200, endpoints[url.path](args))
+            elif url.path.startswith("/data/") and gesdisc is not None:
+                self._send(200, gesdisc.granule, "application/octet-stream")
+            elif url.path.startswith("/docs/"):
+                self._send(200, b"bench", "application/pdf")
+            else:
+                self._send(404, b'{"error": "not found"}')
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if urlparse(self.path).path == "/service/subset/jsonwsp" and gesdisc is not None:
+                base_url = "http://" + self.headers["Host"]  # granule links point back at this server
+                self._send(200, json.dumps(gesdisc.call(request, base_url)).encode())
+            else:
+                self._send(404, b'{"error": "not found"}')
+
+    return Handler
+
+
+def _serve(config, ready):
+    synoptic = SynopticStandin(config["n_stations"], config["interval_minutes"], config.get("recorded_dir"))
+    gesdisc = GesdiscStandin(config["granule_template"], config["granules_per_job"], config.get("granule_bytes"),
+                             config["job_seconds"]) if config.get("granule_template") else None
+    server = ThreadingHTTPServer(("127.0.0.1", config.get("port", 0)),
+                                 _make_handler(synoptic, gesdisc, config["latency"], config["jitter"]))
+    server.daemon_threads = True
+    ready.put("http://127.0.0.1:{}".format(server.server_address[1]))
+    server.serve_forever()
+
+
+class StandinServer:
+    """
+    Runs the stand-ins in a child process. Use as a context manager, or call start() and stop()
+    """
+    def __init__(self, n_stations=500, interval_minutes=5, latency=0.05, jitter=0.02, recorded_dir=None,
+                 granule_template=None, granules_per_job=4, granule_bytes=None, job_seconds=0.0, port=0):
+        """
+        :param latency: seconds every response is held back, standing in for network and server time
+        :param jitter: most seconds randomly added to latency
+        :param port: integer giving the port to listen on; 0 picks a free one
+        See SynopticStandin and GesdiscStandin for the rest
+        """
+        self.config = {"n_stations": n_stations, "interval_minutes": interval_minutes, "latency": latency,
+                       "jitter": jitter, "recorded_dir": recorded_dir, "granule_template": granule_template,
+                       "granules_per_job": granules_per_job, "granule_bytes": granule_bytes,
+                       "job_seconds": job_seconds, "port": port}
+        self.url = None
+        self._process = None
+
+    def start(self):
+        """
+        :return: string giving the server's base URL, e.g. 'http://127.0.0.1:54321'
+        """
+        ready = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve, args=(self.config, ready), daemon=True)
+        self._process.start()
+        self.url = ready.get(timeout=30)
+        return self.url
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+if __name__ == "__main__":  # run the stand-ins on their own, e.g. to point a development wile object at
+    import argparse
+    parser = argparse.ArgumentParser(description="serve the Synoptic and GES DISC stand-ins")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--stations", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--recorded-dir", help="directory of recorded latest.json/timeseries.json responses")
+    parser.add_argument("--granule-template", default=find_granule_template(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    opts = parser.parse_args()
+    standins = StandinServer(n_stations=opts.stations, latency=opts.latency, recorded_dir=opts.recorded_dir,
+                             granule_template=opts.granule_template, port=opts.port)
+    print("serving on {0}; synoptic API root {0}/v2/, GES DISC subset URL {0}/service/subset/jsonwsp".format(
+        standins.start()))
+    try:
+        standins._process.join()
+    except KeyboardInterrupt:
+        standins.stop()
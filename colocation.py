@@ -0,0 +1,236 @@
+# Vectorized station <-> satellite colocation: a uniform-grid spatial index over station coordinates, queried with
+# whole arrays of swath points at a time.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEG_LAT = np.pi * EARTH_RADIUS_KM / 180
+
+
+def _unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def _chord_to_km(chord):
+    # great-circle distance from the straight-line distance between two points on the unit sphere
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def station_fingerprint(stids, lat, lon):
+    """
+    Hashes a station set, so a cached index can tell whether it's still valid
+    :return: hex string
+    """
+    h = hashlib.sha1()
+    h.update("\0".join(map(str, stids)).encode("utf-8"))
+    h.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class StationIndex:
+    """
+    Buckets stations into a uniform lat/lon grid. A radius query only looks at the grid cells that could hold a match,
+    and all of the bookkeeping is done with NumPy over whole batches of query points -- no Python loop per point.
+    Distances are great-circle distances.
+    """
+    def __init__(self, stids, lat, lon, cell_deg=0.25):
+        """
+        :param stids: sequence of station IDs
+        :param lat: array of station latitudes in degrees
+        :param lon: array of station longitudes in degrees
+        :param cell_deg: float giving the grid cell size in degrees
+        """
+        self.stids = np.asarray(stids)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.cell_deg = cell_deg
+        self.fingerprint = station_fingerprint(self.stids, self.lat, self.lon)
+
+        valid = np.isfinite(self.lat) & np.isfinite(self.lon)
+        idx = np.flatnonzero(valid)
+        keys = self._cell_keys(self.lat[idx], self.lon[idx])
+        order = np.argsort(keys, kind="stable")
+        self._station_order = idx[order]  # station indices sorted by cell
+        self._keys, self._cell_start, self._cell_count = np.unique(keys[order], return_index=True, return_counts=True)
+        self._xyz = _unit_vectors(self.lat, self.lon)
+        self._max_abs_lat = float(np.abs(self.lat[valid]).max()) if idx.size else 0.0
+
+    def __len__(self):
+        return len(self.stids)
+
+    def _cell_rows(self, lat):
+        return np.floor((np.asarray(lat) + 90) / self.cell_deg).astype(np.int64)
+
+    def _cell_cols(self, lon):
+        return np.floor((np.mod(np.asarray(lon) + 180, 360)) / self.cell_deg).astype(np.int64)
+
+    def _n_cols(self):
+        return int(np.ceil(360 / self.cell_deg))
+
+    def _cell_keys(self, lat, lon):
+        return self._cell_rows(lat) * self._n_cols() + self._cell_cols(lon)
+
+    def _candidates(self, qlat, qlon, radius_km):
+        """
+        Expands each query point into the stations in every grid cell within reach of it
+        :return: (query index, station index) arrays of candidate pairs
+        """
+        n_rows_reach = int(np.ceil(radius_km / (KM_PER_DEG_LAT * self.cell_deg)))
+        # a degree of longitude shrinks with latitude. Any matching pair lies within max_lat of the equator, and two
+        # such points radius_km apart differ by at most 2 asin(sin(radius / 2) / cos(max_lat)) in longitude (from the
+        # haversine formula); once that reaches a half turn (a cap over the pole) every longitude is in reach
+        n_cols = self._n_cols()
+        max_lat = self._max_abs_lat + n_rows_reach * self.cell_deg
+        reach = np.sin(radius_km / EARTH_RADIUS_KM / 2) / np.cos(np.radians(min(max_lat, 90.0)))
+        if max_lat >= 90 or reach >= 1:
+            d_cols = np.arange(n_cols)
+        else:
+            n_cols_reach = int(np.ceil(np.degrees(2 * np.arcsin(reach)) / self.cell_deg))
+            d_cols = np.arange(n_cols) if 2 * n_cols_reach + 1 >= n_cols else np.arange(-n_cols_reach, n_cols_reach + 1)
+
+        d_row, d_col = np.meshgrid(np.arange(-n_rows_reach, n_rows_reach + 1), d_cols, indexing="ij")
+        rows = self._cell_rows(qlat)[:, None] + d_row.ravel()[None, :]
+        cols = np.mod(self._cell_cols(qlon)[:, None] + d_col.ravel()[None, :], n_cols)
+        keys = rows * n_cols + cols
+
+        # look every (query, cell) pair up in the sorted cell table
+        pos = np.searchsorted(self._keys, keys)
+        pos_clipped = np.minimum(pos, len(self._keys) - 1)
+        hit = (pos < len(self._keys)) & (self._keys[pos_clipped] == keys)
+        query_idx = np.broadcast_to(np.arange(len(qlat))[:, None], keys.shape)[hit]
+        starts = self._cell_start[pos_clipped[hit]]
+        counts = self._cell_count[pos_clipped[hit]]
+
+        # expand each hit cell into its stations
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        pair_query = np.repeat(query_idx, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_station = self._station_order[np.repeat(starts, counts) + offsets]
+        return pair_query, pair_station
+
+    def query_radius(self, qlat, qlon, radius_km, batch_size=200000):
+        """
+        Finds every station within radius_km of every query point
+        :param qlat: array of query latitudes in degrees
+        :param qlon: array of query longitudes in degrees
+        :param radius_km: float giving the search radius in km
+        :param batch_size: integer giving how many query points to expand at once, which bounds memory
+        :return: (query index, station index, distance km) arrays, one entry per matched pair, sorted by query
+        """
+        qlat = np.asarray(qlat, dtype=np.float64)
+        qlon = np.asarray(qlon, dtype=np.float64)
+        out_q, out_s, out_d = [], [], []
+        if len(self._keys) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+        for b in range(0, len(qlat), batch_size):
+            blat = qlat[b:b + batch_size]
+            blon = qlon[b:b + batch_size]
+            ok = np.flatnonzero(np.isfinite(blat) & np.isfinite(blon))
+            pq, ps = self._candidates(blat[ok], blon[ok], radius_km)
+            if pq.size == 0:
+                continue
+            qxyz = _unit_vectors(blat[ok][pq], blon[ok][pq])
+            dist = _chord_to_km(np.linalg.norm(qxyz - self._xyz[ps], axis=1))
+            within = dist <= radius_km
+            out_q.append(ok[pq[within]] + b)
+            out_s.append(ps[within])
+            out_d.append(dist[within])
+        if not out_q:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+        return np.concatenate(out_q), np.concatenate(out_s), np.concatenate(out_d)
+
+    def query_nearest(self, qlat, qlon, max_km, batch_size=200000):
+        """
+        Finds the nearest station to every query point, as long as it's within max_km
+        :return: (station index, distance km) arrays the same length as qlat; -1 and inf where nothing is in range
+        """
+        pq, ps, dist = self.query_radius(qlat, qlon, max_km, batch_size=batch_size)
+        nearest = np.full(len(qlat), -1, dtype=np.int64)
+        nearest_dist = np.full(len(qlat), np.inf)
+        if pq.size:
+            order = np.lexsort((dist, pq))  # by query, then distance: the first of each query is its nearest
+            first = order[np.r_[True, pq[order][1:] != pq[order][:-1]]]
+            nearest[pq[first]] = ps[first]
+            nearest_dist[pq[first]] = dist[first]
+        return nearest, nearest_dist
+
+
+def match_times(pair_query, pair_station, query_times, obs_station, obs_times, window):
+    """
+    For each (query point, station) pair, picks the station's observation closest in time to the query point, if one
+    is within the window. Observations are matched with one sorted-array search, not a loop.
+    :param pair_query: array of query indices from StationIndex.query_radius()
+    :param pair_station: array of station indices from StationIndex.query_radius()
+    :param query_times: datetime64 array of query point times
+    :param obs_station: integer array giving each observation's station index (same numbering as the index)
+    :param obs_times: datetime64 array of observation times
+    :param window: numpy timedelta64 (or datetime.timedelta) giving the largest allowed time difference
+    :return: (pair index, observation index, time difference in seconds) arrays for the pairs that found a match
+    """
+    window_s = int(np.timedelta64(window, "s").astype(np.int64))
+    obs_t = np.asarray(obs_times).astype("datetime64[s]").astype(np.int64)
+    q_t = np.asarray(query_times).astype("datetime64[s]").astype(np.int64)[pair_query]
+    if obs_t.size == 0 or pair_query.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # sort observations by (station, time) and search on that combined key
+    span = int(max(obs_t.max(), q_t.max()) - min(obs_t.min(), q_t.min())) + 2 * window_s + 1
+    base = min(obs_t.min(), q_t.min()) - window_s
+    obs_key = np.asarray(obs_station, dtype=np.int64) * span + (obs_t - base)
+    order = np.argsort(obs_key, kind="stable")
+    sorted_key = obs_key[order]
+    q_key = np.asarray(pair_station, dtype=np.int64) * span + (q_t - base)
+
+    right = np.searchsorted(sorted_key, q_key)  # first observation at or after the query time
+    left = right - 1
+    best = np.full(q_key.shape, -1, dtype=np.int64)
+    best_dt = np.full(q_key.shape, np.iinfo(np.int64).max, dtype=np.int64)
+    for cand in (left, right):
+        ok = (cand >= 0) & (cand < len(sorted_key))
+        cand_c = np.clip(cand, 0, len(sorted_key) - 1)
+        dt = np.abs(sorted_key[cand_c] - q_key)
+        same_station = (sorted_key[cand_c] // span) == (q_key // span)
+        better = ok & same_station & (dt <= window_s) & (dt < best_dt)
+        best = np.where(better, cand_c, best)
+        best_dt = np.where(better, dt, best_dt)
+
+    found = best >= 0
+    return np.flatnonzero(found), order[best[found]], best_dt[found]
+
+
+_INDEX_CACHE = OrderedDict()
+_INDEX_CACHE_LOCK = threading.Lock()
+_INDEX_CACHE_SIZE = 4
+
+
+def get_station_index(stids, lat, lon, cell_deg=0.25):
+    """
+    Returns a StationIndex for a station set, reusing a cached one if the station set hasn't changed
+    :return: StationIndex
+    """
+    key = (station_fingerprint(stids, lat, lon), cell_deg)
+    with _INDEX_CACHE_LOCK:
+        if key in _INDEX_CACHE:
+            _INDEX_CACHE.move_to_end(key)
+            return _INDEX_CACHE[key]
+    index = StationIndex(stids, lat, lon, cell_deg=cell_deg)
+    with _INDEX_CACHE_LOCK:
+        _INDEX_CACHE[key] = index
+        while len(_INDEX_CACHE) > _INDEX_CACHE_SIZE:
+            _INDEX_CACHE.popitem(last=False)
+    return index
@@ -0,0 +1,192 @@
+# Partitioned, compressed columnar (parquet) storage for observation tables, replacing the old CSV dumps.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Layout under a base directory, hive style so pyarrow can prune partitions from a filter without opening files:
+#   <base>/date=2024-07-01/variable=air_temp/part-0.parquet
+#   <base>/stations.parquet
+# Historical data is partitioned by date and variable, real-time data by date only.
+
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed once something actually reads or writes parquet
+    pa = ds = pq = None
+
+PART_FILENAME = "part-0.parquet"
+STATIONS_FILENAME = "stations.parquet"
+DEFAULT_KEY = ["station", "time", "variable", "set"]  # a row is the same observation if these all match
+COMPRESSION = "zstd"
+
+
+# partition files are rewritten read-modify-write; two threads upserting into the same one would each drop the other's
+# rows, so every file gets a lock of its own
+_FILE_LOCKS = {}
+_FILE_LOCKS_LOCK = threading.Lock()
+
+
+def _file_lock(path):
+    key = os.path.abspath(path)
+    with _FILE_LOCKS_LOCK:
+        return _FILE_LOCKS.setdefault(key, threading.Lock())
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("columnar storage needs pyarrow; install it with 'pip install pyarrow'")
+
+
+def _partition_dir(base_dir, values):
+    return os.path.join(base_dir, *["{}={}".format(k, v) for k, v in values])
+
+
+def _write_atomic(table, path):
+    """
+    Writes a parquet file under a temporary name and renames it into place, so readers never see half a file
+    """
+    tmp_path = "{}.{}.{}.part".format(path, os.getpid(), threading.get_ident())  # unique per writer
+    pq.write_table(table, tmp_path, compression=COMPRESSION)
+    os.replace(tmp_path, path)
+
+
+def _to_table(df):
+    # categoricals (station IDs, variable names) are stored as parquet dictionary columns and come back as categoricals
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_partitioned(df, base_dir, partition_cols=("date",), key=DEFAULT_KEY):
+    """
+    Upserts a long-format observation table into a date-partitioned parquet store. Each partition touched by df is read
+    back, combined with the new rows, de-duplicated on key (newest wins) and rewritten, so pulling the same range
+    twice doesn't duplicate anything.
+    :param df: pandas DataFrame with at least a 'time' datetime64 column plus the columns in key
+    :param base_dir: string giving the full path of the store's base directory
+    :param partition_cols: tuple of partition columns. 'date' is derived from 'time'; anything else must be a column
+    :param key: list of columns identifying a unique observation
+    :return: paths, a list of strings giving the parquet files written
+    """
+    _require_pyarrow()
+    if len(df) == 0:
+        return []
+    os.makedirs(base_dir, exist_ok=True)
+
+    df = df.copy()
+    if "date" in partition_cols:
+        df["date"] = pd.to_datetime(df["time"]).dt.strftime("%Y-%m-%d")
+    partition_cols = list(partition_cols)
+    key = [k for k in key if k in df.columns and k not in partition_cols]
+
+    paths = []
+    for values, part in df.groupby(partition_cols, observed=True, sort=False):
+        values = values if isinstance(values, tuple) else (values,)
+        part_dir = _partition_dir(base_dir, zip(partition_cols, values))
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, PART_FILENAME)
+
+        part = part.drop(columns=partition_cols)
+        with _file_lock(path):
+            if os.path.exists(path):
+                existing = pq.read_table(path).to_pandas()
+                part = pd.concat([existing, part], ignore_index=True)
+                # concat of two categoricals with different categories falls back to object; put the dictionary back
+                for col in part.columns:
+                    if part[col].dtype == object and (isinstance(existing[col].dtype, pd.CategoricalDtype)):
+                        part[col] = part[col].astype("category")
+            if key:
+                part = part.drop_duplicates(subset=key, keep="last")
+            part = part.sort_values([k for k in ("station", "time") if k in part.columns], kind="stable")
+            _write_atomic(_to_table(part), path)
+        paths.append(path)
+    return paths
+
+
+def write_stations(stations_df, base_dir):
+    """
+    Upserts station metadata (one row per station, indexed by STID) into the store's station table
+    :param stations_df: pandas DataFrame indexed by STID, as returned by synoptic_decode.decode_stations()
+    :param base_dir: string giving the full path of the store's base directory
+    :return: path, string giving the parquet file written
+    """
+    _require_pyarrow()
+    os.makedirs(base_dir, exist_ok=True)
+    path = os.path.join(base_dir, STATIONS_FILENAME)
+    stations_df = stations_df.reset_index()
+    with _file_lock(path):
+        if os.path.exists(path):
+            existing = pq.read_table(path).to_pandas()
+            stations_df = pd.concat([existing, stations_df], ignore_index=True).drop_duplicates("STID", keep="last")
+        _write_atomic(pa.Table.from_pandas(stations_df, preserve_index=False), path)
+    return path
+
+
+def read_stations(base_dir):
+    """
+    :param base_dir: string giving the full path of the store's base directory
+    :return: pandas DataFrame of station metadata indexed by STID (empty if nothing has been written yet)
+    """
+    _require_pyarrow()
+    path = os.path.join(base_dir, STATIONS_FILENAME)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=["STID"]).set_index("STID")
+    return pq.read_table(path).to_pandas().set_index("STID")
+
+
+def _as_datetime(t):
+    if t is None or isinstance(t, datetime):
+        return t
+    return pd.Timestamp(t).to_pydatetime()
+
+
+def read_partitioned(base_dir, columns=None, start=None, end=None, variables=None, stations=None):
+    """
+    Reads a slice of a partitioned store. The date range and variable list prune whole partitions before any file is
+    opened; the time and station filters are pushed down to the parquet row groups; only the requested columns are
+    decoded.
+    :param base_dir: string giving the full path of the store's base directory
+    :param columns: optional list of columns to return. Defaults to every stored column
+    :param start: optional datetime (or anything pandas can parse) giving the earliest time to return
+    :param end: optional datetime (or anything pandas can parse) giving the latest time to return
+    :param variables: optional list of variable names to return
+    :param stations: optional list of station IDs to return
+    :return: pandas DataFrame of the matching rows
+    """
+    _require_pyarrow()
+    if not os.path.isdir(base_dir):
+        return pd.DataFrame(columns=columns)
+
+    dataset = ds.dataset(base_dir, format="parquet", partitioning="hive",
+                         exclude_invalid_files=True, ignore_prefixes=[".", "_", STATIONS_FILENAME])
+    start = _as_datetime(start)
+    end = _as_datetime(end)
+
+    expr = None
+
+    def both(a, b):
+        return b if a is None else a & b
+
+    names = dataset.schema.names
+    if start is not None:
+        if "date" in names:
+            expr = both(expr, ds.field("date") >= start.strftime("%Y-%m-%d"))
+        expr = both(expr, ds.field("time") >= pa.scalar(np.datetime64(start, "s")))
+    if end is not None:
+        if "date" in names:
+            expr = both(expr, ds.field("date") <= end.strftime("%Y-%m-%d"))
+        expr = both(expr, ds.field("time") <= pa.scalar(np.datetime64(end, "s")))
+    if variables is not None:
+        expr = both(expr, ds.field("variable").isin(list(variables)))
+    if stations is not None:
+        expr = both(expr, ds.field("station").isin(list(stations)))
+
+    if columns is None:
+        columns = [n for n in names if n != "date"]  # the date partition is just a copy of time
+    table = dataset.to_table(columns=list(columns), filter=expr)
+    return table.to_pandas()
@@ -0,0 +1,358 @@
+# Compact in-memory representation of station observations, for holding years of history on one machine.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Layout. Rows are sorted by (station, variable, set, time), so every series is one contiguous run of rows:
+#   stations   pandas DataFrame indexed by STID, one row per station; a station's ID is its row number
+#   variables  list of variable names; a variable's ID is its position
+#   sets       list of set names ('set_1', 'set_1d', ...); a set's ID is its position
+#   series     int32 (n_series, 3) array of (station ID, variable ID, set ID), one row per series
+#   offsets    int64 (n_series + 1) array; series i is rows offsets[i]:offsets[i + 1]
+#   time       int64 (n) array of seconds since 1970-01-01 UTC
+#   value      float32 (n) array, NaN where missing
+#   qc_bits    uint8 (ceil(n / 8)) array, the QC flags packed eight to a byte with np.packbits
+# That's a little over 12 bytes per observation, where a tidy DataFrame with categorical station/variable/set columns
+# takes about 16, and the arrays can be saved, memory-mapped and shared between processes as they are.
+#
+# On disk (save/load) the same arrays are .npy files in one directory, so load() can memory-map them:
+#   <path>/meta.json                          variables, sets, station table and row count
+#   <path>/{series,offsets,time,value,qc_bits}.npy
+
+import json
+import os
+import shutil
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+import synoptic_decode
+
+ARRAYS = ("series", "offsets", "time", "value", "qc_bits")
+STATION_FIELDS = ("NAME", "LATITUDE", "LONGITUDE", "ELEVATION")
+
+
+def _epoch_seconds(t):
+    return int(pd.Timestamp(t).value // 10 ** 9)
+
+
+def _station_table(stations_df, stids):
+    """
+    :return: station table holding every row of stations_df plus an empty row for each of stids it doesn't have
+    """
+    if stations_df is None:
+        stations_df = pd.DataFrame(columns=list(STATION_FIELDS), index=pd.Index([], name="STID"))
+    table = stations_df.reindex(columns=list(STATION_FIELDS))
+    missing = [s for s in stids if s not in table.index]
+    if missing:
+        table = pd.concat([table, pd.DataFrame(index=pd.Index(missing, name="STID"), columns=list(STATION_FIELDS))])
+    table.index.name = "STID"
+    for col, dtype in synoptic_decode.STATION_COLUMNS.items():
+        table[col] = pd.to_numeric(table[col], errors="coerce").astype(dtype)
+    return table
+
+
+def _codes(column, names):
+    """
+    Maps a column of names to positions in names, once per category rather than once per row
+    """
+    cat = column.astype("category")
+    position = {n: i for i, n in enumerate(names)}
+    lookup = np.array([position[str(c)] for c in cat.cat.categories], dtype=np.int32)
+    return lookup[cat.cat.codes.to_numpy()]
+
+
+class CompactObservations:
+    """
+    Station observations in a handful of contiguous NumPy arrays (see the layout at the top of this file). to_frame()
+    gives the same tidy table synoptic_decode.decode_observations() does, with the time and value columns viewing
+    these arrays rather than copying them, and lookup() gives one station's variable as array views with no copying
+    at all. Build one with from_frame(), from_response() or from_store(); combine several with concat().
+    """
+    def __init__(self, stations, variables, sets, series, offsets, time, value, qc_bits):
+        """
+        :param stations: pandas DataFrame indexed by STID with NAME, LATITUDE, LONGITUDE and ELEVATION columns
+        :param variables: list of variable names
+        :param sets: list of set names
+        :param series: int32 (n_series, 3) array of (station ID, variable ID, set ID)
+        :param offsets: int64 (n_series + 1) array of where each series starts, then the number of rows
+        :param time: int64 array of seconds since 1970-01-01 UTC
+        :param value: float32 array
+        :param qc_bits: uint8 array of QC flags packed with np.packbits
+        """
+        self.stations = stations
+        self.variables = list(variables)
+        self.sets = list(sets)
+        self.series = series
+        self.offsets = offsets
+        self.time = time
+        self.value = value
+        self.qc_bits = qc_bits
+        self._series_index = None  # (station ID, variable ID, set ID) -> series number, built on first use
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def nbytes(self):
+        """
+        :return: integer giving the bytes held by the arrays, leaving out the (small) station table
+        """
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    @property
+    def qc(self):
+        """
+        :return: bool array of the QC flags, True where a value was flagged. Unpacked, so this one is a copy
+        """
+        return np.unpackbits(self.qc_bits, count=len(self)).view(bool)
+
+    @property
+    def times(self):
+        """
+        :return: datetime64[s] view of the time array
+        """
+        return self.time.view("datetime64[s]")
+
+    def _row_codes(self):
+        """
+        :return: (station ID, variable ID, set ID) arrays with one entry per row
+        """
+        lengths = np.diff(self.offsets)
+        return tuple(np.repeat(self.series[:, i], lengths) for i in range(3))
+
+    @classmethod
+    def _build(cls, stations, variables, sets, station_id, variable_id, set_id, time, value, qc):
+        """
+        Sorts rows into series and packs them. Where the same (station, variable, set, time) appears more than once the
+        last one wins, as when re-ingesting into the observation store
+        """
+        order = np.lexsort((time, set_id, variable_id, station_id))  # stable, so repeats stay in input order
+        station_id, variable_id, set_id, time = station_id[order], variable_id[order], set_id[order], time[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = ((station_id[1:] != station_id[:-1]) | (variable_id[1:] != variable_id[:-1]) |
+                     (set_id[1:] != set_id[:-1]) | (time[1:] != time[:-1]))
+        order = order[last]
+        station_id, variable_id, set_id, time = station_id[last], variable_id[last], set_id[last], time[last]
+
+        starts = np.flatnonzero(np.concatenate([[True], (station_id[1:] != station_id[:-1]) |
+                                                (variable_id[1:] != variable_id[:-1]) |
+                                                (set_id[1:] != set_id[:-1])])) if len(time) else np.array([], int)
+        series = np.stack([station_id[starts], variable_id[starts], set_id[starts]], axis=1).astype(np.int32)
+        offsets = np.append(starts, len(time)).astype(np.int64)
+        return cls(stations, variables, sets, series.reshape(-1, 3), offsets,
+                   np.ascontiguousarray(time, dtype=np.int64),
+                   np.ascontiguousarray(value[order], dtype=np.float32),
+                   np.packbits(np.asarray(qc, dtype=bool)[order]))
+
+    @classmethod
+    def from_frame(cls, obs_df, stations_df=None):
+        """
+        :param obs_df: pandas DataFrame with station, time, variable, set, value and qc columns, as returned by
+                       synoptic_decode.decode_observations(), wile.query() or wile.read_synoptic()
+        :param stations_df: optional station metadata indexed by STID, as returned by synoptic_decode.decode_stations()
+        :return: CompactObservations
+        """
+        stids = [str(s) for s in obs_df["station"].astype("category").cat.categories]
+        stations = _station_table(stations_df, stids)
+        variables = [str(v) for v in obs_df["variable"].astype("category").cat.categories]
+        sets = [str(s) for s in obs_df["set"].astype("category").cat.categories]
+        return cls._build(stations, variables, sets,
+                          _codes(obs_df["station"], list(stations.index)),
+                          _codes(obs_df["variable"], variables),
+                          _codes(obs_df["set"], sets),
+                          obs_df["time"].to_numpy().astype("datetime64[s]").astype(np.int64),
+                          obs_df["value"].to_numpy(dtype=np.float32),
+                          obs_df["qc"].to_numpy(dtype=bool))
+
+    @classmethod
+    def from_response(cls, station_list, variables=None):
+        """
+        :param station_list: list of station dicts from a synoptic response's 'STATION' key
+        :param variables: optional collection of variable names or observation keys to keep
+        :return: CompactObservations
+        """
+        return cls.from_frame(synoptic_decode.decode_observations(station_list, variables=variables),
+                              synoptic_decode.decode_stations(station_list))
+
+    @classmethod
+    def from_store(cls, store, start=None, end=None, stations=None, variables=None, bbox=None, include_qc=True,
+                   chunk=timedelta(days=7)):
+        """
+        Reads observations out of an obs_store.ObservationStore a chunk of time at a time, so the tidy DataFrame the
+        store hands back never holds more than one chunk
+        :param store: obs_store.ObservationStore
+        :param start: optional datetime or string giving the earliest time to read (UTC). Defaults to the store's first
+        :param end: optional datetime or string giving the latest time to read (UTC). Defaults to the store's last
+        :param stations: optional list of station IDs
+        :param variables: optional list of variable names
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list giving the area to read stations from
+        :param include_qc: whether to keep values flagged for quality control
+        :param chunk: timedelta giving how much time to read from the store at once
+        :return: CompactObservations
+        """
+        lo, hi = store.time_range()
+        start = pd.Timestamp(lo if start is None else start).to_pydatetime().replace(tzinfo=None)
+        end = pd.Timestamp(hi if end is None else end).to_pydatetime().replace(tzinfo=None)
+        meta = store.stations()
+        blocks = []
+        t = start
+        while t <= end:
+            chunk_end = min(t + chunk - timedelta(seconds=1), end)
+            obs = store.query(stations=stations, variables=variables, start=t, end=chunk_end, bbox=bbox,
+                              include_qc=include_qc)
+            if len(obs):
+                blocks.append(cls.from_frame(obs, meta))
+            t = chunk_end + timedelta(seconds=1)
+        if not blocks:
+            return cls.from_frame(synoptic_decode.decode_observations([]), meta)
+        return cls.concat(blocks)
+
+    @classmethod
+    def concat(cls, blocks):
+        """
+        Combines several CompactObservations, e.g. one per month of a multi-year pull. Where two blocks hold the same
+        observation, the later block's wins; station metadata is merged field by field, so a block built without it
+        doesn't blank out what an earlier one knew
+        :param blocks: list of CompactObservations
+        :return: CompactObservations
+        """
+        stations = pd.concat([b.stations for b in blocks]).groupby(level=0, sort=False).last()
+        variables, sets = [], []
+        for b in blocks:
+            variables.extend(v for v in b.variables if v not in variables)
+            sets.extend(s for s in b.sets if s not in sets)
+        station_pos = {s: i for i, s in enumerate(stations.index)}
+
+        parts = []
+        for b in blocks:
+            station_id, variable_id, set_id = b._row_codes()
+            parts.append((np.array([station_pos[s] for s in b.stations.index], dtype=np.int32)[station_id],
+                          np.array([variables.index(v) for v in b.variables], dtype=np.int32)[variable_id],
+                          np.array([sets.index(s) for s in b.sets], dtype=np.int32)[set_id],
+                          b.time, b.value, b.qc))
+        return cls._build(stations, variables, sets, *[np.concatenate(columns) for columns in zip(*parts)])
+
+    def to_frame(self):
+        """
+        :return: pandas DataFrame with station, time, variable, set, value and qc columns, like
+                 synoptic_decode.decode_observations() returns, sorted by station, variable, set and time. time and
+                 value view this object's arrays; the categorical codes and qc are expanded per row
+        """
+        station_id, variable_id, set_id = self._row_codes()
+        return pd.DataFrame({"station": pd.Categorical.from_codes(station_id, categories=list(self.stations.index)),
+                             "time": self.times,
+                             "variable": pd.Categorical.from_codes(variable_id, categories=self.variables),
+                             "set": pd.Categorical.from_codes(set_id, categories=self.sets),
+                             "value": self.value,
+                             "qc": self.qc}, copy=False)
+
+    def series_table(self):
+        """
+        :return: pandas DataFrame with one row per series: station, variable, set, start (row) and n
+        """
+        return pd.DataFrame({"station": np.asarray(self.stations.index)[self.series[:, 0]],
+                             "variable": np.asarray(self.variables, dtype=object)[self.series[:, 1]],
+                             "set": np.asarray(self.sets, dtype=object)[self.series[:, 2]],
+                             "start": self.offsets[:-1],
+                             "n": np.diff(self.offsets)})
+
+    def series_slice(self, stid, variable, set_name=None):
+        """
+        :param stid: string giving the station ID
+        :param variable: string giving the variable name
+        :param set_name: optional string giving the set. Defaults to the station's first set of that variable
+        :return: slice of rows holding the series, or None if there's no such series
+        """
+        if self._series_index is None:
+            self._series_index = {tuple(row): i for i, row in enumerate(self.series.tolist())}
+        try:
+            station_id = self.stations.index.get_loc(stid)
+            variable_id = self.variables.index(variable)
+        except (KeyError, ValueError):
+            return None
+        if set_name is None:
+            candidates = sorted(range(len(self.sets)), key=lambda i: self.sets[i])  # set_1 before set_1d before set_2
+        elif set_name in self.sets:
+            candidates = [self.sets.index(set_name)]
+        else:
+            return None
+        for set_id in candidates:
+            i = self._series_index.get((station_id, variable_id, set_id))
+            if i is not None:
+                return slice(self.offsets[i], self.offsets[i + 1])
+        return None
+
+    def lookup(self, stid, variable, set_name=None):
+        """
+        :return: (times, values) tuple of views for one series, datetime64[s] and float32, sorted by time; or None if
+                 there's no such series. See series_slice() for the arguments
+        """
+        rows = self.series_slice(stid, variable, set_name)
+        if rows is None:
+            return None
+        return self.times[rows], self.value[rows]
+
+    def select(self, stations=None, variables=None, start=None, end=None, include_qc=True):
+        """
+        :param stations: optional list of station IDs
+        :param variables: optional list of variable names
+        :param start: optional datetime or string giving the earliest time to keep (UTC)
+        :param end: optional datetime or string giving the latest time to keep (UTC)
+        :param include_qc: whether to keep values flagged for quality control
+        :return: CompactObservations holding a copy of the matching rows
+        """
+        keep_series = np.ones(len(self.series), dtype=bool)
+        if stations is not None:
+            wanted = set(stations)
+            keep_series &= np.isin(self.series[:, 0], [i for i, s in enumerate(self.stations.index) if s in wanted])
+        if variables is not None:
+            keep_series &= np.isin(self.series[:, 1], [i for i, v in enumerate(self.variables) if v in variables])
+        keep = np.repeat(keep_series, np.diff(self.offsets))
+        if start is not None:
+            keep &= self.time >= _epoch_seconds(start)
+        if end is not None:
+            keep &= self.time <= _epoch_seconds(end)
+        qc = self.qc
+        if not include_qc:
+            keep &= ~qc
+        station_id, variable_id, set_id = self._row_codes()
+        return self._build(self.stations, self.variables, self.sets, station_id[keep], variable_id[keep],
+                           set_id[keep], self.time[keep], self.value[keep], qc[keep])
+
+    def save(self, path):
+        """
+        Writes the arrays to a directory, replacing whatever was there. Written alongside and renamed into place, so a
+        reader never sees a half-written copy
+        :param path: string giving the full path of the directory
+        """
+        tmp_path = path + ".part"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_path, name + ".npy"), getattr(self, name))
+        stations = self.stations.astype(object).where(self.stations.notna(), None)
+        meta = {"n": len(self), "variables": self.variables, "sets": self.sets,
+                "stations": {"STID": [str(s) for s in stations.index],
+                             **{col: stations[col].tolist() for col in STATION_FIELDS}}}
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        old_path = path + ".old"
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: string giving the full path of a directory written by save()
+        :param mmap_mode: passed to np.load. The default 'r' memory-maps the arrays read-only, so loading is instant
+                          and only the pages actually touched are read; None reads them into memory
+        :return: CompactObservations
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        stations = _station_table(pd.DataFrame(meta["stations"]).set_index("STID"), [])
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAYS}
+        return cls(stations, meta["variables"], meta["sets"], **arrays)
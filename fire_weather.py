@@ -0,0 +1,144 @@
+# Vectorized fire-weather indices. Every function takes whole arrays, such as (hours, stations) blocks from
+# gridding.hourly_matrix(), and works element-wise, so a decade of statewide history is a handful of array operations.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Inputs are in the units the synoptic pulls ask for ("metric,speed|kph"): temperatures in deg C, relative humidity in
+# percent, wind speed in km/h. NaN means missing; anything computed from a missing input comes out NaN rather than
+# raising or being silently filled.
+
+import numpy as np
+
+KPH_PER_MPH = 1.609344
+KPH_PER_MS = 3.6
+
+
+def _f(x):
+    return np.asarray(x, dtype=np.float32)
+
+
+def mask_qc(values, qc):
+    """
+    :param values: array of values
+    :param qc: boolean array the same shape, True where a value was flagged for quality control
+    :return: float32 copy of values with flagged entries set to NaN
+    """
+    return np.where(np.asarray(qc, dtype=bool), np.float32(np.nan), _f(values))
+
+
+def saturation_vapor_pressure(temp_c):
+    """
+    Bolton (1980)
+    :param temp_c: array of temperatures in deg C
+    :return: array of saturation vapor pressures in hPa
+    """
+    temp_c = _f(temp_c)
+    return np.float32(6.112) * np.exp(np.float32(17.67) * temp_c / (temp_c + np.float32(243.5)))
+
+
+def relative_humidity_from_dewpoint(temp_c, dewpoint_c):
+    """
+    :return: array of relative humidities in percent, capped at 100
+    """
+    return np.minimum(np.float32(100) * saturation_vapor_pressure(dewpoint_c) / saturation_vapor_pressure(temp_c),
+                      np.float32(100))
+
+
+def fill_relative_humidity(rh, temp_c, dewpoint_c):
+    """
+    Fills missing relative humidity from temperature and dewpoint where a station reported those instead
+    :return: float32 array of relative humidities in percent
+    """
+    rh = _f(rh)
+    return np.where(np.isnan(rh), relative_humidity_from_dewpoint(temp_c, dewpoint_c), rh)
+
+
+def dewpoint_depression(temp_c, dewpoint_c):
+    """
+    :return: array of temperature minus dewpoint, in deg C. Large depressions mean dry air
+    """
+    return _f(temp_c) - _f(dewpoint_c)
+
+
+def vapor_pressure_deficit(temp_c, rh):
+    """
+    :return: array of vapor pressure deficits in hPa
+    """
+    return saturation_vapor_pressure(temp_c) * (np.float32(1) - np.clip(_f(rh), 0, 100) / np.float32(100))
+
+
+def equilibrium_moisture_content(temp_c, rh):
+    """
+    Simard (1968) equilibrium moisture content of fine dead fuels, the moisture term of the Fosberg index
+    :param temp_c: array of temperatures in deg C
+    :param rh: array of relative humidities in percent
+    :return: array of moisture contents in percent of dry weight
+    """
+    temp_f = _f(temp_c) * np.float32(1.8) + np.float32(32)
+    h = np.clip(_f(rh), 0, 100)
+    low = np.float32(0.03229) + np.float32(0.281073) * h - np.float32(0.000578) * h * temp_f
+    mid = np.float32(2.22749) + np.float32(0.160107) * h - np.float32(0.01478) * temp_f
+    high = (np.float32(21.0606) + np.float32(0.005565) * h ** 2 - np.float32(0.00035) * h * temp_f
+            - np.float32(0.483199) * h)
+    return np.where(h < 10, low, np.where(h <= 50, mid, high))
+
+
+def fosberg_ffwi(temp_c, rh, wind_kph):
+    """
+    Fosberg Fire Weather Index (Fosberg 1978): 0 to about 100, higher meaning fire spreads more easily. Values above 50
+    are generally treated as significant.
+    :param temp_c: array of temperatures in deg C
+    :param rh: array of relative humidities in percent
+    :param wind_kph: array of wind speeds in km/h
+    :return: array of FFWI values
+    """
+    return _ffwi_from_emc(equilibrium_moisture_content(temp_c, rh), wind_kph)
+
+
+def _ffwi_from_emc(emc, wind_kph):
+    m = emc / np.float32(30)
+    eta = np.float32(1) - np.float32(2) * m + np.float32(1.5) * m ** 2 - np.float32(0.5) * m ** 3
+    eta = np.maximum(eta, 0)  # fuels wetter than the 30% extinction moisture don't burn
+    wind_mph = _f(wind_kph) / np.float32(KPH_PER_MPH)
+    return eta * np.sqrt(np.float32(1) + wind_mph ** 2) / np.float32(0.3002)
+
+
+def hot_dry_windy(temp_c, rh, wind_kph):
+    """
+    Hot-Dry-Windy index (Srock et al. 2018): wind speed in m/s times vapor pressure deficit in hPa. The published index
+    takes the maximum over the lowest 500 m of the atmosphere; from station data this is the surface value.
+    :return: array of HDW values
+    """
+    return _hdw_from_vpd(vapor_pressure_deficit(temp_c, rh), wind_kph)
+
+
+def _hdw_from_vpd(vpd, wind_kph):
+    return (_f(wind_kph) / np.float32(KPH_PER_MS)) * vpd
+
+
+def compute_indices(arrays):
+    """
+    Computes every index available from a set of same-shaped input arrays
+    :param arrays: dictionary of variable name -> array. Uses 'air_temp', 'relative_humidity', 'dew_point_temperature'
+                   and 'wind_speed' where present
+    :return: dictionary of index name -> float32 array: 'dewpoint_depression', 'vapor_pressure_deficit',
+             'equilibrium_moisture_content', 'fosberg_ffwi' and 'hot_dry_windy', as far as the inputs allow
+    """
+    out = {}
+    temp = arrays.get("air_temp")
+    dewpoint = arrays.get("dew_point_temperature")
+    rh = arrays.get("relative_humidity")
+    wind = arrays.get("wind_speed")
+    if temp is None:
+        return out
+    if dewpoint is not None:
+        out["dewpoint_depression"] = dewpoint_depression(temp, dewpoint)
+        rh = fill_relative_humidity(rh if rh is not None else np.full(np.shape(temp), np.nan), temp, dewpoint)
+    if rh is not None:
+        # the composite indices are built from these, so work them out once
+        out["vapor_pressure_deficit"] = vapor_pressure_deficit(temp, rh)
+        out["equilibrium_moisture_content"] = equilibrium_moisture_content(temp, rh)
+        if wind is not None:
+            out["fosberg_ffwi"] = _ffwi_from_emc(out["equilibrium_moisture_content"], wind)
+            out["hot_dry_windy"] = _hdw_from_vpd(out["vapor_pressure_deficit"], wind)
+    return out
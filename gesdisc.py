@@ -0,0 +1,485 @@
+# Helpers for pulling subsets from GES DISC (Earthdata), used by wile.pull_ldas_rt().
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from http.cookiejar import LoadError, MozillaCookieJar
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import NULL_METRICS
+
+DATA_ACCESS_HELP = 'https://disc.gsfc.nasa.gov/information/documents?title=Data%20Access'
+URS_HOST = 'urs.earthdata.nasa.gov'  # Earthdata login server every GES DISC data host redirects to
+SUBSET_URL = 'https://disc.gsfc.nasa.gov/service/subset/jsonwsp'  # GES DISC subset service endpoint
+RUNNING_STATUSES = ('Accepted', 'Running')
+
+
+class DownloadError(Exception):
+    """
+    Raised when a granule can't be downloaded after all retries
+    """
+    pass
+
+
+class SubsetJobError(Exception):
+    """
+    Raised when a GES DISC subset job can't be submitted, fails on the server, or its results can't be fetched.
+    Carries the request that produced it so the orchestrator (or the caller) can resubmit just that job.
+    """
+    def __init__(self, message, request=None, job_id=None):
+        super().__init__(message)
+        self.request = request
+        self.job_id = job_id
+
+
+def format_gesdisc_time(dt):
+    """
+    Formats a datetime the way the subset service wants it, e.g. '2015-08-01T00:00:00.000Z'
+    :param dt: datetime (UTC)
+    :return: string
+    """
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(dt.microsecond // 1000)
+
+
+def split_date_range(start_dt, end_dt, job_length):
+    """
+    Splits a date range into back-to-back, non-overlapping job ranges. Each range ends a millisecond before the next
+    one starts, the same way the subset service's own examples end a day at 23:59:59.999.
+    :param start_dt: datetime giving the start of the whole range
+    :param end_dt: datetime giving the end of the whole range
+    :param job_length: timedelta giving the length of each job
+    :return: ranges, a list of (start datetime, end datetime) tuples
+    """
+    ranges = []
+    job_start = start_dt
+    while job_start <= end_dt:
+        next_start = job_start + job_length
+        ranges.append((job_start, min(next_start - timedelta(milliseconds=1), end_dt)))
+        job_start = next_start
+    return ranges
+
+
+def build_subset_request(product, start_dt, end_dt, box, data):
+    """
+    Constructs a JSON WSP request for API method: subset
+    :param product: string giving the dataset ID, such as 'ML2T_004'
+    :param start_dt: datetime giving the start of the subset
+    :param end_dt: datetime giving the end of the subset
+    :param box: [minlon, minlat, maxlon, maxlat] list giving the area to crop to
+    :param data: list of {'variable': ..., 'slice': ...} dictionaries giving the variables (and dimension slices) to get
+    :return: dictionary giving the request
+    """
+    return {
+        'methodname': 'subset',
+        'type': 'jsonwsp/request',
+        'version': '1.0',
+        'args': {
+            'role': 'subset',
+            'start': format_gesdisc_time(start_dt),
+            'end': format_gesdisc_time(end_dt),
+            'box': list(box),
+            'crop': True,
+            'data': [dict(d, datasetId=product) for d in data]
+        }
+    }
+
+
+def jsonwsp_call(session, svcurl, request, metrics=NULL_METRICS):
+    """
+    POSTs a JSON WSP request to the subset service
+    :param session: requests Session to send it through
+    :param svcurl: string giving the service endpoint URL
+    :param request: dictionary giving the JSON WSP request
+    :param metrics: optional metrics.Metrics to time the call under request_seconds, labeled with its methodname
+    :return: dictionary giving the decoded response
+    """
+    try:
+        with metrics.timer("request_seconds", source="gesdisc", endpoint=request['methodname']):
+            r = session.post(svcurl, data=json.dumps(request), timeout=120,
+                             headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+        metrics.count("request_bytes_total", len(r.content), source="gesdisc", endpoint=request['methodname'])
+        r.raise_for_status()
+        response = r.json()
+    except (requests.RequestException, ValueError) as e:
+        raise SubsetJobError("{} call failed: {}".format(request['methodname'], e), request=request) from e
+    if response.get('type') == 'jsonwsp/fault':
+        raise SubsetJobError("API Error: faulty {} request: {}".format(request['methodname'], response.get('fault')),
+                             request=request)
+    return response
+
+
+def sort_results(results):
+    """
+    Sorts GES DISC GetResult items into documents and download URLs
+    :param results: list of items from GetResult responses
+    :return: docs and urls, lists of items linking to documentation or to granules, respectively
+    """
+    docs = []
+    urls = []
+    for item in results:
+        if item.get('start') and item.get('end'):
+            urls.append(item)
+        else:
+            docs.append(item)
+    return docs, urls
+
+
+def make_download_session(pool_size):
+    """
+    Creates a requests Session with a connection pool big enough for every download worker. requests picks up the
+    Earthdata login from ~/.netrc on its own, including across the URS redirect.
+    :param pool_size: integer giving the number of connections to keep open
+    :return: session, a requests.Session object
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class EarthdataSession(requests.Session):
+    """
+    One long-lived, authenticated session for everything we ask of GES DISC: jsonwsp subset calls and granule
+    downloads share its connection pool and its cookies. The cookie jar is persisted to disk (by default the same
+    ~/.urs_cookies file the .dodsrc points OPeNDAP clients at), so once a data host has issued its session cookie, later
+    requests -- including ones from a later run -- go straight to the data without the URS redirect/login round trip.
+    """
+    def __init__(self, login, password, cookie_path, pool_size=8):
+        """
+        :param login: string giving the Earthdata username
+        :param password: string giving the Earthdata password
+        :param cookie_path: string giving the full path of the Netscape-format cookie file to load and save
+        :param pool_size: integer giving the number of connections to keep open per host
+        """
+        super().__init__()
+        self.auth = (login, password)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+        self.cookie_path = cookie_path
+        self.cookies = MozillaCookieJar(cookie_path)
+        try:
+            self.cookies.load(ignore_discard=True, ignore_expires=True)
+        except (LoadError, OSError):
+            pass  # missing or blank jar (earthdata_setup_auth creates an empty one); start fresh
+        self._save_lock = threading.Lock()
+
+    def rebuild_auth(self, prepared_request, response):
+        """
+        requests drops the Authorization header whenever a redirect changes host. That's exactly what happens on the
+        data host -> URS hop, so keep the header when either end of the redirect is URS and drop it otherwise.
+        """
+        headers = prepared_request.headers
+        if "Authorization" in headers:
+            original = urlparse(response.request.url).hostname
+            redirect = urlparse(prepared_request.url).hostname
+            if original != redirect and URS_HOST not in (original, redirect):
+                del headers["Authorization"]
+
+    def save_cookies(self):
+        """
+        Writes the cookie jar back to disk so the next run starts warm
+        :return: none
+        """
+        with self._save_lock:
+            self.cookies.save(ignore_discard=True, ignore_expires=True)
+            if os.name != "nt":
+                os.chmod(self.cookie_path, 0o600)  # session cookies are as good as a password
+
+
+class GranuleDownloader:
+    """
+    Downloads GES DISC granules through a bounded pool of workers sharing one session. Each granule is streamed to a
+    '.part' file in fixed-size chunks and renamed into place once complete, so memory stays flat no matter how big the
+    granule is and a finished file is never half written. An interrupted '.part' file is resumed with a range request,
+    and a granule already on disk is skipped only when its size matches the server's Content-Length.
+    """
+    def __init__(self,
+                 dest_dir,
+                 session=None,
+                 max_workers=4,
+                 chunk_size=2 ** 20,  # bytes read from the socket and written to disk at a time
+                 max_retries=3,
+                 timeout=300,
+                 verify_size=True,  # whether to HEAD granules already on disk and re-download on a size mismatch
+                 logger=None,
+                 metrics=None):
+        self.dest_dir = dest_dir
+        self.session = session if session is not None else make_download_session(max_workers)
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.verify_size = verify_size
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self._lock = threading.Lock()
+        self.bytes_downloaded = 0
+        os.makedirs(dest_dir, exist_ok=True)
+
+    def _remote_size(self, url):
+        resp = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        size = resp.headers.get("Content-Length")
+        return int(size) if resp.ok and size is not None else None
+
+    def _is_complete(self, path, url):
+        if not os.path.exists(path):
+            return False
+        if not self.verify_size:
+            return True  # trust the name: files only get it after a full download
+        remote = self._remote_size(url)
+        return remote is None or remote == os.path.getsize(path)
+
+    def _stream(self, url, part_path):
+        """
+        Streams one URL into part_path, resuming from whatever is already there
+        :return: integer giving the number of bytes written this attempt
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as resp:
+            if resp.status_code == 416:  # range starts at/after the end: the .part file is already complete
+                return 0
+            resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                offset = 0  # server ignored the range request; start over
+            expected = resp.headers.get("Content-Length")
+            written = 0
+            with open(part_path, "ab" if offset else "wb") as f:
+                for block in resp.iter_content(chunk_size=self.chunk_size):
+                    f.write(block)
+                    written += len(block)
+            if expected is not None and written != int(expected):
+                raise requests.ConnectionError("short read: got {} of {} bytes".format(written, expected))
+        return written
+
+    def download(self, item):
+        """
+        Downloads one granule
+        :param item: dictionary from a GES DISC GetResult response with at least 'link' and 'label' keys
+        :return: path, string giving the full path of the downloaded (or already present) file
+        """
+        url = item['link']
+        path = os.path.join(self.dest_dir, item['label'])
+        if self._is_complete(path, url):
+            self.logger.debug("already have {}, skipping".format(item['label']))
+            return path
+
+        part_path = path + ".part"
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.metrics.timer("request_seconds", source="gesdisc", endpoint="granule"):
+                    written = self._stream(url, part_path)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.Timeout,
+                    requests.HTTPError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if (status is not None and status < 500 and status != 429) or attempt == self.max_retries:
+                    raise DownloadError("could not download {} ({})".format(url, e)) from e
+                self.metrics.count("retries_total", source="gesdisc")
+                time.sleep(2 ** attempt)
+        os.replace(part_path, path)
+        self.metrics.count("request_bytes_total", written, source="gesdisc", endpoint="granule")
+        with self._lock:
+            self.bytes_downloaded += written
+        return path
+
+    def download_all(self, items):
+        """
+        Downloads a batch of granules concurrently. A failure on one granule is logged and doesn't stop the others.
+        :param items: list of dictionaries from a GES DISC GetResult response with 'link' and 'label' keys
+        :return: (paths, failed) tuple; paths is a list of downloaded file paths and failed a list of items that
+                 couldn't be downloaded
+        """
+        paths = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.download, item): item for item in items}
+            for i, future in enumerate(as_completed(futures)):
+                self.metrics.gauge("queue_depth", len(futures) - i - 1, queue="gesdisc_granules")
+                item = futures[future]
+                try:
+                    paths.append(future.result())
+                    self.logger.info(item['label'])
+                except DownloadError as e:
+                    failed.append(item)
+                    self.logger.error("{}\nHelp for downloading data is at {}".format(e, DATA_ACCESS_HELP))
+        return paths, failed
+
+
+class SubsetOrchestrator:
+    """
+    Runs many subset jobs at once. Each job is submitted, polled, has its results paged in and its granules
+    downloaded on its own worker thread, so downloads for a finished job start straight away instead of waiting on the
+    slowest job. Polling backs off adaptively: it starts quick, then spaces out based on how fast PercentCompleted is
+    moving. A job that fails is resubmitted up to max_job_retries times before it's reported back as failed.
+    """
+    def __init__(self,
+                 session,
+                 downloader,
+                 svcurl=SUBSET_URL,
+                 max_jobs=4,  # subset jobs in flight at once
+                 poll_initial=2.0,  # seconds before the first status check
+                 poll_max=60.0,  # longest wait between status checks
+                 page_size=500,  # GetResult items per page
+                 max_job_retries=2,
+                 logger=None,
+                 metrics=None):
+        self.session = session
+        self.downloader = downloader
+        self.svcurl = svcurl
+        self.max_jobs = max_jobs
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.page_size = page_size
+        self.max_job_retries = max_job_retries
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+
+    def _next_poll(self, delay, elapsed, percent):
+        """
+        Picks the wait before the next status check: half the estimated time remaining, if progress gives us an
+        estimate, otherwise 1.5x the last wait; always between poll_initial and poll_max
+        """
+        if 0 < percent < 100:
+            remaining = elapsed * (100 - percent) / percent
+            delay = remaining / 2
+        else:
+            delay = delay * 1.5
+        return min(max(delay, self.poll_initial), self.poll_max)
+
+    def wait_for_job(self, job_id, request=None):
+        """
+        Polls GetStatus until a job leaves the Accepted/Running states
+        :param job_id: string giving the job ID
+        :param request: the subset request, attached to any error raised
+        :return: dictionary giving the final GetStatus result
+        """
+        status_request = {'methodname': 'GetStatus', 'version': '1.0', 'type': 'jsonwsp/request',
+                          'args': {'jobId': job_id}}
+        started = time.monotonic()
+        delay = self.poll_initial
+        while True:
+            time.sleep(delay)
+            result = jsonwsp_call(self.session, self.svcurl, status_request, self.metrics)['result']
+            percent = result.get('PercentCompleted', 0) or 0
+            self.logger.debug('Job {} status: {} ({}% complete)'.format(job_id, result['Status'], percent))
+            if result['Status'] not in RUNNING_STATUSES:
+                if result['Status'] != 'Succeeded':
+                    raise SubsetJobError('Job {} {}: {}'.format(job_id, result['Status'], result.get('message')),
+                                         request=request, job_id=job_id)
+                return result
+            delay = self._next_poll(delay, time.monotonic() - started, percent)
+
+    def get_results(self, job_id):
+        """
+        Pages in every GetResult item for a finished job. The first page tells us the total; the remaining pages are
+        then fetched in parallel.
+        :param job_id: string giving the job ID
+        :return: list of result items
+        """
+        def page(start_index):
+            request = {'methodname': 'GetResult', 'version': '1.0', 'type': 'jsonwsp/request',
+                       'args': {'jobId': job_id, 'count': self.page_size, 'startIndex': start_index}}
+            return jsonwsp_call(self.session, self.svcurl, request, self.metrics)['result']
+
+        first = page(0)
+        results = list(first['items'])
+        total = first['totalResults']
+        starts = list(range(first['itemsPerPage'] or self.page_size, total, self.page_size))
+        if starts:
+            with ThreadPoolExecutor(max_workers=min(4, len(starts))) as pool:
+                for page_result in pool.map(page, starts):  # map keeps the pages in order
+                    results.extend(page_result['items'])
+        self.logger.debug('Job {}: retrieved {} out of {} expected items'.format(job_id, len(results), total))
+        return results
+
+    def run_job(self, request):
+        """
+        Submits one subset job, waits for it, and downloads its granules
+        :param request: dictionary giving a subset request from build_subset_request()
+        :return: (docs, paths, failed) tuple of documentation items, downloaded file paths, and items that failed
+        """
+        try:
+            return self._run_job(request)
+        except SubsetJobError as e:
+            if e.request is request:
+                raise
+            # a GetStatus or GetResult call failed; the error has to carry the subset request so the job can be
+            # resubmitted, not the status/result request it came from
+            raise SubsetJobError(str(e), request=request, job_id=e.job_id) from e
+
+    def _run_job(self, request):
+        response = jsonwsp_call(self.session, self.svcurl, request, self.metrics)
+        job_id = response['result']['jobId']
+        self.logger.info('Job ID: {} ({} to {}), status: {}'.format(job_id, request['args']['start'],
+                                                                    request['args']['end'],
+                                                                    response['result']['Status']))
+        if response['result']['Status'] in RUNNING_STATUSES:
+            with self.metrics.timer("subset_job_seconds", source="gesdisc"):
+                result = self.wait_for_job(job_id, request)
+        else:
+            result = response['result']
+            if result['Status'] != 'Succeeded':
+                raise SubsetJobError('Job {} {}'.format(job_id, result['Status']), request=request, job_id=job_id)
+        self.logger.info('Job {} finished: {}'.format(job_id, result.get('message')))
+
+        docs, urls = sort_results(self.get_results(job_id))
+        paths, failed = self.downloader.download_all(urls)
+        return docs, paths, failed
+
+    def _run_with_retries(self, request):
+        for attempt in range(self.max_job_retries + 1):
+            try:
+                return self.run_job(request)
+            except SubsetJobError as e:
+                if attempt == self.max_job_retries:
+                    raise
+                self.metrics.count("retries_total", source="gesdisc_subset")
+                self.logger.warning('{}; resubmitting (attempt {} of {})'.format(e, attempt + 2,
+                                                                                self.max_job_retries + 1))
+
+    def run(self, subset_requests):
+        """
+        Runs a batch of subset jobs concurrently
+        :param subset_requests: list of subset request dictionaries
+        :return: (docs, paths, failed_jobs, failed_items) tuple: documentation items (de-duplicated), downloaded file
+                 paths, SubsetJobErrors for jobs that failed every attempt, and granule items that failed to download
+        """
+        docs = {}
+        paths = []
+        failed_jobs = []
+        failed_items = []
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as pool:
+            futures = {pool.submit(self._run_with_retries, request): request for request in subset_requests}
+            for i, future in enumerate(as_completed(futures)):
+                self.metrics.gauge("queue_depth", len(futures) - i - 1, queue="gesdisc_jobs")
+                try:
+                    job_docs, job_paths, job_failed = future.result()
+                except SubsetJobError as e:
+                    self.logger.error(str(e))
+                    failed_jobs.append(e)
+                    continue
+                except Exception as e:
+                    # anything else (a malformed result, say) fails this job, not the whole batch
+                    error = SubsetJobError("subset job failed: {!r}".format(e), request=futures[future])
+                    error.__cause__ = e
+                    self.logger.error(str(error))
+                    failed_jobs.append(error)
+                    continue
+                for item in job_docs:
+                    docs[item.get('link')] = item
+                paths.extend(job_paths)
+                failed_items.extend(job_failed)
+        return list(docs.values()), paths, failed_jobs, failed_items
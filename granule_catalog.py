@@ -0,0 +1,163 @@
+# Persistent catalog of downloaded satellite granules, so readers can find the files covering a time/area without
+# opening every one.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import json
+import os
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import mls_reader
+
+# MLS-Aura_L2GP-Temperature_v04-22-c01_2015d213.SUB.he5 -> product 'MLS-Aura_L2GP-Temperature'
+PRODUCT_PATTERN = re.compile(r"^(?P<product>.+?)_v\d")
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS granules ("
+    "path TEXT PRIMARY KEY, product TEXT NOT NULL, swath TEXT NOT NULL, "
+    "start_time INTEGER NOT NULL, end_time INTEGER NOT NULL, "  # seconds since 1970-01-01 UTC
+    "min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL, "
+    "variables TEXT NOT NULL, n_bytes INTEGER NOT NULL, mtime REAL NOT NULL, n_profiles INTEGER)",
+    "CREATE INDEX IF NOT EXISTS granules_time ON granules (product, start_time, end_time)",
+]
+
+
+def _epoch_seconds(t):
+    return int(pd.Timestamp(t).value // 10 ** 9)
+
+
+def product_from_filename(path):
+    """
+    :param path: string giving a granule path
+    :return: string giving the product part of the filename, or the filename without extension if it doesn't match
+    """
+    name = os.path.basename(path)
+    match = PRODUCT_PATTERN.match(name)
+    return match.group("product") if match else name.split(".")[0]
+
+
+def describe_granule(path):
+    """
+    Opens a granule once and works out everything the catalog keeps about it
+    :param path: string giving the full path of an HDF-EOS5 swath granule
+    :return: dictionary of catalog columns
+    """
+    mls_reader._require_h5py()
+    with mls_reader.h5py.File(path, "r") as f:
+        swath = sorted(f[mls_reader.SWATH_ROOT].keys())[0]
+        variables = sorted(f["{}/{}/Data Fields".format(mls_reader.SWATH_ROOT, swath)].keys())
+
+    with mls_reader.MLSGranule(path, swath=swath) as granule:
+        geo = granule.read(fields=())
+    times = geo["time"].astype("datetime64[s]").astype(np.int64)
+    lat = geo["latitude"][np.isfinite(geo["latitude"]) & (geo["latitude"] >= -90)]
+    lon = geo["longitude"][np.isfinite(geo["longitude"]) & (geo["longitude"] >= -180)]
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path),
+            "product": product_from_filename(path),
+            "swath": swath,
+            "start_time": int(times.min()) if times.size else 0,
+            "end_time": int(times.max()) if times.size else 0,
+            "min_lon": float(lon.min()) if lon.size else None,
+            "min_lat": float(lat.min()) if lat.size else None,
+            "max_lon": float(lon.max()) if lon.size else None,
+            "max_lat": float(lat.max()) if lat.size else None,
+            "variables": json.dumps(variables),
+            "n_bytes": stat.st_size,
+            "mtime": stat.st_mtime,
+            "n_profiles": int(times.size)}
+
+
+class GranuleCatalog:
+    """
+    SQLite index of every granule we've got on disk: product, swath, time span, bounding box, variables and size,
+    recorded once at ingest. "Which granules intersect this (bbox, time range)?" is then answered from the index alone.
+    """
+    def __init__(self, db_path):
+        """
+        :param db_path: string giving the full path of the SQLite file; it's created if it doesn't exist
+        """
+        self.db_path = db_path
+        with self._connect() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def ingest(self, paths):
+        """
+        Adds granules to the catalog. A granule already cataloged with the same size and modification time is skipped
+        without being opened, so calling this on a whole directory after every pull is cheap.
+        :param paths: list of strings giving granule paths
+        :return: integer giving the number of granules (re)cataloged
+        """
+        with self._connect() as conn:
+            known = dict(((p, (n, m)) for p, n, m in conn.execute("SELECT path, n_bytes, mtime FROM granules")))
+        rows = []
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_size, stat.st_mtime):
+                continue
+            rows.append(describe_granule(path))
+        if rows:
+            columns = list(rows[0])
+            with self._connect() as conn:
+                conn.executemany("INSERT OR REPLACE INTO granules ({}) VALUES ({})".format(
+                    ", ".join(columns), ", ".join("?" * len(columns))), [tuple(r[c] for c in columns) for r in rows])
+        return len(rows)
+
+    def prune(self):
+        """
+        Drops catalog entries whose files no longer exist
+        :return: integer giving the number of entries removed
+        """
+        with self._connect() as conn:
+            gone = [(p,) for (p,) in conn.execute("SELECT path FROM granules") if not os.path.exists(p)]
+            conn.executemany("DELETE FROM granules WHERE path = ?", gone)
+        return len(gone)
+
+    def find(self, bbox=None, start=None, end=None, product=None):
+        """
+        Finds the granules that intersect a bounding box and time range
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list
+        :param start: optional datetime or string giving the start of the time range (UTC)
+        :param end: optional datetime or string giving the end of the time range (UTC)
+        :param product: optional string giving the product, such as 'MLS-Aura_L2GP-Temperature'
+        :return: list of granule paths, in time order
+        """
+        where = []
+        params = []
+        if product is not None:
+            where.append("product = ?")
+            params.append(product)
+        if start is not None:
+            where.append("end_time >= ?")
+            params.append(_epoch_seconds(start))
+        if end is not None:
+            where.append("start_time <= ?")
+            params.append(_epoch_seconds(end))
+        if bbox is not None:
+            minlon, minlat, maxlon, maxlat = bbox
+            where.append("max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?")
+            params.extend([minlon, maxlon, minlat, maxlat])
+        sql = "SELECT path FROM granules"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._connect() as conn:
+            return [p for (p,) in conn.execute(sql + " ORDER BY start_time", params)]
+
+    def entries(self):
+        """
+        :return: pandas DataFrame of the whole catalog
+        """
+        with self._connect() as conn:
+            df = pd.read_sql_query("SELECT * FROM granules ORDER BY product, start_time", conn)
+        for col in ("start_time", "end_time"):
+            df[col] = pd.to_datetime(df[col], unit="s")
+        return df
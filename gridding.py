@@ -0,0 +1,278 @@
+# Rasterizes station observations and satellite retrievals onto one fixed lat/lon grid, one file per hour.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Layout under a base directory (DATA_DERIVED_DIR/grid):
+#   <base>/<source>/grid.json                 the grid the files below were made on
+#   <base>/<source>/2024/07/2024070113.npz    one hour; one float32 (..., ny, nx) array per variable
+
+import json
+import os
+import threading
+
+import numpy as np
+
+import colocation
+
+CA_BBOX = (-124.5, 32.5, -114.0, 42.1)  # [minlon, minlat, maxlon, maxlat] covering all of California
+HOUR_FILE_FORMAT = "%Y%m%d%H"
+
+
+class GridSpec:
+    """
+    A regular lat/lon grid. Cells are res degrees square; cell (0, 0) is the south-west corner.
+    """
+    def __init__(self, bbox=CA_BBOX, res=0.1):
+        """
+        :param bbox: [minlon, minlat, maxlon, maxlat] list giving the area covered
+        :param res: float giving the cell size in degrees
+        """
+        self.minlon, self.minlat, self.maxlon, self.maxlat = [float(b) for b in bbox]
+        self.res = float(res)
+        self.nx = int(np.ceil(round((self.maxlon - self.minlon) / self.res, 6)))
+        self.ny = int(np.ceil(round((self.maxlat - self.minlat) / self.res, 6)))
+
+    @property
+    def shape(self):
+        return self.ny, self.nx
+
+    @property
+    def lon(self):
+        """
+        :return: array of cell-center longitudes, length nx
+        """
+        return self.minlon + (np.arange(self.nx) + 0.5) * self.res
+
+    @property
+    def lat(self):
+        """
+        :return: array of cell-center latitudes, length ny
+        """
+        return self.minlat + (np.arange(self.ny) + 0.5) * self.res
+
+    def centers(self):
+        """
+        :return: (lat, lon) arrays of every cell center, flattened in row-major (ny, nx) order
+        """
+        lat, lon = np.meshgrid(self.lat, self.lon, indexing="ij")
+        return lat.ravel(), lon.ravel()
+
+    def cell_index(self, lat, lon):
+        """
+        :return: integer array giving the flat cell index of each point, or -1 for points off the grid
+        """
+        row = np.floor((np.asarray(lat, dtype=np.float64) - self.minlat) / self.res)
+        col = np.floor((np.asarray(lon, dtype=np.float64) - self.minlon) / self.res)
+        ok = (row >= 0) & (row < self.ny) & (col >= 0) & (col < self.nx)
+        return np.where(ok, row * self.nx + col, -1).astype(np.int64)
+
+    def to_dict(self):
+        return {"bbox": [self.minlon, self.minlat, self.maxlon, self.maxlat], "res": self.res}
+
+    def __eq__(self, other):
+        return isinstance(other, GridSpec) and self.to_dict() == other.to_dict()
+
+
+def bin_mean(grid, lat, lon, values):
+    """
+    Averages every point falling in a cell, with one scatter-add over all points (and all trailing dimensions, such as
+    levels) at once. NaN values are left out of the average.
+    :param grid: GridSpec
+    :param lat: array of point latitudes
+    :param lon: array of point longitudes
+    :param values: array shaped (n_points, ...) of values to grid
+    :return: float32 array shaped (..., ny, nx); NaN where a cell has no valid points
+    """
+    values = np.asarray(values, dtype=np.float64)
+    trailing = values.shape[1:]
+    cells = grid.cell_index(lat, lon)
+    on_grid = cells >= 0
+    cells = cells[on_grid]
+    values = values[on_grid].reshape(len(cells), -1)  # (points, everything else)
+    n_cells = grid.ny * grid.nx
+    valid = np.isfinite(values)
+    # offset each trailing column by n_cells so one bincount handles every column
+    flat = (cells[:, None] + n_cells * np.arange(values.shape[1])[None, :])[valid]
+    total = np.bincount(flat, weights=values[valid], minlength=n_cells * values.shape[1])
+    count = np.bincount(flat, minlength=n_cells * values.shape[1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+    return mean.astype(np.float32).reshape(trailing + grid.shape)
+
+
+class IDWInterpolator:
+    """
+    Inverse-distance weighting from a fixed station set onto a grid. The (cell, station, weight) table is worked out
+    once per station set; gridding a time step is then one gather, one multiply and one segmented sum, and a whole
+    block of time steps is gridded in the same pass.
+    """
+    def __init__(self, grid, stids, lat, lon, radius_km=50, power=2):
+        """
+        :param grid: GridSpec
+        :param stids: sequence of station IDs; value arrays passed to interpolate() are in this order
+        :param lat: array of station latitudes in degrees
+        :param lon: array of station longitudes in degrees
+        :param radius_km: float giving how far a station reaches; cells with no station in reach are NaN
+        :param power: float giving the distance exponent
+        """
+        self.grid = grid
+        self.radius_km = radius_km
+        self.power = power
+        index = colocation.get_station_index(stids, lat, lon)
+        self.fingerprint = index.fingerprint
+        self.n_stations = len(index)
+        cell_lat, cell_lon = grid.centers()
+        # pairs come back sorted by cell, which is what the segmented sum below needs
+        self._cell, self._station, dist = index.query_radius(cell_lat, cell_lon, radius_km)
+        self._weight = 1.0 / np.maximum(dist, 0.1) ** power  # a station sitting on a cell center doesn't blow up
+        self._starts = np.flatnonzero(np.r_[True, self._cell[1:] != self._cell[:-1]]) if self._cell.size else \
+            np.empty(0, dtype=np.int64)
+
+    def interpolate(self, values):
+        """
+        :param values: array shaped (..., n_stations), such as (hours, stations); NaN marks a missing value
+        :return: float32 array shaped (..., ny, nx). A cell is NaN when no station in reach has a value
+        """
+        values = np.asarray(values, dtype=np.float64)
+        lead = values.shape[:-1]
+        values = values.reshape(-1, self.n_stations)
+        out = np.full((values.shape[0], self.grid.ny * self.grid.nx), np.nan, dtype=np.float32)
+        if self._cell.size == 0:
+            return out.reshape(lead + self.grid.shape)
+        v = values[:, self._station]  # (steps, pairs)
+        valid = np.isfinite(v)
+        w = np.where(valid, self._weight, 0.0)
+        num = np.add.reduceat(np.where(valid, v, 0.0) * w, self._starts, axis=1)
+        den = np.add.reduceat(w, self._starts, axis=1)
+        cells = self._cell[self._starts]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[:, cells] = np.where(den > 0, num / den, np.nan)
+        return out.reshape(lead + self.grid.shape)
+
+
+def hourly_matrix(obs_df, stids, variables):
+    """
+    Turns a tidy observation table into one (hours, stations) array per variable, averaging everything a station
+    reported in each hour (over sets and times). QC-flagged values are left out.
+    :param obs_df: pandas DataFrame with station, time, variable, value and qc columns
+    :param stids: sequence of station IDs giving the column order
+    :param variables: list of variable names to return
+    :return: (hours, dictionary of variable -> float32 (hours, stations) array) tuple; hours is a sorted
+             datetime64[h] array
+    """
+    obs = obs_df[~obs_df["qc"].to_numpy(dtype=bool)]
+    hour = obs["time"].to_numpy().astype("datetime64[h]")
+    hours, hour_idx = np.unique(hour, return_inverse=True)
+    hour_idx = hour_idx.ravel()
+
+    # map station and variable names through their categories rather than row by row
+    station_cat = obs["station"].astype("category")
+    station_pos = {s: i for i, s in enumerate(stids)}
+    station_lookup = np.array([station_pos.get(str(s), -1) for s in station_cat.cat.categories] + [-1], dtype=np.int64)
+    station_idx = station_lookup[station_cat.cat.codes.to_numpy()]  # code -1 (missing) lands on the trailing -1
+    variable_cat = obs["variable"].astype("category")
+    variable_codes = variable_cat.cat.codes.to_numpy()
+    variable_names = [str(c) for c in variable_cat.cat.categories]
+    value = obs["value"].to_numpy(dtype=np.float64)
+    n = len(hours) * len(stids)
+
+    out = {}
+    for name in variables:
+        code = variable_names.index(name) if name in variable_names else -2
+        keep = (variable_codes == code) & (station_idx >= 0) & np.isfinite(value)
+        flat = hour_idx[keep] * len(stids) + station_idx[keep]
+        total = np.bincount(flat, weights=value[keep], minlength=n)
+        count = np.bincount(flat, minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[name] = np.where(count > 0, total / count, np.nan).astype(np.float32).reshape(len(hours), len(stids))
+    return hours, out
+
+
+class GridStore:
+    """
+    Gridded time steps on disk: one compressed .npz per (source, hour), written atomically so a reader never sees half
+    a file and a re-grid of one hour just replaces that hour's file.
+    """
+    def __init__(self, base_dir, grid):
+        """
+        :param base_dir: string giving the full path of the store's base directory
+        :param grid: GridSpec every file in the store is on
+        """
+        self.base_dir = base_dir
+        self.grid = grid
+
+    def _source_dir(self, source):
+        source_dir = os.path.join(self.base_dir, source)
+        os.makedirs(source_dir, exist_ok=True)
+        spec_path = os.path.join(source_dir, "grid.json")
+        if os.path.exists(spec_path):
+            with open(spec_path) as f:
+                on_disk = json.load(f)
+            if on_disk != self.grid.to_dict():
+                raise ValueError("{} holds grids made on {}, not {}".format(source_dir, on_disk, self.grid.to_dict()))
+        else:
+            # written under a name of its own and renamed, so another thread setting up the same source never reads
+            # half of it
+            tmp_path = "{}.{}.{}.tmp".format(spec_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, "w") as f:
+                json.dump(self.grid.to_dict(), f)
+            os.replace(tmp_path, spec_path)
+        return source_dir
+
+    def path(self, source, hour):
+        """
+        :param source: string giving the data source, such as 'synoptic' or 'mls'
+        :param hour: numpy datetime64 or datetime giving the hour
+        :return: string giving the full path of that hour's file
+        """
+        stamp = np.datetime64(hour, "h").astype(object).strftime(HOUR_FILE_FORMAT)
+        return os.path.join(self.base_dir, source, stamp[:4], stamp[4:6], stamp + ".npz")
+
+    def write(self, source, hour, arrays):
+        """
+        :param arrays: dictionary of name -> array, each shaped (..., ny, nx)
+        :return: string giving the path written
+        """
+        self._source_dir(source)
+        path = self.path(source, hour)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.{}.part".format(path, os.getpid(), threading.get_ident())  # unique per writer
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+        return path
+
+    def read(self, source, hour):
+        """
+        :return: dictionary of name -> array for that hour, or None if it hasn't been gridded
+        """
+        path = self.path(source, hour)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            return dict(f)
+
+    def remove(self, source, hours):
+        """
+        Deletes the files of some hours, skipping any that aren't there
+        :param hours: list/array of hours (datetime64 or datetime)
+        :return: integer giving the number of files deleted
+        """
+        n = 0
+        for hour in np.asarray(hours).astype("datetime64[h]"):
+            try:
+                os.remove(self.path(source, hour))
+                n += 1
+            except FileNotFoundError:
+                pass
+        return n
+
+    def hours(self, source):
+        """
+        :return: sorted datetime64[h] array of every hour gridded for a source
+        """
+        stamps = []
+        for root, _, files in os.walk(os.path.join(self.base_dir, source)):
+            stamps.extend(f[:-4] for f in files if f.endswith(".npz"))
+        return np.array(sorted("{}-{}-{}T{}".format(s[:4], s[4:6], s[6:8], s[8:10]) for s in stamps),
+                        dtype="datetime64[h]")
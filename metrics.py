@@ -0,0 +1,218 @@
+# Lightweight performance metrics for the pull/parse/write paths: request latency, bytes, rows, parse and write
+# times, retries and queue depths, exported as JSON lines and/or a Prometheus text file.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Every instrumented class takes an optional metrics argument and falls back to NULL_METRICS, whose methods do
+# nothing, so instrumentation costs a method call and nothing more unless metrics are switched on.
+#
+# Files written under the output directory:
+#   metrics_YYYY-MM-DD.jsonl   one JSON object per event: {"ts", "metric", "kind", "value", <labels>}
+#   wile.prom                  running totals in the Prometheus text format, rewritten on every flush, for the
+#                              node_exporter textfile collector or anything else that scrapes a file
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+PROM_FILENAME = "wile.prom"
+JSONL_FORMAT = "metrics_%Y-%m-%d.jsonl"
+FORMATS = ("jsonl", "prometheus")
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullMetrics:
+    """
+    Stands in for Metrics when metrics are off. Every method is a no-op
+    """
+    enabled = False
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return _NULL_TIMER
+
+    def flush(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.seconds = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._started
+        self.metrics.observe(self.name, self.seconds, **self.labels)
+        return False
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for k, v in labels) + "}"
+
+
+class Metrics:
+    """
+    Collects metrics from any number of threads. Three kinds:
+    counters (count) only go up, e.g. bytes transferred or retries;
+    observations (observe, timer) are individual measurements such as one request's latency, summarized as count, sum
+    and max;
+    gauges (gauge) are a current level, such as the number of requests in flight.
+    Events are buffered in memory and written out by flush(), or once flush_every events have piled up.
+    """
+    enabled = True
+
+    def __init__(self, out_dir, formats=FORMATS, prefix="wile", flush_every=1000):
+        """
+        :param out_dir: string giving the directory to write metrics files in
+        :param formats: tuple of 'jsonl' and/or 'prometheus'
+        :param prefix: string put in front of every metric name in the Prometheus file
+        :param flush_every: integer giving the number of buffered JSON-lines events that triggers a flush
+        """
+        for fmt in formats:
+            if fmt not in FORMATS:
+                raise ValueError("unknown metrics format {!r}; expected some of {}".format(fmt, FORMATS))
+        self.out_dir = out_dir
+        self.formats = tuple(formats)
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._events = []  # JSON-lines events not yet written
+        self._counters = {}  # (name, labels) -> total
+        self._summaries = {}  # (name, labels) -> [count, sum, max]
+        self._gauges = {}  # (name, labels) -> last value
+        self._dirty = False  # whether anything was recorded since the last flush
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _record(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._dirty = True
+            if kind == "counter":
+                self._counters[key] = self._counters.get(key, 0) + value
+            elif kind == "summary":
+                summary = self._summaries.get(key)
+                if summary is None:
+                    self._summaries[key] = [1, value, value]
+                else:
+                    summary[0] += 1
+                    summary[1] += value
+                    summary[2] = max(summary[2], value)
+            else:
+                self._gauges[key] = value
+            if "jsonl" in self.formats:
+                self._events.append(dict(labels, ts=time.time(), metric=name, kind=kind, value=value))
+                full = len(self._events) >= self.flush_every
+            else:
+                full = False
+        if full:
+            self.flush()
+
+    def count(self, name, value=1, **labels):
+        """
+        Adds to a counter
+        """
+        self._record("counter", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Records one measurement
+        """
+        self._record("summary", name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        """
+        Sets a gauge to its current level
+        """
+        self._record("gauge", name, value, labels)
+
+    def timer(self, name, **labels):
+        """
+        :return: context manager that observes how many seconds its block took under name. The duration is also left
+                 on its seconds attribute
+        """
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """
+        :return: dictionary of 'counters', 'summaries' and 'gauges', each mapping (name, labels tuple) to its value(s)
+        """
+        with self._lock:
+            return {"counters": dict(self._counters),
+                    "summaries": {k: tuple(v) for k, v in self._summaries.items()},
+                    "gauges": dict(self._gauges)}
+
+    def flush(self):
+        """
+        Appends buffered events to today's JSON-lines file and rewrites the Prometheus file. Does nothing if nothing
+        was recorded since the last flush
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            events, self._events = self._events, []
+            if events:
+                path = os.path.join(self.out_dir, datetime.utcnow().strftime(JSONL_FORMAT))
+                with open(path, "a") as f:
+                    f.writelines(json.dumps(event, default=str) + "\n" for event in events)
+            if "prometheus" in self.formats:
+                self._write_prometheus()
+
+    def _write_prometheus(self):
+        lines = []
+        for kind, table in (("counter", self._counters), ("gauge", self._gauges)):
+            for name in sorted({k[0] for k in table}):
+                metric = "{}_{}".format(self.prefix, name)
+                lines.append("# TYPE {} {}".format(metric, kind))
+                for (n, labels), value in sorted(table.items()):
+                    if n == name:
+                        lines.append("{}{} {}".format(metric, _prom_labels(labels), repr(float(value))))
+        for name in sorted({k[0] for k in self._summaries}):
+            metric = "{}_{}".format(self.prefix, name)
+            lines.append("# TYPE {} summary".format(metric))
+            for (n, labels), (n_obs, total, peak) in sorted(self._summaries.items()):
+                if n == name:
+                    lines.append("{}_count{} {}".format(metric, _prom_labels(labels), n_obs))
+                    lines.append("{}_sum{} {}".format(metric, _prom_labels(labels), repr(float(total))))
+            lines.append("# TYPE {}_max gauge".format(metric))
+            for (n, labels), (n_obs, total, peak) in sorted(self._summaries.items()):
+                if n == name:
+                    lines.append("{}_max{} {}".format(metric, _prom_labels(labels), repr(float(peak))))
+        # renamed into place, so a scraper never reads half a file
+        path = os.path.join(self.out_dir, PROM_FILENAME)
+        tmp_path = "{}.{}.{}.part".format(path, os.getpid(), threading.get_ident())  # unique per writer
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
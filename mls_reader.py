@@ -0,0 +1,260 @@
+# Lazy reader for MLS L2GP (.he5) granules, such as the MLS-Aura_L2GP-Temperature_*.he5 subsets pulled from GES DISC.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Nothing is read from a granule until it's sliced. Uncompressed, contiguous datasets are memory-mapped straight from
+# the file; chunked/compressed ones (which is what GES DISC subsets are) are left as h5py datasets so slicing only
+# decompresses the chunks that overlap the slice.
+
+import glob
+import os
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:  # h5py is only needed once a granule is actually opened
+    h5py = None
+
+SWATH_ROOT = "/HDFEOS/SWATHS"
+TAI93_EPOCH = np.datetime64("1993-01-01T00:00:00", "s")  # MLS Time is seconds since this (TAI, so a few leap
+                                                         # seconds ahead of UTC)
+
+# the subset service asks for .../Data Fields/Temperature and .../TemperaturePrecision, but the granules themselves use
+# the generic L2GP names, so look for either
+FIELD_ALIASES = {
+    "value": ("Data Fields/L2gpValue", "Data Fields/{swath}"),
+    "precision": ("Data Fields/L2gpPrecision", "Data Fields/{swath}Precision"),
+    "quality": ("Data Fields/Quality",),
+    "status": ("Data Fields/Status",),
+    "convergence": ("Data Fields/Convergence",),
+    "latitude": ("Geolocation Fields/Latitude",),
+    "longitude": ("Geolocation Fields/Longitude",),
+    "time": ("Geolocation Fields/Time",),
+    "pressure": ("Geolocation Fields/Pressure",),
+}
+
+
+def _require_h5py():
+    if h5py is None:
+        raise ImportError("reading MLS granules needs h5py; install it with 'pip install h5py'")
+
+
+def _runs(mask):
+    """
+    :return: list of (start, stop) index pairs, one per run of consecutive True entries in a 1-D mask
+    """
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+
+class MLSGranule:
+    """
+    One MLS L2GP granule, opened lazily. Every field is exposed as an array-like that only reads what it's sliced
+    with; read() pulls out a level/lat-lon window as plain NumPy arrays.
+    """
+    def __init__(self, path, swath="Temperature"):
+        """
+        :param path: string giving the full path of the .he5 file
+        :param swath: string giving the swath name under /HDFEOS/SWATHS
+        """
+        _require_h5py()
+        self.path = path
+        self.swath = swath
+        self._file = None
+        self._fields = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Closes the underlying file; any memory-mapped arrays handed out stay valid
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._fields = {}
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = h5py.File(self.path, "r")
+        return self._file
+
+    def _dataset(self, name):
+        group = self.file["{}/{}".format(SWATH_ROOT, self.swath)]
+        for candidate in FIELD_ALIASES[name]:
+            candidate = candidate.format(swath=self.swath)
+            if candidate in group:
+                return group[candidate]
+        raise KeyError("{} has no {} field in swath {}".format(self.path, name, self.swath))
+
+    def field(self, name):
+        """
+        Returns a lazy handle on one field: a read-only np.memmap if the dataset is stored contiguously and
+        uncompressed, otherwise the h5py Dataset itself. Either way nothing is read until it's sliced.
+        :param name: one of 'value', 'precision', 'quality', 'status', 'convergence', 'latitude', 'longitude', 'time',
+                     'pressure'
+        :return: array-like
+        """
+        if name not in self._fields:
+            ds = self._dataset(name)
+            offset = ds.id.get_offset() if ds.chunks is None and ds.compression is None else None
+            if offset is not None:
+                self._fields[name] = np.memmap(self.path, dtype=ds.dtype, mode="r", offset=offset, shape=ds.shape)
+            else:
+                self._fields[name] = ds
+        return self._fields[name]
+
+    # the fields the subset request asks for, under the names GES DISC uses for them
+    @property
+    def temperature(self):
+        return self.field("value")
+
+    @property
+    def temperature_precision(self):
+        return self.field("precision")
+
+    @property
+    def quality(self):
+        return self.field("quality")
+
+    @property
+    def latitude(self):
+        return self.field("latitude")
+
+    @property
+    def longitude(self):
+        return self.field("longitude")
+
+    @property
+    def pressure(self):
+        return self.field("pressure")
+
+    @property
+    def n_profiles(self):
+        return self._dataset("latitude").shape[0]
+
+    def fill_value(self, name):
+        """
+        :return: the fill value for a field, or None if it doesn't declare one
+        """
+        attrs = self._dataset(name).attrs
+        for key in ("_FillValue", "MissingValue"):
+            if key in attrs:
+                return np.asarray(attrs[key]).ravel()[0]
+        return None
+
+    def times(self, profiles=slice(None)):
+        """
+        :param profiles: slice or index array of profiles
+        :return: datetime64[ms] array of profile times
+        """
+        seconds = np.asarray(self.field("time")[profiles], dtype=np.float64)
+        return TAI93_EPOCH + (seconds * 1000).astype("timedelta64[ms]")
+
+    def level_indices(self, levels=None, pressure_range=None):
+        """
+        Works out which nLevels indices to read
+        :param levels: optional slice, integer, or list of level indices
+        :param pressure_range: optional (min hPa, max hPa) tuple; only levels inside it are kept
+        :return: slice or sorted integer array usable as the second index of value/precision
+        """
+        if pressure_range is None:
+            if levels is None:
+                return slice(None)
+            if isinstance(levels, slice):
+                return levels
+            if isinstance(levels, (int, np.integer)):
+                return slice(int(levels), int(levels) + 1)  # keep the level axis so shapes don't change
+            return np.unique(np.asarray(levels, dtype=np.int64))  # h5py wants index lists sorted, without repeats
+        pressure = np.asarray(self.field("pressure")[:])
+        keep = (pressure >= pressure_range[0]) & (pressure <= pressure_range[1])
+        if levels is not None:
+            within = np.zeros_like(keep)
+            within[levels] = True
+            keep &= within
+        return np.flatnonzero(keep)
+
+    def read(self, levels=None, pressure_range=None, bbox=None, fields=("value", "precision", "quality"),
+             fill_nan=True):
+        """
+        Reads a level/lat-lon window out of the granule. Geolocation (a few KB) is read to find the profiles inside
+        the bbox; the 2-D fields are then read only over those runs of profiles and the chosen levels.
+        :param levels: optional slice, integer, or list of nLevels indices
+        :param pressure_range: optional (min hPa, max hPa) tuple limiting the levels read
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list limiting the profiles read
+        :param fields: tuple of field names to read
+        :param fill_nan: whether to replace fill values in floating-point fields with NaN
+        :return: dictionary of NumPy arrays: 'latitude', 'longitude', 'time', 'pressure' and one entry per field
+        """
+        lat = np.asarray(self.field("latitude")[:])
+        lon = np.asarray(self.field("longitude")[:])
+        mask = np.ones(lat.shape, dtype=bool)
+        if bbox is not None:
+            minlon, minlat, maxlon, maxlat = bbox
+            mask = (lon >= minlon) & (lon <= maxlon) & (lat >= minlat) & (lat <= maxlat)
+        runs = _runs(mask)  # the orbit crosses a lat/lon window several times a day; read each pass separately
+        level_idx = self.level_indices(levels, pressure_range)
+
+        out = {"pressure": np.asarray(self.field("pressure")[:])[level_idx],  # only nLevels long
+               "latitude": lat[mask],
+               "longitude": lon[mask],
+               "time": np.concatenate([self.times(slice(*run)) for run in runs]) if runs else self.times(slice(0, 0))}
+        n_levels = len(out["pressure"])
+        for name in fields:
+            ds = self.field(name)
+            two_d = len(ds.shape) > 1
+            parts = [self._read_run(ds, slice(*run), level_idx) if two_d else np.asarray(ds[slice(*run)])
+                     for run in runs]
+            if parts:
+                values = np.concatenate(parts)
+            else:
+                values = np.empty((0, n_levels) if two_d else (0,), dtype=ds.dtype)
+            if fill_nan and np.issubdtype(values.dtype, np.floating):
+                fill = self.fill_value(name)
+                if fill is not None:
+                    values = np.where(np.isclose(values, fill), np.nan, values)
+            out[name] = values
+        return out
+
+    @staticmethod
+    def _read_run(ds, profiles, level_idx):
+        if not isinstance(level_idx, np.ndarray):
+            return np.asarray(ds[profiles, level_idx])
+        if level_idx.size == 0:
+            return np.empty((profiles.stop - profiles.start, 0), dtype=ds.dtype)
+        # h5py only takes strictly increasing index lists; read the covering block and pick from it in memory
+        block = np.asarray(ds[profiles, int(level_idx[0]):int(level_idx[-1]) + 1])
+        return block[:, level_idx - level_idx[0]]
+
+
+def find_granules(dirs, pattern="MLS-Aura_L2GP-Temperature_*.he5"):
+    """
+    :param dirs: list of strings giving directories to look in
+    :param pattern: glob pattern for granule filenames
+    :return: sorted list of full paths (de-duplicated by filename, first directory wins)
+    """
+    found = {}
+    for d in dirs:
+        for path in glob.glob(os.path.join(d, pattern)):
+            found.setdefault(os.path.basename(path), path)
+    return sorted(found.values())
+
+
+def scan_granules(paths, swath="Temperature", **read_args):
+    """
+    Reads the same window out of many granules one at a time, so memory is bounded by the size of one slice rather
+    than by the archive
+    :param paths: list of strings giving granule paths
+    :param swath: string giving the swath name
+    :param read_args: keyword arguments passed to MLSGranule.read()
+    :return: generator of (path, slice dictionary) tuples
+    """
+    for path in paths:
+        with MLSGranule(path, swath=swath) as granule:
+            yield path, granule.read(**read_args)
@@ -0,0 +1,256 @@
+# Embedded, indexed SQLite store of synoptic observations, backing wile.query().
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import hashlib
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS stations ("
+    "station_id INTEGER PRIMARY KEY, stid TEXT NOT NULL UNIQUE, name TEXT, "
+    "latitude REAL, longitude REAL, elevation REAL)",
+    "CREATE TABLE IF NOT EXISTS variables (variable_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    "CREATE TABLE IF NOT EXISTS sets (set_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    # clustered on (station, variable, time) so a station/variable/time-range lookup is a single index range scan;
+    # the primary key doubles as the upsert key, so ingesting the same observation twice just overwrites it
+    "CREATE TABLE IF NOT EXISTS observations ("
+    "station_id INTEGER NOT NULL, variable_id INTEGER NOT NULL, time INTEGER NOT NULL, set_id INTEGER NOT NULL, "
+    "value REAL, qc INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (station_id, variable_id, time, set_id)) WITHOUT ROWID",
+    # for statewide queries that don't name any stations
+    "CREATE INDEX IF NOT EXISTS observations_time ON observations (time, variable_id)",
+]
+
+# R*Tree over station coordinates for bbox queries. Every stock SQLite build we've seen has the rtree module, but if
+# one doesn't, bbox queries fall back to a plain index on the coordinates.
+RTREE_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS station_rtree USING rtree(station_id, min_lon, max_lon, min_lat, max_lat)"
+FALLBACK_SPATIAL_INDEX = "CREATE INDEX IF NOT EXISTS stations_lon_lat ON stations (longitude, latitude)"
+
+
+def _epoch_seconds(t):
+    """
+    Converts a datetime, numpy datetime64 or anything pandas can parse to integer seconds since 1970-01-01 UTC
+    """
+    if isinstance(t, (int, np.integer)):
+        return int(t)
+    return int(pd.Timestamp(t).value // 10 ** 9)
+
+
+class ObservationStore:
+    """
+    Wraps a single SQLite file holding station metadata and every observation ingested so far. No server is needed;
+    the file lives under DATA_DIR. Each call opens its own connection, so one store can be shared between threads.
+    """
+    def __init__(self, db_path):
+        """
+        :param db_path: string giving the full path of the SQLite file; it's created if it doesn't exist
+        """
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # readers don't block on an ingest in progress
+            for statement in SCHEMA:
+                conn.execute(statement)
+            try:
+                conn.execute(RTREE_SCHEMA)
+                self.has_rtree = True
+            except sqlite3.OperationalError:
+                conn.execute(FALLBACK_SPATIAL_INDEX)
+                self.has_rtree = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _lookup_ids(self, conn, table, id_col, names):
+        """
+        Maps names to integer IDs in a small lookup table, adding any that aren't there yet
+        """
+        conn.executemany("INSERT OR IGNORE INTO {} (name) VALUES (?)".format(table), [(n,) for n in names])
+        rows = conn.execute("SELECT name, {} FROM {}".format(id_col, table)).fetchall()
+        return dict(rows)
+
+    def upsert_stations(self, stations_df, conn=None):
+        """
+        Adds or updates station metadata, keeping the spatial index in step
+        :param stations_df: pandas DataFrame indexed by STID with NAME, LATITUDE, LONGITUDE and ELEVATION columns, as
+                            returned by synoptic_decode.decode_stations()
+        :param conn: optional open connection to use, so the caller can wrap several upserts in one transaction
+        :return: dictionary of STID -> station_id
+        """
+        if conn is None:
+            with self._connect() as conn:
+                return self.upsert_stations(stations_df, conn)
+
+        df = stations_df.reset_index()
+        rows = [(r.STID, r.NAME,
+                 None if pd.isna(r.LATITUDE) else float(r.LATITUDE),
+                 None if pd.isna(r.LONGITUDE) else float(r.LONGITUDE),
+                 None if pd.isna(r.ELEVATION) else float(r.ELEVATION)) for r in df.itertuples(index=False)]
+        conn.executemany("INSERT INTO stations (stid, name, latitude, longitude, elevation) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT(stid) DO UPDATE SET name=excluded.name, latitude=excluded.latitude, "
+                         "longitude=excluded.longitude, elevation=excluded.elevation", rows)
+        stids = [r[0] for r in rows]
+        ids = {}
+        for i in range(0, len(stids), 500):  # stay under SQLite's bound-parameter limit
+            batch = stids[i:i + 500]
+            ids.update(conn.execute("SELECT stid, station_id FROM stations WHERE stid IN ({})".format(
+                ",".join("?" * len(batch))), batch).fetchall())
+        if self.has_rtree:
+            conn.executemany("INSERT OR REPLACE INTO station_rtree VALUES (?, ?, ?, ?, ?)",
+                             [(ids[r[0]], r[3], r[3], r[2], r[2]) for r in rows if r[2] is not None and r[3] is not None])
+        return ids
+
+    def upsert_observations(self, obs_df, stations_df=None):
+        """
+        Ingests a tidy observation table. Re-ingesting an observation already in the store overwrites it instead of
+        adding a duplicate row.
+        :param obs_df: pandas DataFrame with station, time, variable, set, value and qc columns, as returned by
+                       synoptic_decode.decode_observations()
+        :param stations_df: optional station metadata to upsert in the same transaction
+        :return: integer giving the number of observations ingested
+        """
+        if len(obs_df) == 0:
+            return 0
+        with self._connect() as conn:
+            if stations_df is not None:
+                station_ids = self.upsert_stations(stations_df, conn)
+            else:
+                station_ids = {}
+            missing = [s for s in pd.unique(obs_df["station"].astype(str)) if s not in station_ids]
+            if missing:
+                conn.executemany("INSERT OR IGNORE INTO stations (stid) VALUES (?)", [(s,) for s in missing])
+                station_ids.update(conn.execute("SELECT stid, station_id FROM stations").fetchall())
+            variable_ids = self._lookup_ids(conn, "variables", "variable_id",
+                                            pd.unique(obs_df["variable"].astype(str)))
+            set_ids = self._lookup_ids(conn, "sets", "set_id", pd.unique(obs_df["set"].astype(str)))
+
+            # map the categorical columns to integer IDs once per category rather than once per row
+            def codes(col, ids):
+                values = obs_df[col].astype("category")
+                lookup = np.array([ids[str(c)] for c in values.cat.categories], dtype=np.int64)
+                return lookup[values.cat.codes.to_numpy()]
+
+            values = obs_df["value"].to_numpy(dtype=np.float64)
+            rows = zip(codes("station", station_ids).tolist(),
+                       codes("variable", variable_ids).tolist(),
+                       obs_df["time"].to_numpy().astype("datetime64[s]").astype(np.int64).tolist(),
+                       codes("set", set_ids).tolist(),
+                       [None if np.isnan(v) else v for v in values.tolist()],
+                       obs_df["qc"].to_numpy(dtype=np.int64).tolist())
+            conn.executemany("INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT(station_id, variable_id, time, set_id) DO UPDATE SET "
+                             "value=excluded.value, qc=excluded.qc", rows)
+        return len(obs_df)
+
+    def query(self, stations=None, variables=None, start=None, end=None, bbox=None, include_qc=True):
+        """
+        Looks up observations by station, variable, time range and/or bounding box
+        :param stations: optional list of station IDs (STIDs)
+        :param variables: optional list of variable names, such as ['air_temp', 'relative_humidity']
+        :param start: optional datetime or string giving the earliest time to return (UTC)
+        :param end: optional datetime or string giving the latest time to return (UTC)
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list giving the area to return stations from
+        :param include_qc: whether to return values flagged for quality control. Defaults to True
+        :return: pandas DataFrame with station, time, variable, set, value and qc columns, sorted by station and time
+        """
+        where = []
+        params = []
+        if stations is not None:
+            stations = list(stations)
+            where.append("s.stid IN ({})".format(",".join("?" * len(stations))))
+            params.extend(stations)
+        if variables is not None:
+            variables = list(variables)
+            where.append("o.variable_id IN (SELECT variable_id FROM variables WHERE name IN ({}))".format(
+                ",".join("?" * len(variables))))
+            params.extend(variables)
+        if start is not None:
+            where.append("o.time >= ?")
+            params.append(_epoch_seconds(start))
+        if end is not None:
+            where.append("o.time <= ?")
+            params.append(_epoch_seconds(end))
+        if bbox is not None:
+            minlon, minlat, maxlon, maxlat = bbox
+            if self.has_rtree:
+                where.append("o.station_id IN (SELECT station_id FROM station_rtree WHERE "
+                             "min_lon >= ? AND max_lon <= ? AND min_lat >= ? AND max_lat <= ?)")
+            else:
+                where.append("o.station_id IN (SELECT station_id FROM stations WHERE "
+                             "longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?)")
+            params.extend([minlon, maxlon, minlat, maxlat])
+        if not include_qc:
+            where.append("o.qc = 0")
+
+        sql = ("SELECT s.stid, o.time, v.name, t.name, o.value, o.qc FROM observations o "
+               "JOIN stations s ON s.station_id = o.station_id "
+               "JOIN variables v ON v.variable_id = o.variable_id "
+               "JOIN sets t ON t.set_id = o.set_id")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        stid, time, variable, set_name, value, qc = zip(*rows) if rows else ([], [], [], [], [], [])
+        df = pd.DataFrame({"station": pd.Categorical(stid),
+                           "time": np.array(time, dtype=np.int64).astype("datetime64[s]"),
+                           "variable": pd.Categorical(variable),
+                           "set": pd.Categorical(set_name),
+                           "value": np.array([np.nan if v is None else v for v in value], dtype=np.float32),
+                           "qc": np.array(qc, dtype=bool)})
+        return df.sort_values(["station", "time"], kind="stable").reset_index(drop=True)
+
+    def stations(self):
+        """
+        :return: pandas DataFrame indexed by STID with NAME, LATITUDE, LONGITUDE and ELEVATION columns, sorted by STID
+        """
+        with self._connect() as conn:
+            df = pd.read_sql_query("SELECT stid AS STID, name AS NAME, latitude AS LATITUDE, longitude AS LONGITUDE, "
+                                   "elevation AS ELEVATION FROM stations ORDER BY stid", conn)
+        return df.set_index("STID")
+
+    def hour_fingerprints(self, hours):
+        """
+        Summarizes what the store holds for each hour, cheaply enough to check every run: a new, changed, moved or
+        re-flagged observation changes its hour's fingerprint. Each hour's fingerprint is a hash of its rows in key
+        order, so it doesn't depend on the order they were ingested in, and values swapped between stations or times
+        still change it. Each run of consecutive hours is one range scan over the time index.
+        :param hours: datetime64[h] array of hours
+        :return: dictionary of hour (seconds since 1970-01-01 UTC) -> fingerprint string, for the hours with any data
+        """
+        seconds = np.unique(np.asarray(hours).astype("datetime64[h]").astype("datetime64[s]").astype(np.int64))
+        if seconds.size == 0:
+            return {}
+        breaks = np.flatnonzero(np.diff(seconds) != 3600) + 1
+        out = {}
+        with self._connect() as conn:
+            for run in np.split(seconds, breaks):
+                rows = conn.execute("SELECT time, station_id, variable_id, set_id, qc, value FROM observations "
+                                    "WHERE time >= ? AND time < ? ORDER BY time, station_id, variable_id, set_id",
+                                    (int(run[0]), int(run[-1]) + 3600)).fetchall()
+                if not rows:
+                    continue
+                columns = list(zip(*rows))
+                # one int64 row per observation, the value by its bit pattern, so each hour hashes as one buffer
+                table = np.column_stack([np.array(c, dtype=np.int64) for c in columns[:5]] +
+                                        [np.array(columns[5], dtype=np.float64).view(np.int64)])
+                hour = table[:, 0] // 3600 * 3600
+                for chunk in np.split(table, np.flatnonzero(np.diff(hour)) + 1):
+                    out[int(chunk[0, 0]) // 3600 * 3600] = hashlib.sha1(chunk.tobytes()).hexdigest()
+        return out
+
+    def time_range(self):
+        """
+        :return: (earliest, latest) tuple of datetimes covered by the store, or (None, None) if it's empty
+        """
+        with self._connect() as conn:
+            lo, hi = conn.execute("SELECT MIN(time), MAX(time) FROM observations").fetchone()
+        if lo is None:
+            return None, None
+        return datetime.utcfromtimestamp(lo), datetime.utcfromtimestamp(hi)
@@ -0,0 +1,225 @@
+# Incremental derived-dataset pipeline: stages declare their inputs, every (stage, hour) output is fingerprinted by
+# what went into it, and a run only recomputes the hours whose fingerprints changed (and removes the outputs of hours
+# whose inputs are gone).
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from metrics import NULL_METRICS
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS partitions ("
+    "stage TEXT NOT NULL, hour INTEGER NOT NULL, "  # hour is seconds since 1970-01-01 UTC, on the hour
+    "fingerprint TEXT NOT NULL, computed_at REAL NOT NULL, "
+    "PRIMARY KEY (stage, hour)) WITHOUT ROWID",
+]
+
+
+# one lock per manifest file: two runs over the same manifest (a daemon pull and an on-demand rebuild, say) would
+# otherwise both see the same hours as stale and build them twice, racing on the outputs
+_RUN_LOCKS = {}
+_RUN_LOCKS_LOCK = threading.Lock()
+
+
+def _run_lock(manifest_path):
+    key = os.path.abspath(manifest_path)
+    with _RUN_LOCKS_LOCK:
+        return _RUN_LOCKS.setdefault(key, threading.RLock())
+
+
+def _hour_seconds(hours):
+    return np.asarray(hours).astype("datetime64[h]").astype("datetime64[s]").astype(np.int64)
+
+
+def _hash(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class Stage:
+    """
+    One step of the pipeline. compute() is handed the hours that need (re)building and writes its own outputs;
+    remove() is handed the hours it has outputs for but no longer any inputs, and deletes them.
+    """
+    def __init__(self, name, inputs, compute, version="1", params=None, remove=None):
+        """
+        :param name: string naming the stage
+        :param inputs: list of source and stage names this stage reads
+        :param compute: function taking a sorted datetime64[h] array of hours to build
+        :param version: string to bump when the stage's code changes in a way that should rebuild its outputs
+        :param params: optional function returning a string describing any other setting the outputs depend on (such
+                       as the grid or the station set); a change rebuilds every hour
+        :param remove: optional function taking a sorted datetime64[h] array of hours whose inputs have all vanished
+                       since they were built. Without one those hours are only dropped from the manifest, and their
+                       outputs are left where they are
+        """
+        self.name = name
+        self.inputs = list(inputs)
+        self.compute = compute
+        self.version = version
+        self.params = params
+        self.remove = remove
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order over a set of hours. Sources are the raw data (their fingerprints come from
+    wherever the data lives); stages are everything derived from them. A stage's fingerprint for an hour hashes its
+    version, its params and its inputs' fingerprints for that hour, so a change anywhere upstream ripples down to
+    exactly the hours it touched and nothing else. Fingerprints are kept in a SQLite manifest.
+    """
+    def __init__(self, manifest_path, logger=None, metrics=None):
+        """
+        :param manifest_path: string giving the full path of the manifest SQLite file
+        :param logger: optional logging.Logger
+        :param metrics: optional metrics.Metrics to report stage timings to
+        """
+        self.manifest_path = manifest_path
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.sources = {}
+        self.stages = {}
+        with self._connect() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.manifest_path, timeout=60)
+
+    def add_source(self, name, fingerprints):
+        """
+        :param name: string naming the source
+        :param fingerprints: function taking a datetime64[h] array of hours and returning a dictionary of hour seconds
+                             -> fingerprint string, for the hours that have any data
+        """
+        self.sources[name] = fingerprints
+
+    def add_stage(self, stage):
+        """
+        :param stage: Stage. Its inputs must already have been added, which keeps the stages in dependency order
+        """
+        for name in stage.inputs:
+            if name not in self.sources and name not in self.stages:
+                raise ValueError("stage {} reads {}, which hasn't been added".format(stage.name, name))
+        self.stages[stage.name] = stage
+
+    def fingerprints(self, stage_name, hours):
+        """
+        :return: dictionary of hour seconds -> stored fingerprint for the hours a stage has been built for
+        """
+        seconds = _hour_seconds(hours).tolist()
+        out = {}
+        with self._connect() as conn:
+            for i in range(0, len(seconds), 500):  # stay under SQLite's bound-parameter limit
+                batch = seconds[i:i + 500]
+                out.update(conn.execute("SELECT hour, fingerprint FROM partitions WHERE stage = ? AND hour IN ({})"
+                                        .format(",".join("?" * len(batch))), [stage_name] + batch).fetchall())
+        return out
+
+    def hours(self):
+        """
+        :return: sorted datetime64[h] array of every hour any stage has been built for
+        """
+        with self._connect() as conn:
+            seconds = [row[0] for row in conn.execute("SELECT DISTINCT hour FROM partitions ORDER BY hour")]
+        return np.array(seconds, dtype="datetime64[s]").astype("datetime64[h]")
+
+    def run(self, hours, targets=None, force=False):
+        """
+        Brings stages up to date for a set of hours. Runs over the same manifest take turns, so calling this from
+        several threads at once is safe
+        :param hours: list/array of hours (datetime64 or datetime) to bring up to date
+        :param targets: optional list of stage names to build, along with whatever they depend on. Defaults to every
+                        stage
+        :param force: whether to rebuild every hour regardless of fingerprints
+        :return: dictionary of stage name -> datetime64[h] array of the hours that were rebuilt
+        """
+        with _run_lock(self.manifest_path):
+            return self._run(hours, targets, force)
+
+    def _run(self, hours, targets, force):
+        hours = np.unique(np.asarray(hours).astype("datetime64[h]"))
+        seconds = _hour_seconds(hours)
+        needed = self._needed(targets)
+
+        current = {}  # name -> {hour seconds: fingerprint} as of this run
+        for name in self.sources:
+            if name in needed:
+                current[name] = self.sources[name](hours)
+
+        rebuilt = {}
+        for name, stage in self.stages.items():
+            if name not in needed:
+                continue
+            params = stage.params() if stage.params is not None else ""
+            new = {}
+            for s in seconds.tolist():
+                inputs = [current[i].get(s) for i in stage.inputs]
+                if all(fp is None for fp in inputs):
+                    continue  # nothing to build this hour from
+                new[s] = _hash(name, stage.version, params, *inputs)
+            old = self.fingerprints(name, hours)
+            todo = sorted(s for s, fp in new.items() if force or old.get(s) != fp)
+            current[name] = new
+            gone = sorted(s for s in old if s not in new)
+            if gone:
+                self._remove(stage, gone)
+
+            if todo:
+                started = time.monotonic()
+                with self.metrics.timer("stage_seconds", stage=name):
+                    stage.compute(np.array(todo, dtype="datetime64[s]").astype("datetime64[h]"))
+                self.metrics.count("stage_hours_total", len(todo), stage=name)
+                now = time.time()
+                with self._connect() as conn:
+                    conn.executemany("INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?)",
+                                     [(name, s, new[s], now) for s in todo])
+                self.logger.debug("stage {}: rebuilt {} of {} hour(s) in {:.1f}s".format(
+                    name, len(todo), len(new), time.monotonic() - started))
+            else:
+                self.logger.debug("stage {}: all {} hour(s) up to date".format(name, len(new)))
+            rebuilt[name] = np.array(todo, dtype="datetime64[s]").astype("datetime64[h]")
+        return rebuilt
+
+    def _remove(self, stage, gone):
+        """
+        Deletes the outputs of hours a stage was built for whose inputs have since vanished, and forgets them in the
+        manifest so the hours are rebuilt if data for them turns up again
+        """
+        hours = np.array(gone, dtype="datetime64[s]").astype("datetime64[h]")
+        if stage.remove is not None:
+            stage.remove(hours)
+        else:
+            self.logger.warning("stage {}: inputs of {} hour(s) vanished and the stage has no remove(); their "
+                                "outputs are stale".format(stage.name, len(gone)))
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM partitions WHERE stage = ? AND hour = ?", [(stage.name, s) for s in gone])
+        self.metrics.count("stage_hours_removed_total", len(gone), stage=stage.name)
+        self.logger.debug("stage {}: removed {} hour(s) whose inputs vanished".format(stage.name, len(gone)))
+
+    def _needed(self, targets):
+        if targets is None:
+            return set(self.sources) | set(self.stages)
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            if name in self.stages:
+                pending.extend(self.stages[name].inputs)
+            elif name not in self.sources:
+                raise KeyError("no stage or source named {}".format(name))
+        return needed
@@ -0,0 +1,317 @@
+# Rollup pyramid of station observations: per station and variable, the count, min, max and sum of every day, week,
+# month and year, so long-range summaries read a handful of precomputed rows instead of years of hourly data.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Levels, finest first. Only days are read from raw data; each coarser level is aggregated from a finer one:
+#   day    from the observation store
+#   week   from days (weeks start on Monday, as in ISO 8601)
+#   month  from days
+#   year   from months
+
+import logging
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+LEVELS = ("day", "week", "month", "year")
+DAY = 86400
+ACCUMULATED_VARS = ("precip_accum",)  # running totals; their rollup 'total' is the sum of the increases
+LOOKBACK = timedelta(days=1)  # how far before a day to look for the observation an accumulated variable rose from
+
+SCHEMA = [
+    # period is the start of the day/week/month/year, in seconds since 1970-01-01 UTC. Keyed level-period first so
+    # reading or replacing a run of periods for every station is one range scan. total is only filled in for
+    # ACCUMULATED_VARS
+    "CREATE TABLE IF NOT EXISTS rollups ("
+    "level TEXT NOT NULL, variable TEXT NOT NULL, period INTEGER NOT NULL, station TEXT NOT NULL, "
+    "n INTEGER NOT NULL, min REAL, max REAL, sum REAL, total REAL, "
+    "PRIMARY KEY (level, period, variable, station)) WITHOUT ROWID",
+]
+
+
+def _day(t):
+    """
+    :return: datetime at the start of the UTC day containing t (datetime, datetime64 or string)
+    """
+    return pd.Timestamp(t).to_pydatetime().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+
+def _seconds(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def set_rank(set_name):
+    """
+    :return: sort key putting the lowest-numbered set first: set_1 before set_1d before set_2 before set_10
+    """
+    match = re.match(r"^(set|value)_(\d+)(d?)$", set_name)
+    if match is None:
+        return (float("inf"), set_name)
+    return (int(match.group(2)), match.group(3), match.group(1))
+
+
+def period_start(level, dt):
+    """
+    :return: datetime at the start of the level's period containing the day dt
+    """
+    if level == "day":
+        return dt
+    if level == "week":
+        return dt - timedelta(days=dt.weekday())
+    if level == "month":
+        return dt.replace(day=1)
+    if level == "year":
+        return dt.replace(month=1, day=1)
+    raise ValueError("unknown rollup level {!r}; expected one of {}".format(level, LEVELS))
+
+
+def period_end(level, start):
+    """
+    :return: datetime at the start of the period after the one starting at start
+    """
+    if level == "day":
+        return start + timedelta(days=1)
+    if level == "week":
+        return start + timedelta(days=7)
+    if level == "month":
+        return (start + timedelta(days=32)).replace(day=1)
+    if level == "year":
+        return start.replace(year=start.year + 1)
+    raise ValueError("unknown rollup level {!r}; expected one of {}".format(level, LEVELS))
+
+
+def _greedy(start, end, levels):
+    """
+    :return: list of (level, period start) tuples covering start to end, taking the coarsest of levels that starts
+             and ends inside the range at each step
+    """
+    pieces = []
+    t = start
+    while t < end:
+        for level in levels[::-1]:
+            if period_start(level, t) == t and period_end(level, t) <= end:
+                pieces.append((level, t))
+                t = period_end(level, t)
+                break
+    return pieces
+
+
+def cover(start, end):
+    """
+    Splits a range of whole days into few rollup periods: days and weeks up to the first month boundary, months and
+    years between the first and last month boundaries, then weeks and days to the end. Weeks never straddle a month
+    boundary, since one that did would leave the cursor off the boundaries the months and years start on. A range from
+    2015-01-15 to 2025-01-10 is 4 days, 1 week and 6 days to February, 11 months and 9 years to 2025, then 9 days: 40
+    pieces
+    :param start: datetime giving the first day of the range
+    :param end: datetime giving the day after the last day of the range
+    :return: list of (level, period start datetime) tuples, in time order
+    """
+    first_month = start if start.day == 1 else period_end("month", period_start("month", start))
+    last_month = period_start("month", end)
+    if first_month >= last_month:  # no whole month in the range
+        return _greedy(start, end, ("day", "week"))
+    return (_greedy(start, first_month, ("day", "week")) +
+            _greedy(first_month, last_month, ("month", "year")) +
+            _greedy(last_month, end, ("day", "week")))
+
+
+class RollupStore:
+    """
+    Keeps the rollup pyramid in a SQLite file. update() rebuilds the days touched by a set of hours from the
+    observation store, then re-derives the weeks, months and years holding those days from the rows below them, so
+    keeping up with an hourly pull costs one day's worth of raw data and a few small aggregates. Values flagged for
+    quality control are left out.
+    """
+    def __init__(self, db_path, logger=None):
+        """
+        :param db_path: string giving the full path of the SQLite file; it's created if it doesn't exist
+        :param logger: optional logging.Logger
+        """
+        self.db_path = db_path
+        self.logger = logger or logging.getLogger(__name__)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def _day_rows(self, obs_store, first_day, last_day, variables=None):
+        """
+        Aggregates raw observations into day rows
+        :return: list of (level, variable, period, station, n, min, max, sum, total) tuples
+        """
+        obs = obs_store.query(variables=variables, start=first_day - LOOKBACK,
+                              end=last_day + timedelta(days=1) - timedelta(seconds=1), include_qc=False)
+        obs = obs[obs["value"].notna()]
+        if len(obs) == 0:
+            return []
+        t = obs["time"].to_numpy().astype("datetime64[s]").astype(np.int64)
+        df = pd.DataFrame({"station": obs["station"].astype(str).to_numpy(),
+                           "variable": obs["variable"].astype(str).to_numpy(),
+                           "set": obs["set"].astype(str).to_numpy(),
+                           "time": t,
+                           "period": t - t % DAY,
+                           "value": obs["value"].to_numpy(dtype=np.float64)})
+
+        # increases of accumulated variables, credited to the day of the later observation; a drop is a counter reset
+        # and adds nothing
+        df["rise"] = np.nan
+        accumulated = df["variable"].isin(ACCUMULATED_VARS)
+        if accumulated.any():
+            acc = df[accumulated].sort_values(["station", "variable", "set", "time"], kind="stable")
+            key = acc[["station", "variable", "set"]].to_numpy()
+            same = (key[1:] == key[:-1]).all(axis=1)
+            rise = np.full(len(acc), np.nan)
+            rise[1:] = np.where(same, np.clip(np.diff(acc["value"].to_numpy()), 0, None), np.nan)
+            df.loc[acc.index, "rise"] = rise
+
+        df = df[df["period"] >= _seconds(first_day)]  # drop the lookback
+        # summarized per set, then one set kept per station, variable and day: two sensors (or the same sensor
+        # ingested under two set names) would otherwise count every reading, and every rainfall, twice
+        grouped = df.groupby(["variable", "period", "station", "set"], sort=True)
+        agg = grouped["value"].agg(["count", "min", "max", "sum"])
+        agg["total"] = grouped["rise"].sum(min_count=1)
+        agg = agg.reset_index()
+        order = {name: i for i, name in enumerate(sorted(agg["set"].unique(), key=set_rank))}
+        agg["rank"] = agg["set"].map(order)
+        agg = agg.sort_values(["variable", "period", "station", "rank"], kind="stable")
+        agg = agg.drop_duplicates(["variable", "period", "station"], keep="first")
+        return [("day", v, int(p), s, int(n), float(lo), float(hi), float(total_value),
+                 None if np.isnan(rise_total) else float(rise_total))
+                for v, p, s, n, lo, hi, total_value, rise_total in zip(agg["variable"], agg["period"], agg["station"],
+                                                                        agg["count"], agg["min"], agg["max"],
+                                                                        agg["sum"], agg["total"])]
+
+    def _rebuild(self, conn, level, source_level, periods):
+        """
+        Re-derives a level's periods from the rows of a finer level
+        """
+        for start in periods:
+            conn.execute("DELETE FROM rollups WHERE level = ? AND period = ?", (level, _seconds(start)))
+            conn.execute("INSERT INTO rollups SELECT ?, variable, ?, station, SUM(n), MIN(min), MAX(max), SUM(sum), "
+                         "SUM(total) FROM rollups WHERE level = ? AND period >= ? AND period < ? "
+                         "GROUP BY variable, station",
+                         (level, _seconds(start), source_level, _seconds(start),
+                          _seconds(period_end(level, start))))
+
+    def update(self, obs_store, hours, variables=None, max_days=31):
+        """
+        Brings the pyramid up to date for the days holding some hours
+        :param obs_store: obs_store.ObservationStore to read raw observations from
+        :param hours: list/array of hours (datetime64 or datetime) whose data changed
+        :param variables: optional list of variable names to roll up. Defaults to every variable
+        :param max_days: integer giving the most days read from the observation store at once
+        :return: integer giving the number of days rebuilt
+        """
+        days = sorted({_day(h) for h in np.unique(np.asarray(hours).astype("datetime64[D]")).astype(object)})
+        if not days:
+            return 0
+        # consecutive days are read together, at most max_days at a time
+        runs = [[days[0]]]
+        for d in days[1:]:
+            if d - runs[-1][-1] == timedelta(days=1) and len(runs[-1]) < max_days:
+                runs[-1].append(d)
+            else:
+                runs.append([d])
+
+        with self._connect() as conn:
+            for run in runs:
+                rows = self._day_rows(obs_store, run[0], run[-1], variables=variables)
+                conn.execute("DELETE FROM rollups WHERE level = 'day' AND period >= ? AND period <= ?",
+                             (_seconds(run[0]), _seconds(run[-1])))
+                conn.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._rebuild(conn, "week", "day", sorted({period_start("week", d) for d in days}))
+            months = sorted({period_start("month", d) for d in days})
+            self._rebuild(conn, "month", "day", months)
+            self._rebuild(conn, "year", "month", sorted({period_start("year", m) for m in months}))
+        self.logger.debug("rolled up {} day(s) from {} to {}".format(len(days), days[0].date(), days[-1].date()))
+        return len(days)
+
+    def _select(self, conn, level, periods, stations, variables):
+        """
+        Reads the rows of one level for a list of period starts (seconds), in batches under SQLite's parameter limit
+        """
+        rows = []
+        for i in range(0, len(periods), 500):
+            batch = periods[i:i + 500]
+            sql = ("SELECT level, variable, period, station, n, min, max, sum, total FROM rollups "
+                   "WHERE level = ? AND period IN ({})".format(",".join("?" * len(batch))))
+            params = [level] + batch
+            if variables is not None:
+                sql += " AND variable IN ({})".format(",".join("?" * len(variables)))
+                params += list(variables)
+            if stations is not None:
+                sql += " AND station IN ({})".format(",".join("?" * len(stations)))
+                params += list(stations)
+            rows.extend(conn.execute(sql, params).fetchall())
+        return rows
+
+    def query(self, level, start, end, stations=None, variables=None):
+        """
+        Reads one level's rows for the periods starting within a range
+        :param level: one of LEVELS
+        :param start: datetime or string giving the start of the range (UTC)
+        :param end: datetime or string giving the end of the range (UTC, exclusive)
+        :param stations: optional list of STIDs
+        :param variables: optional list of variable names
+        :return: pandas DataFrame with level, variable, period (datetime64), station, n, min, max, sum, total and mean
+                 columns
+        """
+        t = period_start(level, _day(start))
+        periods = []
+        while t < pd.Timestamp(end).to_pydatetime().replace(tzinfo=None):
+            if t >= _day(start):
+                periods.append(_seconds(t))
+            t = period_end(level, t)
+        with self._connect() as conn:
+            rows = self._select(conn, level, periods, stations, variables)
+        return self._frame(rows)
+
+    def summarize(self, start, end, stations=None, variables=None):
+        """
+        Summarizes every station and variable over a range of whole days, reading each stretch of the range from the
+        coarsest level that fits it (see cover()), so a ten-year range reads about ten year rows per station and
+        variable plus whatever partial months and days sit at its ends
+        :param start: datetime or string giving the first day of the range (UTC); any time of day is ignored
+        :param end: datetime or string giving the end of the range (UTC, exclusive); a time of day rounds it up to the
+                    end of that day
+        :param stations: optional list of STIDs
+        :param variables: optional list of variable names
+        :return: pandas DataFrame indexed by (station, variable) with n, min, max, sum, total and mean columns
+        """
+        start_day = _day(start)
+        end_ts = pd.Timestamp(end).to_pydatetime().replace(tzinfo=None)
+        end_day = _day(end_ts) if end_ts == _day(end_ts) else _day(end_ts) + timedelta(days=1)
+        pieces = cover(start_day, end_day)
+        by_level = {}
+        for level, t in pieces:
+            by_level.setdefault(level, []).append(_seconds(t))
+        rows = []
+        with self._connect() as conn:
+            for level, periods in by_level.items():
+                rows.extend(self._select(conn, level, periods, stations, variables))
+        self.logger.debug("summarized {} to {} from {} rollup row(s): {}".format(
+            start_day.date(), end_day.date(), len(rows),
+            ", ".join("{} {}(s)".format(len(p), level) for level, p in by_level.items())))
+
+        df = self._frame(rows)
+        out = df.groupby(["station", "variable"], sort=True).agg(
+            n=("n", "sum"), min=("min", "min"), max=("max", "max"), sum=("sum", "sum"),
+            total=("total", lambda x: x.sum(min_count=1)))
+        out["mean"] = out["sum"] / out["n"]
+        return out
+
+    @staticmethod
+    def _frame(rows):
+        df = pd.DataFrame(rows, columns=["level", "variable", "period", "station", "n", "min", "max", "sum", "total"])
+        df["period"] = df["period"].to_numpy(dtype=np.int64).astype("datetime64[s]")
+        df["total"] = df["total"].astype(float)
+        df["mean"] = df["sum"] / df["n"]
+        return df
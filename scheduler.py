@@ -0,0 +1,164 @@
+# Resident scheduler for the daemon mode: runs pulls on fixed cadences in one long-lived process, so sessions,
+# caches and indexes stay warm between cycles.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import logging
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from metrics import NULL_METRICS
+
+
+def _seconds(t):
+    return t.total_seconds() if isinstance(t, timedelta) else float(t)
+
+
+class Job:
+    """
+    A function to call on a fixed cadence. Runs are anchored to a grid of ticks (first tick + n * interval) rather
+    than to when the previous run finished, so a slow upstream response delays one run without shifting every run
+    after it.
+    """
+    def __init__(self, name, func, interval, jitter=0, run_on_start=True):
+        """
+        :param name: string naming the job in logs
+        :param func: function taking no arguments
+        :param interval: timedelta or seconds between ticks
+        :param jitter: timedelta or seconds; each run starts a random 0..jitter after its tick, so jobs (and other
+                       clients polling the same API) don't all fire at once. Jitter never accumulates across runs
+        :param run_on_start: whether the first tick is when the scheduler starts, or one interval after
+        """
+        self.name = name
+        self.func = func
+        self.interval = _seconds(interval)
+        self.jitter = _seconds(jitter)
+        self.run_on_start = run_on_start
+
+        self.next_tick = None  # monotonic time of the next tick
+        self.next_run = None  # next_tick plus this tick's jitter
+        self.future = None  # the run in progress, if any
+        self.n_runs = 0
+        self.n_skipped = 0
+        self.n_failed = 0
+        self.last_duration = None
+
+    def schedule_first(self, now):
+        self.next_tick = now if self.run_on_start else now + self.interval
+        self.next_run = self.next_tick + random.uniform(0, self.jitter)
+
+    def advance(self, now):
+        """
+        Moves to the next tick after now. Ticks that have already gone by are dropped rather than run late one after
+        another
+        :return: integer giving the number of ticks dropped
+        """
+        n_missed = max(int((now - self.next_tick) // self.interval), 0)
+        self.next_tick += (n_missed + 1) * self.interval
+        self.next_run = self.next_tick + random.uniform(0, self.jitter)
+        return n_missed
+
+    @property
+    def running(self):
+        return self.future is not None and not self.future.done()
+
+
+class Scheduler:
+    """
+    Runs Jobs in a small thread pool until stopped. A job whose previous run is still going when its next tick comes
+    is skipped for that tick instead of being run twice at once; other jobs carry on unaffected. An exception in a
+    run is logged and the job keeps its schedule.
+    """
+    def __init__(self, jobs, logger=None, max_workers=None, metrics=None, clock=time.monotonic, sleep=None):
+        """
+        :param jobs: list of Jobs
+        :param logger: optional logging.Logger
+        :param max_workers: integer giving the number of jobs allowed to run at once. Defaults to one per job
+        :param metrics: optional metrics.Metrics to report run times to; flushed after every run
+        :param clock: function returning the current time in seconds, monotonic. Defaults to time.monotonic
+        :param sleep: function waiting up to a number of seconds between ticks. Defaults to waiting on the stop event,
+                      so stop() wakes the scheduler straight away. Pass both to run on a simulated clock
+        """
+        self.jobs = list(jobs)
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.max_workers = max_workers or max(len(self.jobs), 1)
+        self._stop = threading.Event()
+        self.clock = clock
+        self._sleep = sleep if sleep is not None else self._stop.wait
+
+    def stop(self, *args):
+        """
+        Asks the scheduler to stop; runs in progress are allowed to finish. Also usable as a signal handler
+        """
+        self._stop.set()
+
+    def _run(self, job):
+        started = self.clock()
+        try:
+            job.func()
+        except Exception:
+            job.n_failed += 1
+            self.metrics.count("job_failures_total", job=job.name)
+            self.logger.exception("job {} failed".format(job.name))
+        finally:
+            job.n_runs += 1
+            job.last_duration = self.clock() - started
+            self.metrics.observe("job_seconds", job.last_duration, job=job.name)
+            self.metrics.flush()
+            self.logger.debug("job {} finished in {:.1f}s".format(job.name, job.last_duration))
+
+    def run(self, handle_signals=True, max_runtime=None):
+        """
+        Runs until stop() is called, SIGINT/SIGTERM arrives, or max_runtime passes
+        :param handle_signals: whether to install SIGINT/SIGTERM handlers that stop the scheduler cleanly. Only possible
+                               from the main thread
+        :param max_runtime: optional timedelta or seconds after which to stop
+        """
+        if handle_signals and threading.current_thread() is threading.main_thread():
+            previous = {s: signal.signal(s, self.stop) for s in (signal.SIGINT, signal.SIGTERM)}
+        else:
+            previous = {}
+        start = self.clock()
+        deadline = start + _seconds(max_runtime) if max_runtime is not None else None
+        for job in self.jobs:
+            job.schedule_first(start)
+        self.logger.info("scheduler started with job(s): " + ", ".join(
+            "{} every {:g}s".format(job.name, job.interval) for job in self.jobs))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="wile-job") as pool:
+                while not self._stop.is_set():
+                    now = self.clock()
+                    if deadline is not None and now >= deadline:
+                        break
+                    for job in self.jobs:
+                        if now < job.next_run:
+                            continue
+                        if job.running:
+                            job.n_skipped += 1
+                            self.metrics.count("job_skips_total", job=job.name)
+                            self.logger.warning("job {} is still running from its last tick; skipping this one"
+                                                .format(job.name))
+                        else:
+                            job.future = pool.submit(self._run, job)
+                        n_missed = job.advance(now)
+                        if n_missed:
+                            job.n_skipped += n_missed
+                            self.logger.warning("job {} fell {} tick(s) behind; they were dropped".format(job.name,
+                                                                                                        n_missed))
+                    wake = min(job.next_run for job in self.jobs) if self.jobs else now + 1
+                    if deadline is not None:
+                        wake = min(wake, deadline)
+                    self._sleep(max(wake - self.clock(), 0))
+                self.logger.info("scheduler stopping; waiting for runs in progress to finish")
+        finally:
+            for s, handler in previous.items():
+                signal.signal(s, handler)
+        self.logger.info("scheduler stopped: " + ", ".join(
+            "{} ran {} ({} failed, {} skipped)".format(job.name, job.n_runs, job.n_failed, job.n_skipped)
+            for job in self.jobs))
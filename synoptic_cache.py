@@ -0,0 +1,253 @@
+# On-disk cache of completed synoptic request windows, so historical pulls can resume and only fetch what's new.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import synoptic_fetch
+
+CACHE_TIME_FORMAT = "%Y%m%d%H%M"  # how window bounds are stored in the manifest; sorts correctly as text
+SYNOPTIC_OBS_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"  # format of OBSERVATIONS.date_time in synoptic responses
+
+
+def series_key(endpoint, args):
+    """
+    Builds the key that identifies one "series" of cached windows: the same endpoint asked for the same variables over
+    the same region with the same units. The token and the time bounds are deliberately left out.
+    :param endpoint: string giving the synoptic endpoint, such as 'stations/timeseries'
+    :param args: dictionary giving the request arguments
+    :return: key, a hex string
+    """
+    kept = {k: v for k, v in args.items() if k.lower() not in ("token", "syn_token", "start", "end")}
+    canonical = json.dumps({"endpoint": endpoint, "args": kept}, sort_keys=True)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def _merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(i) for i in merged]
+
+
+def trim_stations(station_list, start_dt, end_dt):
+    """
+    Drops observations outside [start_dt, end_dt] from each station, in place. Cached windows don't line up with the
+    range a caller asks for, so whatever spills over the edges is cut off here.
+    :param station_list: list of station dicts shaped like a synoptic timeseries 'STATION' list
+    :param start_dt: datetime giving the earliest time to keep
+    :param end_dt: datetime giving the latest time to keep
+    :return: station_list, with stations that have nothing left removed
+    """
+    lo = start_dt.strftime(SYNOPTIC_OBS_TIME_FORMAT)
+    hi = end_dt.strftime(SYNOPTIC_OBS_TIME_FORMAT)
+    kept_stations = []
+    for station in station_list:
+        obs = station.get("OBSERVATIONS", {})
+        times = obs.get("date_time") or []
+        keep = [i for i, t in enumerate(times) if lo <= t <= hi]
+        if not keep:
+            continue
+        if len(keep) != len(times):
+            for arrays in (obs, station.get("QC") or {}):
+                for key, vals in arrays.items():
+                    if isinstance(vals, list) and len(vals) == len(times):
+                        arrays[key] = [vals[i] for i in keep]
+        kept_stations.append(station)
+    return kept_stations
+
+
+class FetchCache:
+    """
+    Keeps every completed request window on disk as a gzipped JSON file, with a small SQLite manifest recording which
+    windows of which series are done. A pull asks for the gaps in the manifest, fetches only those, and reads the rest
+    back from disk.
+
+    Windows that end too close to the time they were fetched are stored but not counted as complete, since stations
+    keep reporting late data for a while; they get fetched again on the next run.
+
+    Each window also records whether its data has been ingested into the stores yet. A window is saved as soon as it
+    arrives but only stored once the whole pull is, so a pull interrupted in between leaves complete windows that
+    pending() hands to the next run instead of losing them.
+    """
+    def __init__(self, cache_dir, settle=timedelta(hours=2)):
+        """
+        :param cache_dir: string giving the full path of the directory to keep the cache in
+        :param settle: timedelta giving how long after a window ends before its data is treated as final
+        """
+        self.cache_dir = cache_dir
+        self.settle = settle
+        self.manifest_path = os.path.join(cache_dir, "manifest.sqlite")
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS windows ("
+                         "series TEXT NOT NULL, start TEXT NOT NULL, end TEXT NOT NULL, path TEXT NOT NULL, "
+                         "n_rows INTEGER, final INTEGER NOT NULL, fetched_at TEXT NOT NULL, "
+                         "ingested INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (series, start, end))")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(windows)")]
+            if "ingested" not in columns:
+                # manifests from before the column existed: their windows are ingested again, once, on the next pull
+                conn.execute("ALTER TABLE windows ADD COLUMN ingested INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self):
+        return sqlite3.connect(self.manifest_path, timeout=30)
+
+    def put(self, series, start_dt, end_dt, chunk_dict, fetched_at=None):
+        """
+        Saves one completed window, not yet ingested. The file is written under a temporary name and renamed into place
+        before the manifest row goes in, so a crash can never leave the manifest pointing at a half-written file.
+        :param series: string giving the series key from series_key()
+        :param start_dt: datetime giving the start of the window
+        :param end_dt: datetime giving the end of the window
+        :param chunk_dict: dictionary giving the decoded synoptic response for the window
+        :param fetched_at: datetime (UTC) the window was fetched at. Defaults to now
+        :return: none
+        """
+        fetched_at = fetched_at if fetched_at is not None else datetime.utcnow()
+        start = start_dt.strftime(CACHE_TIME_FORMAT)
+        end = end_dt.strftime(CACHE_TIME_FORMAT)
+
+        series_dir = os.path.join(self.cache_dir, series)
+        os.makedirs(series_dir, exist_ok=True)
+        path = os.path.join(series_dir, "{}_{}.json.gz".format(start, end))
+        tmp_path = "{}.{}.{}.part".format(path, os.getpid(), threading.get_ident())  # unique per writer
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(chunk_dict, f)
+        os.replace(tmp_path, path)
+
+        final = end_dt + self.settle <= fetched_at
+        with self._connect() as conn:
+            # provisional windows this one supersedes are dropped so their stale copy of the data doesn't linger
+            stale = conn.execute("SELECT path FROM windows WHERE series = ? AND final = 0 AND start >= ? AND end <= ? "
+                                 "AND NOT (start = ? AND end = ?)", (series, start, end, start, end)).fetchall()
+            conn.execute("DELETE FROM windows WHERE series = ? AND final = 0 AND start >= ? AND end <= ? "
+                         "AND NOT (start = ? AND end = ?)", (series, start, end, start, end))
+            conn.execute("INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                         (series, start, end, os.path.relpath(path, self.cache_dir),
+                          synoptic_fetch.count_observations(chunk_dict), int(final),
+                          fetched_at.strftime(CACHE_TIME_FORMAT)))
+        for (stale_path,) in stale:
+            try:
+                os.remove(os.path.join(self.cache_dir, stale_path))
+            except FileNotFoundError:
+                pass
+
+    def _windows(self, series, start_dt, end_dt, final_only, pending_only=False):
+        query = "SELECT start, end, path FROM windows WHERE series = ? AND end >= ? AND start <= ?"
+        if final_only:
+            query += " AND final = 1"
+        if pending_only:
+            query += " AND ingested = 0"
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY start", (series,
+                                                            start_dt.strftime(CACHE_TIME_FORMAT),
+                                                            end_dt.strftime(CACHE_TIME_FORMAT))).fetchall()
+        return [(datetime.strptime(s, CACHE_TIME_FORMAT), datetime.strptime(e, CACHE_TIME_FORMAT), p)
+                for s, e, p in rows]
+
+    def gaps(self, series, start_dt, end_dt):
+        """
+        Works out which parts of a range still have to be fetched
+        :param series: string giving the series key from series_key()
+        :param start_dt: datetime giving the start of the range
+        :param end_dt: datetime giving the end of the range
+        :return: gaps, a list of (start datetime, end datetime) tuples not covered by any final cached window
+        """
+        covered = _merge_intervals((s, e) for s, e, _ in self._windows(series, start_dt, end_dt, final_only=True))
+        gaps = []
+        cursor = start_dt
+        for s, e in covered:
+            if s > cursor:
+                gaps.append((cursor, s))
+            cursor = max(cursor, e)
+        if cursor < end_dt:
+            gaps.append((cursor, end_dt))
+        return gaps
+
+    def last_complete(self, series):
+        """
+        :param series: string giving the series key from series_key()
+        :return: datetime giving the end of the newest final window, or None if nothing is cached yet
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(end) FROM windows WHERE series = ? AND final = 1", (series,)).fetchone()
+        return datetime.strptime(row[0], CACHE_TIME_FORMAT) if row[0] else None
+
+    def load(self, series, start_dt, end_dt):
+        """
+        Reads every cached window overlapping a range back off disk and merges them
+        :param series: string giving the series key from series_key()
+        :param start_dt: datetime giving the start of the range
+        :param end_dt: datetime giving the end of the range
+        :return: resp_dict, a dictionary shaped like a single synoptic timeseries response covering the range
+        """
+        stations = {}
+        units = {}
+        for _, _, path in self._windows(series, start_dt, end_dt, final_only=False):
+            with gzip.open(os.path.join(self.cache_dir, path), "rt", encoding="utf-8") as f:
+                chunk_dict = json.load(f)
+            units.update(chunk_dict.get("UNITS", {}))
+            synoptic_fetch.merge_station_chunk(stations, chunk_dict)
+        station_list = trim_stations(synoptic_fetch.finalize_stations(stations), start_dt, end_dt)
+        return {"UNITS": units,
+                "STATION": station_list,
+                "SUMMARY": {"RESPONSE_CODE": 1, "NUMBER_OF_OBJECTS": len(station_list)}}
+
+    def pending(self, series, start_dt, end_dt):
+        """
+        Finds the final windows overlapping a range whose data was cached but never ingested, because the pull that
+        fetched them was interrupted before it stored anything. Provisional windows aren't included; they're fetched
+        again anyway.
+        :param series: string giving the series key from series_key()
+        :param start_dt: datetime giving the start of the range
+        :param end_dt: datetime giving the end of the range
+        :return: windows, a list of (start datetime, end datetime) tuples
+        """
+        return [(s, e) for s, e, _ in self._windows(series, start_dt, end_dt, final_only=True, pending_only=True)]
+
+    def load_windows(self, series, windows):
+        """
+        Reads particular cached windows back off disk, whole, and merges them
+        :param series: string giving the series key from series_key()
+        :param windows: list of (start datetime, end datetime) tuples, as from pending()
+        :return: resp_dict, a dictionary shaped like a single synoptic timeseries response covering the windows
+        """
+        stations = {}
+        units = {}
+        with self._connect() as conn:
+            paths = [conn.execute("SELECT path FROM windows WHERE series = ? AND start = ? AND end = ?",
+                                  (series, s.strftime(CACHE_TIME_FORMAT), e.strftime(CACHE_TIME_FORMAT))).fetchone()
+                     for s, e in windows]
+        for row in paths:
+            if row is None:
+                continue  # superseded since it was listed
+            with gzip.open(os.path.join(self.cache_dir, row[0]), "rt", encoding="utf-8") as f:
+                chunk_dict = json.load(f)
+            units.update(chunk_dict.get("UNITS", {}))
+            synoptic_fetch.merge_station_chunk(stations, chunk_dict)
+        station_list = synoptic_fetch.finalize_stations(stations)
+        return {"UNITS": units,
+                "STATION": station_list,
+                "SUMMARY": {"RESPONSE_CODE": 1, "NUMBER_OF_OBJECTS": len(station_list)}}
+
+    def mark_ingested(self, series, windows):
+        """
+        Records that windows' data has been written to the stores, so pending() stops handing them out. Call this only
+        once the writes have succeeded.
+        :param series: string giving the series key from series_key()
+        :param windows: list of (start datetime, end datetime) tuples
+        :return: none
+        """
+        with self._connect() as conn:
+            conn.executemany("UPDATE windows SET ingested = 1 WHERE series = ? AND start = ? AND end = ?",
+                             [(series, s.strftime(CACHE_TIME_FORMAT), e.strftime(CACHE_TIME_FORMAT))
+                              for s, e in windows])
@@ -0,0 +1,172 @@
+# Decodes synoptic STATION/OBSERVATIONS payloads straight into typed NumPy columns, skipping pd.json_normalize.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# synoptic names observation keys <variable>_set_<n> in timeseries responses and <variable>_value_<n> in latest
+# responses; a trailing 'd' marks a derived value (e.g. dew_point_temperature_set_1d). value_<n> and set_<n> are the
+# same sensor, so both decode to the set name set_<n> and an observation has one key whichever endpoint it came from
+OBS_KEY_PATTERN = re.compile(r"^(?P<variable>.+)_(set|value)_(?P<number>\d+d?)$")
+
+STATION_COLUMNS = {"LATITUDE": np.float64, "LONGITUDE": np.float64, "ELEVATION": np.float32}
+
+
+def split_obs_key(key):
+    """
+    Splits an observation key into its variable and sensor set
+    :param key: string such as 'air_temp_set_1' or 'dew_point_temperature_value_1d'
+    :return: (variable, set) tuple of strings, or None if the key isn't an observation key (e.g. 'date_time'). The set
+             is always named set_<n>: 'dew_point_temperature_value_1d' gives ('dew_point_temperature', 'set_1d')
+    """
+    match = OBS_KEY_PATTERN.match(key)
+    if match is None:
+        return None
+    return match.group("variable"), "set_" + match.group("number")
+
+
+def _wanted(key, parts, wanted):
+    # a key asked for in either naming matches both, so 'air_temp_value_1' picks set_1 out of a timeseries response
+    return (wanted is None or parts[0] in wanted or key in wanted or "{}_{}".format(*parts) in wanted or
+            "{}_value_{}".format(parts[0], parts[1][4:]) in wanted)
+
+
+def _to_float(values, n):
+    """
+    Converts a list of numbers/None to a float32 array with NaN for missing. Returns None for non-numeric variables
+    like wind_cardinal_direction, which the tidy table doesn't carry.
+    """
+    try:
+        return np.fromiter((np.nan if v is None else v for v in values), dtype=np.float32, count=n)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_times(times):
+    """
+    Converts synoptic ISO timestamps ('2024-01-01T00:00:00Z') to datetime64[s] in UTC
+    """
+    # dropping the trailing 'Z' keeps numpy from warning about timezone-aware strings; everything is UTC anyway
+    return np.array(times, dtype="U19").astype("datetime64[s]")
+
+
+def _qc_mask(station, key, n):
+    """
+    Builds the per-value QC flag for one observation set. Uses the per-timestep QC arrays if the request asked for
+    them (qc_checks), otherwise falls back to the station-wide QC_FLAGGED flag.
+    """
+    qc = station.get("QC")
+    if qc and key in qc and qc[key] is not None:
+        flags = qc[key]
+        return np.fromiter((bool(f) for f in flags), dtype=bool, count=n)
+    flagged = station.get("QC_FLAGGED")
+    return np.full(n, flagged is True or flagged == "TRUE", dtype=bool)
+
+
+def decode_stations(station_list):
+    """
+    Builds a station table with one row per station and typed coordinate columns
+    :param station_list: list of station dicts from a synoptic response's 'STATION' key
+    :return: pandas DataFrame indexed by STID with NAME, LATITUDE, LONGITUDE, ELEVATION and QC_FLAGGED columns
+    """
+    columns = {"STID": [s["STID"] for s in station_list],
+               "NAME": [s.get("NAME") for s in station_list]}
+    for col, dtype in STATION_COLUMNS.items():
+        columns[col] = pd.to_numeric(pd.Series([s.get(col) for s in station_list], dtype=object),
+                                     errors="coerce").to_numpy(dtype=dtype)
+    columns["QC_FLAGGED"] = np.array([s.get("QC_FLAGGED") is True or s.get("QC_FLAGGED") == "TRUE"
+                                      for s in station_list], dtype=bool)
+    return pd.DataFrame(columns).set_index("STID")
+
+
+def decode_observations(station_list, variables=None):
+    """
+    Decodes the observations of a synoptic response into a tidy long table with one row per (station, time, variable,
+    set). Works on both timeseries responses (arrays under OBSERVATIONS) and latest responses (one value/date_time pair
+    per key). Only the requested variables are ever converted; everything else is skipped without being touched.
+    :param station_list: list of station dicts from a synoptic response's 'STATION' key
+    :param variables: optional collection of variable names ('air_temp') or full observation keys ('air_temp_set_1')
+                      to keep. Defaults to every numeric variable in the response
+    :return: pandas DataFrame with columns station (categorical), time (datetime64, UTC), variable (categorical), set
+             (categorical), value (float32) and qc (bool, True where the value was flagged)
+    """
+    wanted = set(variables) if variables is not None else None
+
+    stids = {}  # STID -> integer code
+    var_names = {}  # variable name -> integer code
+    set_names = {}  # set name -> integer code
+    station_codes, time_parts, var_codes, set_codes, value_parts, qc_parts = [], [], [], [], [], []
+
+    def add(station_code, variable, set_name, times, values, qc):
+        n = len(values)
+        station_codes.append(np.full(n, station_code, dtype=np.int32))
+        var_codes.append(np.full(n, var_names.setdefault(variable, len(var_names)), dtype=np.int16))
+        set_codes.append(np.full(n, set_names.setdefault(set_name, len(set_names)), dtype=np.int16))
+        time_parts.append(times)
+        value_parts.append(values)
+        qc_parts.append(qc)
+
+    for station in station_list:
+        obs = station.get("OBSERVATIONS") or {}
+        station_code = stids.setdefault(station["STID"], len(stids))
+
+        if "date_time" in obs:  # timeseries response: parallel arrays sharing one date_time array
+            n = len(obs["date_time"])
+            if n == 0:
+                continue
+            times = None  # only parsed once we know at least one wanted variable is present
+            for key, vals in obs.items():
+                parts = split_obs_key(key)
+                if parts is None or not _wanted(key, parts, wanted):
+                    continue
+                values = _to_float(vals, n)
+                if values is None:
+                    continue
+                if times is None:
+                    times = _to_times(obs["date_time"])
+                add(station_code, parts[0], parts[1], times, values, _qc_mask(station, key, n))
+        else:  # latest response: one {value, date_time} dict per key
+            for key, entry in obs.items():
+                parts = split_obs_key(key)
+                if parts is None or not isinstance(entry, dict) or not _wanted(key, parts, wanted):
+                    continue
+                values = _to_float([entry.get("value")], 1)
+                if values is None or entry.get("date_time") is None:
+                    continue
+                add(station_code, parts[0], parts[1], _to_times([entry["date_time"]]), values,
+                    _qc_mask(station, key, 1))
+
+    if not value_parts:
+        return pd.DataFrame({"station": pd.Categorical([]),
+                             "time": np.array([], dtype="datetime64[s]"),
+                             "variable": pd.Categorical([]),
+                             "set": pd.Categorical([]),
+                             "value": np.array([], dtype=np.float32),
+                             "qc": np.array([], dtype=bool)})
+
+    return pd.DataFrame({
+        "station": pd.Categorical.from_codes(np.concatenate(station_codes), categories=list(stids)),
+        "time": np.concatenate(time_parts),
+        "variable": pd.Categorical.from_codes(np.concatenate(var_codes), categories=list(var_names)),
+        "set": pd.Categorical.from_codes(np.concatenate(set_codes), categories=list(set_names)),
+        "value": np.concatenate(value_parts),
+        "qc": np.concatenate(qc_parts),
+    })
+
+
+def obs_keys_from_columns(columns):
+    """
+    Pulls the observation keys out of json_normalize-style column names, so the existing SYNOPTIC_RESPONSE_COLUMNS
+    setting can still pick which sets to keep
+    :param columns: list of strings such as 'OBSERVATIONS.air_temp_value_1.value'
+    :return: list of observation keys such as 'air_temp_value_1'
+    """
+    keys = []
+    for col in columns:
+        parts = col.split(".")
+        if len(parts) == 3 and parts[0] == "OBSERVATIONS" and parts[1] not in keys:
+            keys.append(parts[1])
+    return keys
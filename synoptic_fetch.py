@@ -0,0 +1,445 @@
+# Concurrent fetch engine for the Synoptic timeseries endpoint, used by wile.pull_synoptic_hist().
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import NULL_METRICS
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)  # HTTP status codes worth retrying; everything else is a hard failure
+SYNOPTIC_NO_DATA_CODE = 2  # SUMMARY.RESPONSE_CODE synoptic sends back when a window simply has no observations
+
+
+class SynopticFetchError(Exception):
+    """
+    Raised when a synoptic request fails for good, either because retries ran out or because the API gave an error
+    that retrying won't fix (bad token, malformed args, etc.)
+    """
+    pass
+
+
+def make_session(pool_size):
+    """
+    Creates a requests Session whose connection pool is big enough that every worker thread keeps its own keep-alive
+    connection to the synoptic API
+    :param pool_size: integer giving the number of connections to keep open; should be >= number of worker threads
+    :return: session, a requests.Session object
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept": "application/json"})
+    return session
+
+
+def split_range(start_dt, end_dt, chunk):
+    """
+    Splits a time range into back-to-back windows of a fixed size. The last window is clipped to end_dt.
+    :param start_dt: datetime giving the beginning of the range
+    :param end_dt: datetime giving the end of the range
+    :param chunk: timedelta giving the size of each window
+    :return: windows, a list of (start datetime, end datetime) tuples in chronological order
+    """
+    windows = []
+    window_start = start_dt
+    while window_start < end_dt:
+        window_end = min(window_start + chunk, end_dt)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
+def count_observations(resp_dict):
+    """
+    Counts the (station, time) rows in a timeseries response without decoding any of the values
+    :param resp_dict: dictionary giving one decoded synoptic timeseries response
+    :return: integer giving the total number of timesteps across all stations
+    """
+    return sum(len(st.get("OBSERVATIONS", {}).get("date_time") or []) for st in resp_dict.get("STATION", []))
+
+
+class WindowPlanner:
+    """
+    Hands out request windows for a timeseries backfill, sizing each one from how dense the data has been so far so
+    that every response lands under a byte and row budget. Windows are planned newest first: recent years are dense
+    and get split finely, and as the backfill walks back into sparse eras the windows widen to weeks or months.
+    A response that still comes back over budget is rejected by observe() and its window handed out again in pieces
+    sized to the density it showed, so the budget holds for every window kept. Only a window already at min_window is
+    kept over budget, since it can't be split any further.
+    Safe to share between worker threads.
+    """
+    def __init__(self,
+                 start_dt,
+                 end_dt,
+                 max_bytes=16 * 2 ** 20,  # largest response body we want to hold/parse at once
+                 max_rows=200000,  # largest number of (station, time) rows we want in one response
+                 initial_window=timedelta(hours=6),  # size of the first window, before anything has been observed
+                 min_window=timedelta(hours=1),
+                 max_window=timedelta(days=366),
+                 max_growth=8.0,  # a window may be at most this many times wider than the one before it
+                 fill=0.75):  # fraction of the budget to aim for, leaving headroom for density changing mid-window
+        self.start_dt = start_dt
+        self.end_dt = end_dt
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_growth = max_growth
+        self.fill = fill
+
+        self.window = min(max(initial_window, min_window), max_window)  # size of the next window to hand out
+        self.n_planned = 0
+        self.n_over_budget = 0  # how many responses came back bigger than the budget
+        self.n_resplit = 0  # how many of those were rejected and handed out again in pieces
+        self.peak_bytes = 0
+        self._cursor = end_dt  # end of the next window to hand out
+        self._redo = []  # pieces of over-budget windows, handed out before anything new
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        :return: True once windows covering the whole range have been handed out
+        """
+        with self._lock:
+            return self._cursor <= self.start_dt and not self._redo
+
+    def next_window(self):
+        """
+        :return: the next (start datetime, end datetime) window to request, or None once the range is covered
+        """
+        with self._lock:
+            if self._redo:
+                self.n_planned += 1
+                return self._redo.pop()
+            if self._cursor <= self.start_dt:
+                return None
+            window_start = max(self._cursor - self.window, self.start_dt)
+            window = (window_start, self._cursor)
+            self._cursor = window_start
+            self.n_planned += 1
+            return window
+
+    def observe(self, window, n_bytes, n_rows):
+        """
+        Feeds the size of a finished response back into the planner so later windows can be sized to the budget. An
+        over-budget response wider than min_window is rejected: its window is split into pieces that next_window()
+        hands out again, and the caller should drop the response.
+        :param window: (start datetime, end datetime) tuple the response covers
+        :param n_bytes: integer giving the size of the response body in bytes
+        :param n_rows: integer giving the number of (station, time) rows in the response
+        :return: True if the response should be kept, False if its window was re-split
+        """
+        span_hours = max((window[1] - window[0]).total_seconds() / 3600, 1.0)
+        bytes_per_hour = n_bytes / span_hours
+        rows_per_hour = n_rows / span_hours
+
+        # widest window that keeps both the byte and the row count under budget at the density just observed
+        target_hours = float("inf")
+        if bytes_per_hour > 0:
+            target_hours = min(target_hours, self.fill * self.max_bytes / bytes_per_hour)
+        if rows_per_hour > 0:
+            target_hours = min(target_hours, self.fill * self.max_rows / rows_per_hour)
+
+        with self._lock:
+            self.peak_bytes = max(self.peak_bytes, n_bytes)
+            if n_bytes > self.max_bytes or n_rows > self.max_rows:
+                self.n_over_budget += 1
+            ceiling = min(self.max_window, timedelta(hours=self.window.total_seconds() / 3600 * self.max_growth))
+            if target_hours == float("inf"):
+                new_window = ceiling  # nothing came back at all; open right up
+            else:
+                new_window = timedelta(hours=max(int(target_hours), 1))  # keep windows on whole hours
+            self.window = min(max(new_window, self.min_window), ceiling)
+            if (n_bytes > self.max_bytes or n_rows > self.max_rows) and window[1] - window[0] > self.min_window:
+                # at least two pieces, each no wider than the density just seen allows
+                piece_hours = max(min(int(self.window.total_seconds() // 3600), int(span_hours // 2)), 1)
+                pieces = split_range(window[0], window[1], max(timedelta(hours=piece_hours), self.min_window))
+                self._redo.extend(pieces)  # popped from the end, so the newest piece goes out first
+                self.n_resplit += 1
+                return False
+            return True
+
+
+def _extend_aligned(old, new, n_old, n_new):
+    """
+    Concatenates two dicts of equal-length lists key by key. A key missing on one side is padded with None so every
+    list stays aligned with date_time.
+    """
+    for key in set(old) | set(new):
+        old_vals = old.get(key)
+        new_vals = new.get(key)
+        if not isinstance(old_vals, list) and old_vals is not None:
+            continue  # not a per-timestep array (shouldn't happen for timeseries, but don't mangle it if it does)
+        if old_vals is None:
+            old_vals = [None] * n_old
+        if new_vals is None:
+            new_vals = [None] * n_new
+        old[key] = old_vals + list(new_vals)
+
+
+def merge_station_chunk(stations, chunk_dict):
+    """
+    Merges the STATION list of one timeseries response into an accumulator keyed by station ID. Stations seen for the
+    first time are added whole; stations already present get their OBSERVATIONS (and QC, if present) arrays extended.
+    :param stations: dictionary of STID -> station dict, updated in place
+    :param chunk_dict: dictionary giving one decoded synoptic timeseries response
+    :return: none
+    """
+    for station in chunk_dict.get("STATION", []):
+        stid = station["STID"]
+        obs = station.get("OBSERVATIONS", {})
+        if stid not in stations:
+            stations[stid] = station
+            continue
+
+        merged = stations[stid]
+        merged_obs = merged.setdefault("OBSERVATIONS", {})
+        n_old = len(merged_obs.get("date_time", []))
+        n_new = len(obs.get("date_time", []))
+        _extend_aligned(merged_obs, obs, n_old, n_new)
+        if "QC" in station or "QC" in merged:
+            _extend_aligned(merged.setdefault("QC", {}), station.get("QC") or {}, n_old, n_new)
+
+
+def finalize_stations(stations):
+    """
+    Puts each station's observation arrays in chronological order and drops duplicate timestamps, which show up
+    because synoptic treats both ends of a window as inclusive.
+    :param stations: dictionary of STID -> station dict as built by merge_station_chunk()
+    :return: station_list, a list of station dicts in the same shape synoptic returns under 'STATION'
+    """
+    for station in stations.values():
+        obs = station.get("OBSERVATIONS", {})
+        times = obs.get("date_time")
+        if not times:
+            continue
+        # ISO-8601 timestamps in a single timezone sort correctly as strings
+        order = sorted(range(len(times)), key=times.__getitem__)
+        keep = []
+        last = None
+        for i in order:
+            if times[i] != last:
+                keep.append(i)
+                last = times[i]
+        if keep == list(range(len(times))):
+            continue  # already sorted and unique
+        for arrays in (obs, station.get("QC") or {}):
+            for key, vals in arrays.items():
+                if isinstance(vals, list) and len(vals) == len(times):
+                    arrays[key] = [vals[i] for i in keep]
+    return list(stations.values())
+
+
+class SynopticFetcher:
+    """
+    Fetches many time windows from a synoptic endpoint at once through a bounded thread pool sharing one pooled
+    keep-alive session. Rate limiting (HTTP 429) pauses every worker, not just the one that got throttled.
+    """
+    def __init__(self,
+                 url,
+                 base_args,
+                 time_format="%Y%m%d%H%M",
+                 max_workers=8,
+                 max_retries=5,
+                 backoff_base=1.0,  # seconds to wait before the first retry; doubles every retry after that
+                 backoff_cap=60.0,  # longest single wait between retries, in seconds
+                 timeout=120,  # seconds to wait on any one request
+                 session=None,
+                 logger=None,
+                 metrics=None):
+        self.url = url
+        self.base_args = dict(base_args)
+        self.time_format = time_format
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.session = session if session is not None else make_session(max_workers)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+
+        # when the API rate limits us, every worker waits until this monotonic timestamp before its next request
+        self._pause_until = 0.0
+        self._pause_lock = threading.Lock()
+
+    def _wait_for_pause(self):
+        with self._pause_lock:
+            delay = self._pause_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pause_all(self, delay):
+        with self._pause_lock:
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+
+    def _backoff(self, attempt, retry_after=None):
+        """
+        Works out how long to wait before the next attempt. Honors a Retry-After header if the server sent one,
+        otherwise uses capped exponential backoff with full jitter so workers don't retry in lockstep.
+        """
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.backoff_cap)
+            except ValueError:
+                pass  # Retry-After can also be an HTTP date; fall back to our own schedule
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def fetch_window(self, start_dt, end_dt, extra_args=None):
+        """
+        Requests one time window, retrying on rate limiting, server errors, and dropped connections
+        :param start_dt: datetime giving the start of the window (UTC)
+        :param end_dt: datetime giving the end of the window (UTC)
+        :param extra_args: optional dictionary of request arguments layered on top of base_args
+        :return: resp_dict, the decoded synoptic response; a window with no data gives a response with no stations
+        """
+        return self._fetch(start_dt, end_dt, extra_args)[0]
+
+    def _fetch(self, start_dt, end_dt, extra_args=None):
+        """
+        Does the work for fetch_window(), also handing back the size of the response body in bytes
+        """
+        args = dict(self.base_args)
+        if extra_args:
+            args.update(extra_args)
+        args["START"] = start_dt.strftime(self.time_format)
+        args["END"] = end_dt.strftime(self.time_format)
+
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_pause()
+            retry_after = None
+            try:
+                with self.metrics.timer("request_seconds", source="synoptic", endpoint="timeseries"):
+                    resp = self.session.get(self.url, params=args, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                reason = repr(e)
+            else:
+                self.metrics.count("request_bytes_total", len(resp.content), source="synoptic", endpoint="timeseries")
+                if resp.status_code == 200:
+                    resp_dict = resp.json()
+                    code = resp_dict.get("SUMMARY", {}).get("RESPONSE_CODE", 1)
+                    if code == 1 or code == SYNOPTIC_NO_DATA_CODE:
+                        resp_dict.setdefault("STATION", [])
+                        return resp_dict, len(resp.content)
+                    raise SynopticFetchError("synoptic error for {}-{}: {}".format(
+                        args["START"], args["END"], resp_dict.get("SUMMARY", {}).get("RESPONSE_MESSAGE")))
+                if resp.status_code not in RETRY_STATUS_CODES:
+                    raise SynopticFetchError("HTTP {} for {}-{}: {}".format(
+                        resp.status_code, args["START"], args["END"], resp.text[:200]))
+                reason = "HTTP {}".format(resp.status_code)
+                retry_after = resp.headers.get("Retry-After")
+
+            if attempt == self.max_retries:
+                break
+            self.metrics.count("retries_total", source="synoptic")
+            delay = self._backoff(attempt, retry_after)
+            if retry_after is not None or reason == "HTTP 429":
+                self._pause_all(delay)  # rate limited: everybody backs off, not just this worker
+            self.logger.debug("retrying window {}-{} in {:.1f}s ({})".format(args["START"], args["END"], delay, reason))
+            time.sleep(delay)
+
+        raise SynopticFetchError("gave up on window {}-{} after {} retries ({})".format(
+            args["START"], args["END"], self.max_retries, reason))
+
+    def fetch_range(self, windows, extra_args=None):
+        """
+        Fetches a list of time windows concurrently and merges them into a single response
+        :param windows: list of (start datetime, end datetime) tuples
+        :param extra_args: optional dictionary of request arguments layered on top of base_args for every window
+        :return: resp_dict, a dictionary shaped like a single synoptic timeseries response covering all windows
+        """
+        stations = {}
+        units = {}
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.fetch_window, s, e, extra_args): (s, e) for s, e in windows}
+            for future in as_completed(futures):
+                try:
+                    chunk_dict = future.result()  # re-raises SynopticFetchError from the worker
+                except Exception:
+                    for f in futures:
+                        f.cancel()  # don't keep hammering the API once the pull has already failed
+                    raise
+                units.update(chunk_dict.get("UNITS", {}))
+                merge_station_chunk(stations, chunk_dict)
+                done += 1
+                self.metrics.gauge("queue_depth", len(windows) - done, queue="synoptic_windows")
+                self.logger.debug("retrieved window {} of {}".format(done, len(windows)))
+
+        station_list = finalize_stations(stations)
+        return {"UNITS": units,
+                "STATION": station_list,
+                "SUMMARY": {"RESPONSE_CODE": 1, "NUMBER_OF_OBJECTS": len(station_list)}}
+
+    def fetch_planned(self, planner, extra_args=None, on_window=None, keep=True):
+        """
+        Fetches a whole range with window sizes chosen on the fly by a WindowPlanner. Keeps max_workers windows in
+        flight; every time one finishes its size is fed back to the planner before the next window is planned.
+        :param planner: WindowPlanner covering the range to fetch
+        :param extra_args: optional dictionary of request arguments layered on top of base_args for every window
+        :param on_window: optional function called as on_window(start datetime, end datetime, chunk_dict) as each
+                          window arrives
+        :param keep: whether to hold on to and merge every window; pass False when on_window already stores them
+        :return: resp_dict, a dictionary shaped like a single synoptic timeseries response covering the whole range, or
+                 None if keep is False
+        """
+        stations = {}
+        units = {}
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            def submit_more():
+                # tops the pool back up; a re-split window can free up more than one slot's worth of work
+                while len(futures) < self.max_workers:
+                    window = planner.next_window()
+                    if window is None:
+                        return
+                    futures[pool.submit(self._fetch, window[0], window[1], extra_args)] = window
+
+            submit_more()
+
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    window = futures.pop(future)
+                    try:
+                        chunk_dict, n_bytes = future.result()
+                    except Exception:
+                        for f in futures:
+                            f.cancel()
+                        raise
+                    n_rows = count_observations(chunk_dict)
+                    self.metrics.count("rows_fetched_total", n_rows, source="synoptic")
+                    self.metrics.gauge("queue_depth", len(futures), queue="synoptic_windows")
+                    if not planner.observe(window, n_bytes, n_rows):
+                        self.metrics.count("windows_resplit_total", source="synoptic")
+                        self.logger.debug("window {}-{} came back over budget ({} bytes, {} rows); re-fetching it "
+                                          "in pieces of at most {}".format(window[0], window[1], n_bytes, n_rows,
+                                                                           planner.window))
+                        submit_more()
+                        continue
+                    self.logger.debug("retrieved window {}-{}: {} bytes, {} rows; next window {}".format(
+                        window[0], window[1], n_bytes, n_rows, planner.window))
+                    if on_window is not None:
+                        on_window(window[0], window[1], chunk_dict)
+                    if keep:
+                        units.update(chunk_dict.get("UNITS", {}))
+                        merge_station_chunk(stations, chunk_dict)
+                    submit_more()
+
+        self.logger.debug("planned {} windows, {} over budget ({} re-split), largest response {} bytes".format(
+            planner.n_planned, planner.n_over_budget, planner.n_resplit, planner.peak_bytes))
+        if not keep:
+            return None
+        station_list = finalize_stations(stations)
+        return {"UNITS": units,
+                "STATION": station_list,
+                "SUMMARY": {"RESPONSE_CODE": 1, "NUMBER_OF_OBJECTS": len(station_list)}}
@@ -0,0 +1,201 @@
+# Region handling for synoptic pulls: turns states, bounding boxes, county sets and station lists into request
+# arguments, splits regions too big for one response, and fans requests out concurrently.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import NULL_METRICS
+from synoptic_fetch import SYNOPTIC_NO_DATA_CODE, SynopticFetchError
+
+GEO_ARGS = ("state", "county", "bbox", "stid", "cwa", "nwsfirezone", "gacc", "subgacc", "radius")  # synoptic's area
+                                                                                                    # selectors
+
+
+def region_args(region):
+    """
+    Turns one region into synoptic request arguments
+    :param region: a state code such as 'CA', or a dictionary of area selectors such as {'state': 'CA'},
+                   {'bbox': (-122.6, 37.2, -121.7, 38.0)}, {'state': 'CA', 'county': ['Napa', 'Sonoma']} or
+                   {'stid': ['KSFO', 'KOAK']}. Lists and tuples are joined with commas the way the API wants
+    :return: dictionary of request arguments
+    """
+    if isinstance(region, str):
+        if len(region) != 2 or not region.isalpha():
+            raise ValueError("{!r} isn't a two-letter state code; pass a dictionary for other kinds of region".format(
+                region))
+        return {"state": region.upper()}
+    args = {}
+    for key, value in dict(region).items():
+        if key not in GEO_ARGS:
+            raise ValueError("{!r} isn't a synoptic area selector; expected one of {}".format(key, GEO_ARGS))
+        args[key] = ",".join(str(v) for v in value) if isinstance(value, (list, tuple)) else str(value)
+    if not args:
+        raise ValueError("empty region")
+    return args
+
+
+def normalize_regions(regions):
+    """
+    :param regions: one region, or a list of them; see region_args()
+    :return: list of request-argument dictionaries, without duplicates
+    """
+    if isinstance(regions, (str, dict)):
+        regions = [regions]
+    out = []
+    for region in regions:
+        args = region_args(region)
+        if args not in out:
+            out.append(args)
+    return out
+
+
+def region_label(args):
+    """
+    :return: short readable name for a region's arguments, for logs
+    """
+    label = ";".join("{}={}".format(k, v) for k, v in sorted(args.items()))
+    return label if len(label) <= 60 else label[:57] + "..."
+
+
+def dedupe_stations(station_lists):
+    """
+    Merges the STATION lists of several responses, keeping each station once. Overlapping regions (a bbox straddling
+    a state line, say) return the same station more than once, with the same data.
+    :param station_lists: list of STATION lists
+    :return: list of station dictionaries, first occurrence of each STID wins
+    """
+    seen = set()
+    merged = []
+    for station_list in station_lists:
+        for station in station_list:
+            stid = station.get("STID")
+            if stid in seen:
+                continue
+            seen.add(stid)
+            merged.append(station)
+    return merged
+
+
+class RegionFanout:
+    """
+    Requests one endpoint over several regions at once and merges the results. A region with more stations than
+    max_stations is split into several requests over explicit station lists, so no one response grows past a size that
+    is slow to transfer and parse. The station lists come from the (much smaller) stations/metadata endpoint and are
+    cached for metadata_ttl.
+    """
+    def __init__(self, session, api_root, token_args, max_stations=500, max_workers=4, metadata_ttl=24 * 3600,
+                 timeout=120, logger=None, metrics=None):
+        """
+        :param session: requests.Session to send every request through; its pool should hold max_workers connections
+        :param api_root: string giving the synoptic API root URL
+        :param token_args: dictionary holding the token argument, added to metadata requests
+        :param max_stations: integer giving the most stations any one request may cover; also keeps the comma-joined
+                             stid list inside URL length limits
+        :param max_workers: integer giving the number of requests allowed in flight at once
+        :param metadata_ttl: seconds a region's station list is trusted before being looked up again
+        :param timeout: seconds to wait on any one request
+        :param logger: optional logging.Logger
+        :param metrics: optional metrics.Metrics to report requests to
+        """
+        self.session = session
+        self.api_root = api_root.rstrip("/") + "/"
+        self.token_args = dict(token_args)
+        self.max_stations = max_stations
+        self.max_workers = max_workers
+        self.metadata_ttl = metadata_ttl
+        self.timeout = timeout
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self._stations = {}  # region arguments -> (looked up at, list of STIDs)
+        self._lock = threading.Lock()
+
+    def _get(self, url, args):
+        endpoint = url[len(self.api_root):]
+        with self.metrics.timer("request_seconds", source="synoptic", endpoint=endpoint):
+            resp = self.session.get(url, params=args, timeout=self.timeout)
+        self.metrics.count("request_bytes_total", len(resp.content), source="synoptic", endpoint=endpoint)
+        if resp.status_code != 200:
+            raise SynopticFetchError("HTTP {} from {} for {}: {}".format(resp.status_code, url,
+                                                                         region_label(args), resp.text[:200]))
+        resp_dict = resp.json()
+        code = resp_dict.get("SUMMARY", {}).get("RESPONSE_CODE", 1)
+        if code not in (1, SYNOPTIC_NO_DATA_CODE):
+            raise SynopticFetchError("synoptic error from {} for {}: {}".format(
+                url, region_label(args), resp_dict.get("SUMMARY", {}).get("RESPONSE_MESSAGE")))
+        resp_dict.setdefault("STATION", [])
+        return resp_dict
+
+    def region_stations(self, args):
+        """
+        :return: sorted list of the active STIDs in a region
+        """
+        key = repr(sorted(args.items()))
+        with self._lock:
+            cached = self._stations.get(key)
+        if cached is not None and time.time() - cached[0] < self.metadata_ttl:
+            return cached[1]
+        meta = self._get(self.api_root + "stations/metadata", dict(args, status="active", **self.token_args))
+        stids = sorted({st["STID"] for st in meta["STATION"] if st.get("STID")})
+        with self._lock:
+            self._stations[key] = (time.time(), stids)
+        return stids
+
+    def plan(self, regions):
+        """
+        Splits regions into requests of at most max_stations stations. Station lists already small enough are left
+        alone, as are regions given as explicit station lists.
+        :param regions: list of request-argument dictionaries, as from normalize_regions()
+        :return: list of request-argument dictionaries to send
+        """
+        planned = []
+        for args in regions:
+            if "stid" in args and len(args["stid"].split(",")) <= self.max_stations:
+                planned.append(args)
+                continue
+            stids = self.region_stations(args)
+            if len(stids) <= self.max_stations:
+                planned.append(args)
+                continue
+            n_parts = -(-len(stids) // self.max_stations)
+            self.logger.debug("splitting {} ({} stations) into {} requests".format(region_label(args), len(stids),
+                                                                                   n_parts))
+            for i in range(n_parts):  # even parts, within a station of each other, rather than full ones and a runt
+                planned.append({"stid": ",".join(stids[i * len(stids) // n_parts:(i + 1) * len(stids) // n_parts])})
+        return planned
+
+    def map(self, func, regions):
+        """
+        Calls func on every region concurrently
+        :param func: function taking one request-argument dictionary
+        :param regions: list of request-argument dictionaries
+        :return: list of results, in the same order as regions
+        """
+        if len(regions) == 1:
+            return [func(regions[0])]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(regions))) as pool:
+            return list(pool.map(func, regions))
+
+    def fetch(self, endpoint, base_args, regions):
+        """
+        Requests an endpoint over every region, split as needed, and merges the responses
+        :param endpoint: string giving the endpoint, such as 'stations/latest'
+        :param base_args: dictionary of the non-area request arguments (vars, units, token, ...)
+        :param regions: list of request-argument dictionaries, as from normalize_regions()
+        :return: resp_dict, a dictionary shaped like a single synoptic response with each station once
+        """
+        planned = self.plan(regions)
+        url = self.api_root + endpoint
+        responses = self.map(lambda args: self._get(url, dict(base_args, **args)), planned)
+        units = {}
+        for resp_dict in responses:
+            units.update(resp_dict.get("UNITS", {}))
+        station_list = dedupe_stations([r["STATION"] for r in responses])
+        self.logger.debug("{} request(s) over {} region(s) returned {} station(s)".format(len(planned), len(regions),
+                                                                                         len(station_list)))
+        return {"UNITS": units,
+                "STATION": station_list,
+                "SUMMARY": {"RESPONSE_CODE": 1, "NUMBER_OF_OBJECTS": len(station_list)}}
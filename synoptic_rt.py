@@ -0,0 +1,177 @@
+# Delta poller for the synoptic stations/latest endpoint: each poll asks only for what can have changed since the last
+# one and hands back only the observations that are actually new.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import synoptic_cache
+import synoptic_decode
+from metrics import NULL_METRICS
+from synoptic_fetch import SYNOPTIC_NO_DATA_CODE, SynopticFetchError, make_session
+
+SCHEMA = [
+    # newest observation time seen per (station, variable, set), in seconds since 1970-01-01 UTC. Shared by every
+    # poller on the same state file, so a station inside two overlapping regions is only emitted once
+    "CREATE TABLE IF NOT EXISTS last_seen ("
+    "station TEXT NOT NULL, variable TEXT NOT NULL, obs_set TEXT NOT NULL, "
+    "time INTEGER NOT NULL, PRIMARY KEY (station, variable, obs_set)) WITHOUT ROWID",
+    # last successful poll of each series. State files from before validators were dropped still have etag and
+    # last_modified columns; they're left alone and unused
+    "CREATE TABLE IF NOT EXISTS polls (series TEXT PRIMARY KEY, polled_at TEXT NOT NULL)",
+]
+LOG_COLUMNS = ["station", "time", "variable", "set", "value", "qc"]
+
+# pollers for different regions run concurrently but share the state file and the logs; the check-append-save step
+# is done under this lock so two of them can't both decide the same observation is new
+_COMMIT_LOCK = threading.Lock()
+
+
+class RealtimePoller:
+    """
+    Polls stations/latest with a 'within' window covering just the time since the previous poll (plus some slack for
+    late reports), so stations that haven't reported since then aren't sent at all. No ETag/Last-Modified validators are
+    sent: the 'within' argument changes from one poll to the next, so a request never repeats and a validator could
+    never match. Of what does come back, only observations newer than the last one seen for that station/variable/set
+    are kept; those are appended to a daily CSV log that is never rewritten.
+    State lives in a small SQLite file, so polling picks up where it left off across restarts. The log is appended
+    before the state is saved: a crash in between re-emits a few rows on the next poll rather than losing them.
+    """
+    def __init__(self, url, base_args, state_path, log_dir, session=None, variables=None, max_within=timedelta(hours=2),
+                 slack=timedelta(minutes=10), timeout=120, logger=None, metrics=None):
+        """
+        :param url: string giving the full stations/latest URL
+        :param base_args: dictionary of request arguments (region, vars, units, token, ...)
+        :param state_path: string giving the full path of the state SQLite file
+        :param log_dir: string giving the directory the append-only daily logs go in
+        :param session: optional requests.Session to poll through
+        :param variables: optional list of observation keys (e.g. 'air_temp_value_1') and/or variable names to keep, as
+                          from synoptic_decode.obs_keys_from_columns(); see synoptic_decode.decode_observations()
+        :param max_within: timedelta giving the widest window asked for, used on the first poll and after long gaps
+        :param slack: timedelta added to the window to catch stations that report late
+        :param timeout: seconds to wait on the request
+        :param logger: optional logging.Logger
+        :param metrics: optional metrics.Metrics to report polls to
+        """
+        self.url = url
+        self.base_args = dict(base_args)
+        self.series = synoptic_cache.series_key(url, self.base_args)
+        self.state_path = state_path
+        self.log_dir = log_dir
+        self.session = session if session is not None else make_session(1)
+        self.variables = variables
+        self.max_within = max_within
+        self.slack = slack
+        self.timeout = timeout
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self._lock = threading.Lock()  # one poll at a time per poller
+        os.makedirs(log_dir, exist_ok=True)
+        with self._connect() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.state_path, timeout=60)
+
+    def _last_poll(self):
+        with self._connect() as conn:
+            row = conn.execute("SELECT polled_at FROM polls WHERE series = ?", (self.series,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row is not None else None
+
+    def _changed(self, obs_df):
+        """
+        :return: the rows of obs_df newer than the last time seen for their (station, variable, set). Only the keys in
+                 obs_df are looked up, through a temporary table joined against last_seen, so a poll costs what came
+                 back rather than everything ever seen
+        """
+        if len(obs_df) == 0:
+            return obs_df
+        key = ["station", "variable", "set"]
+        keys = obs_df[key].astype(str)
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE polled (station TEXT, variable TEXT, obs_set TEXT)")
+            conn.executemany("INSERT INTO polled VALUES (?, ?, ?)",
+                             keys.drop_duplicates().itertuples(index=False, name=None))
+            seen = pd.read_sql_query("SELECT l.station, l.variable, l.obs_set AS \"set\", l.time AS last_time "
+                                     "FROM polled p JOIN last_seen l ON l.station = p.station "
+                                     "AND l.variable = p.variable AND l.obs_set = p.obs_set", conn)
+        merged = keys.merge(seen, on=key, how="left")
+        obs_time = obs_df["time"].to_numpy().astype("datetime64[s]").astype(np.int64)
+        last_time = merged["last_time"].to_numpy(dtype=np.float64)
+        new = np.isnan(last_time) | (obs_time > last_time)
+        return obs_df[new].reset_index(drop=True)
+
+    def _append_log(self, new_df):
+        """
+        Appends rows to the daily log files
+        :return: list of strings giving the log files appended to
+        """
+        paths = []
+        if len(new_df) == 0:
+            return paths
+        day = new_df["time"].dt.strftime("%Y-%m-%d")
+        for d, rows in new_df[LOG_COLUMNS].groupby(day, sort=True):
+            path = os.path.join(self.log_dir, "synoptic_rt_{}.csv".format(d))
+            rows.to_csv(path, mode="a", header=not os.path.exists(path), index=False, date_format="%Y-%m-%dT%H:%M:%SZ")
+            paths.append(path)
+        return paths
+
+    def _save_state(self, new_df, polled_at):
+        with self._connect() as conn:
+            if len(new_df):
+                latest = new_df.assign(t=new_df["time"].to_numpy().astype("datetime64[s]").astype(np.int64)) \
+                    .groupby(["station", "variable", "set"], observed=True)["t"].max().reset_index()
+                conn.executemany("INSERT INTO last_seen VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT(station, variable, obs_set) DO UPDATE SET "
+                                 "time=MAX(time, excluded.time)",
+                                 [(str(r.station), str(r.variable), str(r.set), int(r.t))
+                                  for r in latest.itertuples(index=False)])
+            conn.execute("INSERT OR REPLACE INTO polls (series, polled_at) VALUES (?, ?)",
+                         (self.series, polled_at.isoformat()))
+
+    def poll(self):
+        """
+        Polls once
+        :return: (new_df, stations_df) tuple: the new observations as a tidy (station, time, variable, set, value, qc)
+                 table, and station metadata for the stations in the response (None if nothing came back)
+        """
+        with self._lock:
+            polled_at = datetime.utcnow()
+            last_poll = self._last_poll()
+            window = self.max_within if last_poll is None else min(self.max_within, polled_at - last_poll + self.slack)
+            args = dict(self.base_args, within=max(int(math.ceil(window.total_seconds() / 60)), 1))
+
+            with self.metrics.timer("request_seconds", source="synoptic", endpoint="stations/latest"):
+                resp = self.session.get(self.url, params=args, timeout=self.timeout)
+            self.metrics.count("request_bytes_total", len(resp.content), source="synoptic", endpoint="stations/latest")
+            if resp.status_code != 200:
+                raise SynopticFetchError("HTTP {} polling stations/latest: {}".format(resp.status_code,
+                                                                                      resp.text[:200]))
+            resp_dict = resp.json()
+            code = resp_dict.get("SUMMARY", {}).get("RESPONSE_CODE", 1)
+            if code not in (1, SYNOPTIC_NO_DATA_CODE):
+                raise SynopticFetchError("synoptic error polling stations/latest: {}".format(
+                    resp_dict.get("SUMMARY", {}).get("RESPONSE_MESSAGE")))
+            station_list = resp_dict.get("STATION", [])
+
+            with self.metrics.timer("parse_seconds", source="synoptic_rt"):
+                obs_df = synoptic_decode.decode_observations(station_list, variables=self.variables)
+            self.metrics.count("rows_decoded_total", len(obs_df), source="synoptic_rt")
+            with _COMMIT_LOCK, self.metrics.timer("write_seconds", store="synoptic_log"):
+                new_df = self._changed(obs_df)
+                paths = self._append_log(new_df)
+                self._save_state(new_df, polled_at)
+            self.metrics.count("rows_written_total", len(new_df), store="synoptic_log")
+            self.logger.debug("polled {} station(s) within {} min ({} bytes): {} of {} observation(s) new, logged to {} "
+                              "file(s)".format(len(station_list), args["within"], len(resp.content), len(new_df),
+                                               len(obs_df), len(paths)))
+            return new_df, synoptic_decode.decode_stations(station_list) if station_list else None
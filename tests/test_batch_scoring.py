@@ -0,0 +1,38 @@
+# Tests for batch probability scoring.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_scoring  # noqa: E402
+import gridding  # noqa: E402
+
+
+def test_scoring_part_of_a_block_keeps_the_other_parts(tmp_path):
+    grid = gridding.GridSpec([-120.0, 37.0, -119.0, 38.0], 0.5)
+    store = gridding.GridStore(str(tmp_path / "grid"), grid)
+    hours = np.arange(np.datetime64("2024-07-01T00"), np.datetime64("2024-07-02T00"))  # one 24-hour block
+    for i, hour in enumerate(hours):
+        store.write("fire_weather", hour, {"fosberg_ffwi": np.full(grid.shape, 10.0 + i, dtype=np.float32),
+                                           "hot_dry_windy": np.full(grid.shape, 50.0, dtype=np.float32)})
+    scorer = batch_scoring.BatchScorer(str(tmp_path / "probability"), store, hours_per_shard=24)
+
+    assert scorer.run(hours[:6], max_workers=1)["scored"] == 1
+    first = scorer.read(hours[:6])
+    assert scorer.run(hours[6:18], max_workers=1)["skipped"] == 1  # same block, same inputs: already scored
+    assert np.array_equal(scorer.read(hours[:6]), first)
+    assert np.isfinite(scorer.read(hours)).all()
+
+    # a changed input re-scores the block, and every hour of it survives
+    store.write("fire_weather", hours[20], {"fosberg_ffwi": np.full(grid.shape, 90.0, dtype=np.float32),
+                                            "hot_dry_windy": np.full(grid.shape, 50.0, dtype=np.float32)})
+    assert scorer.run(hours[18:], max_workers=1)["scored"] == 1
+    probability = scorer.read(hours)
+    assert np.isfinite(probability).all()
+    assert np.array_equal(probability[:6], first)
+    assert probability[20, 0, 0] > probability[19, 0, 0]
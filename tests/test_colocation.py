@@ -0,0 +1,94 @@
+# Tests for the station spatial index used to colocate satellite swaths with stations.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import colocation  # noqa: E402
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * colocation.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _brute_force(index, qlat, qlon, radius_km):
+    """
+    :return: (distance matrix, set of (query, station) pairs in range), leaving out pairs so close to the radius that
+             rounding could put them either side of it
+    """
+    dist = _haversine_km(np.asarray(qlat)[:, None], np.asarray(qlon)[:, None], index.lat[None, :],
+                         index.lon[None, :])
+    pairs = set(zip(*np.nonzero(dist <= radius_km)))
+    borderline = set(zip(*np.nonzero(np.abs(dist - radius_km) < 1e-6)))
+    return dist, pairs, borderline
+
+
+def _points(rng, n, cell_deg, lat_range, lon_range):
+    """
+    Random points, half of them within a hair of a grid-cell boundary in latitude, longitude or both
+    """
+    lat = rng.uniform(*lat_range, n)
+    lon = rng.uniform(*lon_range, n)
+    edge = rng.random(n) < 0.5
+    nudge = rng.choice([-1e-9, 0.0, 1e-9], size=(2, n))
+    snap_lat = edge & (rng.random(n) < 0.7)
+    snap_lon = edge & (rng.random(n) < 0.7)
+    lat = np.where(snap_lat, np.round(lat / cell_deg) * cell_deg + nudge[0], lat)
+    lon = np.where(snap_lon, np.round(lon / cell_deg) * cell_deg + nudge[1], lon)
+    return np.clip(lat, -90, 90), (lon + 180) % 360 - 180
+
+
+@pytest.mark.parametrize("lat_range, lon_range", [
+    ((32.0, 42.0), (-125.0, -114.0)),  # California
+    ((-10.0, 10.0), (170.0, 190.0)),  # across the antimeridian
+    ((70.0, 90.0), (-180.0, 180.0)),  # near the pole
+])
+@pytest.mark.parametrize("radius_km", [5.0, 40.0, 150.0])
+def test_query_radius_matches_brute_force(lat_range, lon_range, radius_km):
+    rng = np.random.default_rng([int(radius_km), int(lat_range[0]) + 90])
+    cell_deg = 0.25
+    slat, slon = _points(rng, 400, cell_deg, lat_range, lon_range)
+    qlat, qlon = _points(rng, 300, cell_deg, lat_range, lon_range)
+    index = colocation.StationIndex(np.arange(len(slat)).astype(str), slat, slon, cell_deg=cell_deg)
+    pq, ps, dist = index.query_radius(qlat, qlon, radius_km, batch_size=64)
+
+    found = list(zip(pq.tolist(), ps.tolist()))
+    assert len(found) == len(set(found))  # no pair twice
+    assert np.all(np.diff(pq) >= 0)
+    expected_dist, expected, borderline = _brute_force(index, qlat, qlon, radius_km)
+    assert set(found) - borderline == expected - borderline
+    np.testing.assert_allclose(dist, expected_dist[pq, ps], atol=1e-6)
+
+
+@pytest.mark.parametrize("lat_range, lon_range", [((32.0, 42.0), (-125.0, -114.0)), ((70.0, 90.0), (-180.0, 180.0))])
+def test_query_nearest_matches_brute_force(lat_range, lon_range):
+    rng = np.random.default_rng(7)
+    slat, slon = _points(rng, 300, 0.5, lat_range, lon_range)
+    qlat, qlon = _points(rng, 300, 0.5, lat_range, lon_range)
+    index = colocation.StationIndex(np.arange(len(slat)).astype(str), slat, slon, cell_deg=0.5)
+    nearest, nearest_dist = index.query_nearest(qlat, qlon, 60.0)
+
+    dist = _haversine_km(qlat[:, None], qlon[:, None], slat[None, :], slon[None, :])
+    best = dist.min(axis=1)
+    in_range = best <= 60.0
+    np.testing.assert_array_equal(nearest == -1, ~in_range)
+    np.testing.assert_allclose(nearest_dist[in_range], best[in_range], atol=1e-6)
+    np.testing.assert_allclose(dist[np.flatnonzero(in_range), nearest[in_range]], best[in_range], atol=1e-6)
+    assert np.all(np.isinf(nearest_dist[~in_range]))
+
+
+def test_missing_coordinates_are_never_matched():
+    index = colocation.StationIndex(["A", "B"], [34.0, np.nan], [-118.0, -118.0])
+    pq, ps, _ = index.query_radius([34.0, np.nan], [-118.0, -118.0], 10.0)
+    assert pq.tolist() == [0] and ps.tolist() == [0]
+    empty = colocation.StationIndex([], [], [])
+    nearest, nearest_dist = empty.query_nearest([34.0], [-118.0], 10.0)
+    assert nearest.tolist() == [-1] and np.isinf(nearest_dist[0])
@@ -0,0 +1,126 @@
+# Tests for the compact in-memory observation arrays.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compact_obs  # noqa: E402
+
+STATIONS = pd.DataFrame({"NAME": ["Alpha", "Bravo"], "LATITUDE": [34.0, 36.5], "LONGITUDE": [-118.0, -120.25],
+                         "ELEVATION": [100.0, np.nan]}, index=pd.Index(["KAAA", "KBBB"], name="STID"))
+
+
+def _frame(rows):
+    """
+    :param rows: list of (station, time, variable, set, value, qc) tuples
+    """
+    station, time, variable, set_name, value, qc = zip(*rows)
+    return pd.DataFrame({"station": pd.Categorical(station), "time": pd.to_datetime(list(time)),
+                         "variable": pd.Categorical(variable), "set": pd.Categorical(set_name),
+                         "value": np.array(value, dtype=np.float32), "qc": np.array(qc, dtype=bool)})
+
+
+ROWS = [("KBBB", "2024-07-01T02:00", "air_temp", "set_1", 21.0, False),
+        ("KAAA", "2024-07-01T01:00", "air_temp", "set_1", 20.0, False),
+        ("KAAA", "2024-07-01T00:00", "air_temp", "set_1", 19.5, True),
+        ("KAAA", "2024-07-01T00:00", "relative_humidity", "set_1", 40.0, False),
+        ("KAAA", "2024-07-01T00:00", "air_temp", "set_2", np.nan, False),
+        ("KBBB", "2024-07-01T01:00", "air_temp", "set_1", 22.5, True)]
+
+
+def _sorted(df):
+    return (df.astype({"station": str, "variable": str, "set": str, "time": "datetime64[s]"})
+            .sort_values(["station", "variable", "set", "time"]).reset_index(drop=True))
+
+
+def test_from_frame_round_trips_to_frame():
+    obs = _frame(ROWS)
+    compact = compact_obs.CompactObservations.from_frame(obs, STATIONS)
+    assert len(compact) == len(ROWS)
+    pd.testing.assert_frame_equal(_sorted(compact.to_frame()), _sorted(obs))
+    assert compact.series_table()[["station", "variable", "set", "n"]].values.tolist() == [
+        ["KAAA", "air_temp", "set_1", 2], ["KAAA", "air_temp", "set_2", 1], ["KAAA", "relative_humidity", "set_1", 1],
+        ["KBBB", "air_temp", "set_1", 2]]
+
+
+def test_repeated_observation_keeps_the_last():
+    obs = _frame(ROWS + [("KAAA", "2024-07-01T01:00", "air_temp", "set_1", 25.0, True)])
+    compact = compact_obs.CompactObservations.from_frame(obs, STATIONS)
+    assert len(compact) == len(ROWS)
+    times, values = compact.lookup("KAAA", "air_temp", "set_1")
+    assert values.tolist() == [19.5, 25.0]
+    assert compact.select(stations=["KAAA"], variables=["air_temp"], start="2024-07-01T01:00").qc.tolist() == [True]
+
+
+def test_time_and_value_are_views_not_copies():
+    compact = compact_obs.CompactObservations.from_frame(_frame(ROWS), STATIONS)
+    times, values = compact.lookup("KBBB", "air_temp")
+    assert np.shares_memory(times, compact.time)
+    assert np.shares_memory(values, compact.value)
+    df = compact.to_frame()
+    assert np.shares_memory(df["value"].to_numpy(), compact.value)
+    assert np.shares_memory(df["time"].to_numpy(), compact.time)
+
+
+def test_lookup_defaults_to_the_first_set():
+    compact = compact_obs.CompactObservations.from_frame(_frame(ROWS), STATIONS)
+    times, values = compact.lookup("KAAA", "air_temp")
+    assert times.tolist() == list(np.array(["2024-07-01T00:00", "2024-07-01T01:00"], dtype="datetime64[s]"))
+    assert values.tolist() == [19.5, 20.0]
+    assert np.isnan(compact.lookup("KAAA", "air_temp", "set_2")[1][0])
+    assert compact.lookup("KBBB", "relative_humidity") is None
+    assert compact.lookup("KZZZ", "air_temp") is None
+
+
+def test_select_filters_and_copies():
+    compact = compact_obs.CompactObservations.from_frame(_frame(ROWS), STATIONS)
+    picked = compact.select(variables=["air_temp"], end="2024-07-01T01:00", include_qc=False)
+    table = picked.series_table()
+    assert table[["station", "set", "n"]].values.tolist() == [["KAAA", "set_1", 1], ["KAAA", "set_2", 1]]
+    assert picked.value[0] == 20.0 and np.isnan(picked.value[1])
+    assert not picked.qc.any()
+    assert not np.shares_memory(picked.value, compact.value)
+    assert len(compact.select(stations=["KZZZ"])) == 0
+
+
+def test_concat_merges_tables_and_later_blocks_win():
+    first = compact_obs.CompactObservations.from_frame(_frame(ROWS[:3]), STATIONS)
+    update = [("KAAA", "2024-07-01T01:00", "air_temp", "set_1", 30.0, False),
+              ("KCCC", "2024-07-01T01:00", "wind_speed", "set_1", 4.0, False)]
+    second = compact_obs.CompactObservations.from_frame(_frame(update))  # no station metadata
+    combined = compact_obs.CompactObservations.concat([first, second])
+    assert list(combined.stations.index) == ["KAAA", "KBBB", "KCCC"]
+    assert combined.stations.loc["KAAA", "NAME"] == "Alpha"
+    assert combined.stations["LATITUDE"].tolist()[:2] == [34.0, 36.5]
+    assert combined.stations["ELEVATION"].dtype == np.float32
+    assert combined.variables == ["air_temp", "wind_speed"]
+    assert len(combined) == 4
+    assert combined.lookup("KAAA", "air_temp")[1].tolist() == [19.5, 30.0]
+    assert combined.lookup("KCCC", "wind_speed")[1].tolist() == [4.0]
+    assert combined.qc.tolist() == [True, False, False, False]
+
+
+def test_save_and_load_memory_maps_the_arrays(tmp_path):
+    compact = compact_obs.CompactObservations.from_frame(_frame(ROWS), STATIONS)
+    path = str(tmp_path / "compact")
+    compact.save(path)
+    compact.save(path)  # replacing an existing copy
+    assert sorted(os.listdir(tmp_path)) == ["compact"]
+
+    loaded = compact_obs.CompactObservations.load(path)
+    for name in compact_obs.ARRAYS:
+        assert isinstance(getattr(loaded, name), np.memmap)
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(compact, name))
+    pd.testing.assert_frame_equal(loaded.stations, compact.stations)
+    pd.testing.assert_frame_equal(loaded.to_frame(), compact.to_frame())
+    assert np.shares_memory(loaded.lookup("KBBB", "air_temp")[1], loaded.value)
+
+    in_memory = compact_obs.CompactObservations.load(path, mmap_mode=None)
+    assert not isinstance(in_memory.value, np.memmap)
+    assert in_memory.nbytes == compact.nbytes
@@ -0,0 +1,64 @@
+# Tests for the fire-weather indices against published reference numbers.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fire_weather  # noqa: E402
+
+
+def _c(temp_f):
+    return (temp_f - 32) / 1.8
+
+
+def test_saturation_vapor_pressure_matches_the_tables():
+    # saturation vapor pressure over water (Smithsonian Meteorological Tables / WMO), hPa
+    temps = [0.0, 10.0, 20.0, 30.0]
+    np.testing.assert_allclose(fire_weather.saturation_vapor_pressure(temps), [6.112, 12.28, 23.39, 42.46], rtol=2e-3)
+
+
+def test_equilibrium_moisture_content_matches_simard():
+    # Simard (1968) as tabulated for NFDRS (Cohen and Deeming 1985), one case per humidity regime, in deg F
+    temp_f = np.array([70.0, 80.0, 60.0, 90.0])
+    rh = np.array([5.0, 20.0, 50.0, 80.0])
+    # worked by hand from Simard's published coefficients:
+    #   h < 10:       0.03229 + 0.281073 h - 0.000578 h T
+    #   10 <= h <= 50: 2.22749 + 0.160107 h - 0.01478 T
+    #   h > 50:       21.0606 + 0.005565 h^2 - 0.00035 h T - 0.483199 h
+    expected = [1.2354, 4.2472, 9.3460, 15.5007]
+    np.testing.assert_allclose(fire_weather.equilibrium_moisture_content(_c(temp_f), rh), expected, atol=2e-3)
+
+
+def test_fosberg_ffwi_is_100_with_dry_fuel_and_a_30_mph_wind():
+    # the index is scaled so that zero fuel moisture and a 30 mph wind give 100 (Fosberg 1978; Goodrick 2002)
+    wind_kph = 30 * fire_weather.KPH_PER_MPH
+    np.testing.assert_allclose(fire_weather._ffwi_from_emc(np.float32(0), wind_kph), 100.0, atol=0.05)
+    np.testing.assert_allclose(fire_weather._ffwi_from_emc(np.float32(0), 0.0), 1 / 0.3002, rtol=1e-5)
+    # bone-dry air leaves only Simard's 0.03 % intercept, so nearly the full 100
+    np.testing.assert_allclose(fire_weather.fosberg_ffwi(20.0, 0.0, wind_kph), 99.8, atol=0.1)
+
+
+def test_fosberg_ffwi_is_zero_at_the_extinction_moisture():
+    np.testing.assert_allclose(fire_weather._ffwi_from_emc(np.float32([30.0, 35.0]), 50.0), [0.0, 0.0], atol=1e-5)
+    # 70 F, 30 % RH and 15 mph: EMC 6.0 %, so eta = 1 - 2m + 1.5m^2 - 0.5m^3 with m = 0.2
+    eta = 1 - 2 * 0.19987 + 1.5 * 0.19987 ** 2 - 0.5 * 0.19987 ** 3
+    np.testing.assert_allclose(fire_weather.fosberg_ffwi(_c(70.0), 30.0, 15 * fire_weather.KPH_PER_MPH),
+                               eta * np.sqrt(1 + 15 ** 2) / 0.3002, rtol=1e-3)
+
+
+def test_hot_dry_windy_is_wind_times_vapor_pressure_deficit():
+    # Srock et al. (2018): HDW = wind (m/s) x VPD (hPa). 30 C at 10 % RH is a 0.9 x 42.46 hPa deficit
+    np.testing.assert_allclose(fire_weather.hot_dry_windy(30.0, 10.0, 36.0), 10 * 0.9 * 42.46, rtol=2e-3)
+    np.testing.assert_allclose(fire_weather.hot_dry_windy(30.0, 100.0, 36.0), 0.0, atol=1e-4)
+
+
+def test_missing_inputs_stay_missing():
+    out = fire_weather.compute_indices({"air_temp": np.array([30.0, np.nan]), "relative_humidity": [10.0, 10.0],
+                                        "wind_speed": [36.0, 36.0]})
+    for name in ("vapor_pressure_deficit", "equilibrium_moisture_content", "fosberg_ffwi", "hot_dry_windy"):
+        assert np.isfinite(out[name][0]) and np.isnan(out[name][1])
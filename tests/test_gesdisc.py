@@ -0,0 +1,159 @@
+# Tests for the GES DISC subset orchestrator and granule downloader.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import http.server
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gesdisc  # noqa: E402
+
+
+class _Response:
+    def __init__(self, body):
+        self.body = body
+        self.content = json.dumps(body).encode("utf-8")
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+class _Session:
+    """
+    Answers subset calls with a running job, and GetStatus/GetResult calls with whatever the test asks for
+    """
+    def __init__(self, status=None, result=None):
+        self.status = status
+        self.result = result
+
+    def post(self, url, data=None, **kwargs):
+        method = json.loads(data)["methodname"]
+        if method == "subset":
+            return _Response({"type": "jsonwsp/response", "result": {"jobId": "job1", "Status": "Accepted"}})
+        answer = self.status if method == "GetStatus" else self.result
+        if isinstance(answer, Exception):
+            raise answer
+        return _Response(answer)
+
+
+class _Downloader:
+    def download_all(self, urls):
+        return [], []
+
+
+def _request():
+    return gesdisc.build_subset_request("ML2T_004", datetime(2015, 8, 1), datetime(2015, 8, 2), [-125, 32, -114, 42],
+                                        [{"variable": "Temperature"}])
+
+
+def _orchestrator(session):
+    return gesdisc.SubsetOrchestrator(session, _Downloader(), poll_initial=0, max_job_retries=0)
+
+
+def test_status_failure_carries_the_subset_request():
+    request = _request()
+    session = _Session(status=requests.ConnectionError("connection reset"))
+    docs, paths, failed_jobs, failed_items = _orchestrator(session).run([request])
+    assert len(failed_jobs) == 1
+    assert failed_jobs[0].request is request
+    assert failed_jobs[0].request["args"]["start"] == request["args"]["start"]
+
+
+def test_malformed_result_fails_the_job_not_the_batch():
+    request = _request()
+    session = _Session(status={"type": "jsonwsp/response", "result": {"Status": "Succeeded"}},
+                       result={"type": "jsonwsp/response", "result": {}})
+    docs, paths, failed_jobs, failed_items = _orchestrator(session).run([request])
+    assert len(failed_jobs) == 1
+    assert failed_jobs[0].request is request
+    assert isinstance(failed_jobs[0].__cause__, KeyError)
+
+
+class _GranuleHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves GRANULE at any path, honoring 'bytes=N-' range requests, and records each request's method and Range
+    """
+    def _send(self, body_too):
+        self.server.seen.append((self.command, self.headers.get("Range")))
+        rng = self.headers.get("Range")
+        start = int(rng[len("bytes="):-1]) if rng else 0
+        if start >= len(GRANULE):
+            self.send_response(416)
+            self.end_headers()
+            return
+        body = GRANULE[start:]
+        self.send_response(206 if rng else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body_too:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+    def log_message(self, *args):
+        pass
+
+
+GRANULE = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def granule_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _GranuleHandler)
+    server.seen = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _download(server, dest_dir, **kwargs):
+    item = {"link": "http://127.0.0.1:{}/MLS-Aura_L2GP-Temperature.he5".format(server.server_address[1]),
+            "label": "MLS-Aura_L2GP-Temperature.he5"}
+    downloader = gesdisc.GranuleDownloader(str(dest_dir), session=requests.Session(), max_retries=0, **kwargs)
+    return downloader.download(item)
+
+
+def test_download_writes_the_whole_granule(granule_server, tmp_path):
+    path = _download(granule_server, tmp_path)
+    with open(path, "rb") as f:
+        assert f.read() == GRANULE
+    assert not os.path.exists(path + ".part")
+
+
+def test_complete_granule_is_skipped(granule_server, tmp_path):
+    (tmp_path / "MLS-Aura_L2GP-Temperature.he5").write_bytes(GRANULE)
+    _download(granule_server, tmp_path)
+    assert [method for method, _ in granule_server.seen] == ["HEAD"]
+
+
+def test_truncated_granule_is_downloaded_again(granule_server, tmp_path):
+    (tmp_path / "MLS-Aura_L2GP-Temperature.he5").write_bytes(GRANULE[:100])
+    path = _download(granule_server, tmp_path)
+    with open(path, "rb") as f:
+        assert f.read() == GRANULE
+    assert ("GET", None) in granule_server.seen
+
+
+def test_part_file_is_resumed_with_a_range_request(granule_server, tmp_path):
+    (tmp_path / "MLS-Aura_L2GP-Temperature.he5.part").write_bytes(GRANULE[:1000])
+    path = _download(granule_server, tmp_path)
+    with open(path, "rb") as f:
+        assert f.read() == GRANULE
+    assert ("GET", "bytes=1000-") in granule_server.seen
@@ -0,0 +1,91 @@
+# Tests for the catalog of downloaded satellite granules, run against the granules bundled in data/.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("h5py")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import granule_catalog  # noqa: E402
+import mls_reader  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+PRODUCT = "MLS-Aura_L2GP-Temperature"
+
+
+@pytest.fixture
+def granules(tmp_path):
+    """
+    Copies of the bundled granules, so tests can touch and delete them
+    """
+    paths = []
+    for path in mls_reader.find_granules([DATA_DIR]):
+        paths.append(str(tmp_path / os.path.basename(path)))
+        shutil.copy2(path, paths[-1])
+    return paths
+
+
+@pytest.fixture
+def catalog(tmp_path, granules):
+    catalog = granule_catalog.GranuleCatalog(str(tmp_path / "catalog.sqlite"))
+    assert catalog.ingest(granules) == 3
+    return catalog
+
+
+def test_product_from_filename():
+    assert granule_catalog.product_from_filename("/x/MLS-Aura_L2GP-Temperature_v04-22-c01_2015d213.SUB.he5") == PRODUCT
+    assert granule_catalog.product_from_filename("/x/other.SUB.he5") == "other"
+
+
+def test_ingest_records_each_granule(catalog, granules):
+    entries = catalog.entries()
+    assert list(entries["path"]) == granules
+    assert set(entries["product"]) == {PRODUCT}
+    assert set(entries["swath"]) == {"Temperature"}
+    assert list(entries["start_time"].dt.strftime("%Y-%m-%d")) == ["2015-08-01", "2015-08-02", "2015-08-03"]
+    assert (entries["end_time"] - entries["start_time"]).max() < pd.Timedelta(days=1)
+    assert (entries["max_lat"] < 30).all() and (entries["min_lat"] > -30).all()
+    assert (entries["n_profiles"] > 0).all()
+    assert entries["variables"].str.contains("L2gpValue").all()
+
+
+def test_unchanged_granules_are_skipped_without_being_opened(catalog, granules, monkeypatch):
+    def opened(path):
+        raise AssertionError("{} was opened".format(path))
+    monkeypatch.setattr(granule_catalog, "describe_granule", opened)
+    assert catalog.ingest(granules) == 0
+
+
+def test_changed_granule_is_cataloged_again(catalog, granules, monkeypatch):
+    stat = os.stat(granules[1])
+    os.utime(granules[1], (stat.st_atime, stat.st_mtime + 60))
+    described = []
+    describe = granule_catalog.describe_granule
+    monkeypatch.setattr(granule_catalog, "describe_granule", lambda path: described.append(path) or describe(path))
+    assert catalog.ingest(granules) == 1
+    assert described == [granules[1]]
+    assert len(catalog.entries()) == 3
+
+
+def test_find_filters_by_time_bbox_and_product(catalog, granules):
+    assert catalog.find() == granules
+    assert catalog.find(start="2015-08-02T06:00", end="2015-08-02T18:00") == granules[1:2]
+    assert catalog.find(start="2015-08-02T12:00") == granules[1:]
+    assert catalog.find(end="2015-08-01T12:00") == granules[:1]
+    assert catalog.find(start="2015-08-05") == []
+    assert catalog.find(bbox=[-125.0, 10.0, -114.0, 20.0], product=PRODUCT) == granules
+    assert catalog.find(bbox=[-125.0, 32.0, -114.0, 42.0]) == []  # the subsets stop at 30 degrees
+    assert catalog.find(product="MLS-Aura_L2GP-O3") == []
+
+
+def test_prune_drops_deleted_granules(catalog, granules):
+    os.remove(granules[0])
+    assert catalog.prune() == 1
+    assert catalog.find() == granules[1:]
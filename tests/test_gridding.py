@@ -0,0 +1,76 @@
+# Tests for putting observations on the common analysis grid.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gridding  # noqa: E402
+
+NAN = np.nan
+
+
+def test_bin_mean_averages_valid_points_on_the_grid():
+    grid = gridding.GridSpec([0.0, 0.0, 2.0, 2.0], 1.0)  # 2 x 2, row 0 in the south
+    lat = [0.5, 0.6, 0.7, 1.5, 5.0, 0.5]
+    lon = [0.5, 0.5, 0.5, 1.5, 5.0, -0.1]
+    values = [1.0, 3.0, NAN, 5.0, 100.0, 100.0]  # a NaN, then two points off the grid
+    np.testing.assert_array_equal(gridding.bin_mean(grid, lat, lon, values), [[2.0, NAN], [NAN, 5.0]])
+
+
+def test_bin_mean_grids_trailing_dimensions_separately():
+    grid = gridding.GridSpec([0.0, 0.0, 2.0, 1.0], 1.0)  # 1 x 2
+    values = np.array([[1.0, 10.0], [3.0, NAN], [7.0, 20.0]])  # (points, levels)
+    out = gridding.bin_mean(grid, [0.5, 0.5, 0.5], [0.5, 0.5, 1.5], values)
+    assert out.shape == (2, 1, 2)
+    np.testing.assert_array_equal(out, [[[2.0, 7.0]], [[10.0, 20.0]]])
+
+
+def test_idw_uses_stations_in_reach_only():
+    grid = gridding.GridSpec([0.0, 0.0, 3.0, 1.0], 1.0)  # cell centers at lon 0.5, 1.5 and 2.5, lat 0.5
+    # A sits on the first cell's center; C and D are 0.3 degrees (about 33 km) either side of the last one's. Nothing
+    # is within 40 km of the middle cell.
+    idw = gridding.IDWInterpolator(grid, ["A", "C", "D"], [0.5, 0.5, 0.5], [0.5, 2.2, 2.8], radius_km=40)
+    values = np.array([[4.0, 10.0, 20.0],
+                       [NAN, 10.0, NAN]])  # (hours, stations)
+    out = idw.interpolate(values)
+    assert out.shape == (2, 1, 3)
+    np.testing.assert_allclose(out[0, 0], [4.0, NAN, 15.0], rtol=1e-6)  # C and D are equally far: a plain mean
+    np.testing.assert_allclose(out[1, 0], [NAN, NAN, 10.0], rtol=1e-6)  # missing values drop out of the weights
+
+
+def test_idw_weights_by_inverse_distance():
+    grid = gridding.GridSpec([0.0, 0.0, 1.0, 1.0], 1.0)  # one cell, centered on (0.5, 0.5)
+    idw = gridding.IDWInterpolator(grid, ["near", "far"], [0.5, 0.5], [0.6, 0.8], radius_km=100, power=2)
+    near, far = idw._weight[np.argsort(idw._station)]
+    np.testing.assert_allclose(near / far, 9.0, rtol=1e-3)  # a third of the distance: nine times the weight
+    np.testing.assert_allclose(idw.interpolate([0.0, 10.0])[0, 0], 10.0 * far / (near + far), rtol=1e-5)
+
+
+def test_hourly_matrix_averages_each_station_hour():
+    obs = pd.DataFrame({
+        "station": ["KAAA", "KAAA", "KAAA", "KBBB", "KBBB", "KZZZ", "KAAA"],
+        "time": pd.to_datetime(["2024-07-01T00:10", "2024-07-01T00:40", "2024-07-01T00:50", "2024-07-01T00:00",
+                                "2024-07-01T02:30", "2024-07-01T00:00", "2024-07-01T02:00"]),
+        "variable": ["air_temp", "air_temp", "air_temp", "air_temp", "air_temp", "air_temp", "wind_speed"],
+        "value": [10.0, 20.0, 99.0, 5.0, 7.0, 1.0, NAN],
+        "qc": [False, False, True, False, False, False, False]})  # the flagged 99 is left out; KZZZ isn't asked for
+    hours, out = gridding.hourly_matrix(obs, ["KAAA", "KBBB"], ["air_temp", "wind_speed", "precip_accum"])
+    np.testing.assert_array_equal(hours, np.array(["2024-07-01T00", "2024-07-01T02"], dtype="datetime64[h]"))
+    np.testing.assert_array_equal(out["air_temp"], [[15.0, 5.0], [NAN, 7.0]])
+    assert np.isnan(out["wind_speed"]).all()
+    assert np.isnan(out["precip_accum"]).all() and out["precip_accum"].shape == (2, 2)
+
+
+def test_grid_store_remove_deletes_only_the_hours_given(tmp_path):
+    store = gridding.GridStore(str(tmp_path), gridding.GridSpec([0.0, 0.0, 1.0, 1.0], 1.0))
+    hours = np.arange(np.datetime64("2020-08-01T00", "h"), np.datetime64("2020-08-01T03", "h"))
+    for h in hours:
+        store.write("synoptic", h, {"air_temp": np.zeros((1, 1))})
+    assert store.remove("synoptic", [hours[1], np.datetime64("2020-09-01T00", "h")]) == 1
+    np.testing.assert_array_equal(store.hours("synoptic"), hours[[0, 2]])
@@ -0,0 +1,105 @@
+# Tests for the lazy MLS L2GP granule reader, run against the granules bundled in data/.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mls_reader  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+GRANULE = os.path.join(DATA_DIR, "MLS-Aura_L2GP-Temperature_v04-22-c01_2015d213.SUB.he5")
+SWATH = mls_reader.SWATH_ROOT + "/Temperature/"
+FILL = -999.99
+
+
+@pytest.fixture(scope="module")
+def raw():
+    """
+    The granule's fields read whole with h5py, to check the reader's windows against
+    """
+    with h5py.File(GRANULE, "r") as f:
+        return {"latitude": f[SWATH + "Geolocation Fields/Latitude"][:],
+                "longitude": f[SWATH + "Geolocation Fields/Longitude"][:],
+                "pressure": f[SWATH + "Geolocation Fields/Pressure"][:],
+                "time": f[SWATH + "Geolocation Fields/Time"][:],
+                "value": f[SWATH + "Data Fields/L2gpValue"][:],
+                "precision": f[SWATH + "Data Fields/L2gpPrecision"][:],
+                "quality": f[SWATH + "Data Fields/Quality"][:]}
+
+
+def _filled(values):
+    return np.where(np.isclose(values, FILL), np.nan, values)
+
+
+def test_whole_granule_matches_h5py(raw):
+    with mls_reader.MLSGranule(GRANULE) as granule:
+        assert granule.n_profiles == len(raw["latitude"])
+        out = granule.read()
+    np.testing.assert_array_equal(out["latitude"], raw["latitude"])
+    np.testing.assert_array_equal(out["pressure"], raw["pressure"])
+    np.testing.assert_array_equal(out["value"], _filled(raw["value"]))
+    np.testing.assert_array_equal(out["quality"], _filled(raw["quality"]))
+    # Time counts TAI seconds from 1993; this is the granule for 2015 day 213 (August 1)
+    assert out["time"].astype("datetime64[D]").min() == np.datetime64("2015-08-01")
+    assert np.all(np.diff(out["time"]) >= np.timedelta64(0, "ms"))
+
+
+def test_pressure_range_keeps_the_levels_inside_it(raw):
+    with mls_reader.MLSGranule(GRANULE) as granule:
+        out = granule.read(pressure_range=(100, 316.3))
+    levels = np.flatnonzero((raw["pressure"] >= 100) & (raw["pressure"] <= 316.3))
+    assert len(levels) == 7  # 316.2 to 100 hPa, both ends included
+    np.testing.assert_array_equal(out["pressure"], raw["pressure"][levels])
+    np.testing.assert_array_equal(out["value"], _filled(raw["value"][:, levels]))
+    np.testing.assert_array_equal(out["precision"], _filled(raw["precision"][:, levels]))
+
+
+def test_level_lists_and_integers(raw):
+    with mls_reader.MLSGranule(GRANULE) as granule:
+        picked = granule.read(levels=[12, 0, 5, 5], fields=("value",))
+        single = granule.read(levels=3, fields=("value",))
+    np.testing.assert_array_equal(picked["pressure"], raw["pressure"][[0, 5, 12]])
+    np.testing.assert_array_equal(picked["value"], _filled(raw["value"][:, [0, 5, 12]]))
+    assert single["value"].shape == (len(raw["latitude"]), 1)
+    np.testing.assert_array_equal(single["value"][:, 0], _filled(raw["value"][:, 3]))
+
+
+def test_bbox_reads_only_the_profiles_inside_it(raw):
+    bbox = [-125.0, 0.0, -60.0, 25.0]
+    with mls_reader.MLSGranule(GRANULE) as granule:
+        out = granule.read(bbox=bbox, pressure_range=(200, 500))
+    lat, lon = raw["latitude"], raw["longitude"]
+    mask = (lon >= bbox[0]) & (lon <= bbox[2]) & (lat >= bbox[1]) & (lat <= bbox[3])
+    levels = np.flatnonzero((raw["pressure"] >= 200) & (raw["pressure"] <= 500))
+    assert 0 < mask.sum() < len(mask)
+    assert len(mls_reader._runs(mask)) > 1  # more than one orbital pass
+    np.testing.assert_array_equal(out["latitude"], lat[mask])
+    np.testing.assert_array_equal(out["longitude"], lon[mask])
+    np.testing.assert_array_equal(out["value"], _filled(raw["value"][mask][:, levels]))
+    np.testing.assert_array_equal(out["quality"], _filled(raw["quality"][mask]))
+    assert len(out["time"]) == mask.sum()
+
+
+def test_empty_bbox_gives_empty_arrays_of_the_right_shape():
+    with mls_reader.MLSGranule(GRANULE) as granule:
+        out = granule.read(bbox=[-125.0, 60.0, -114.0, 70.0], pressure_range=(100, 300))
+    n_levels = len(out["pressure"])
+    assert n_levels > 0
+    assert out["value"].shape == (0, n_levels)
+    assert out["quality"].shape == (0,)
+    assert out["time"].shape == (0,)
+
+
+def test_scan_granules_reads_each_bundled_granule():
+    paths = mls_reader.find_granules([DATA_DIR, DATA_DIR])
+    assert [os.path.basename(p)[-12:-8] for p in paths] == ["d213", "d214", "d215"]
+    days = [out["time"].astype("datetime64[D]").min() for _, out in mls_reader.scan_granules(paths, levels=0)]
+    assert days == list(np.array(["2015-08-01", "2015-08-02", "2015-08-03"], dtype="datetime64[D]"))
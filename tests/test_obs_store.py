@@ -0,0 +1,134 @@
+# Tests for the SQLite observation store.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import obs_store  # noqa: E402
+
+HOURS = np.array(["2024-07-01T01", "2024-07-01T02"], dtype="datetime64[h]")
+
+
+def _obs(stations, times, values):
+    return pd.DataFrame({"station": stations, "time": pd.to_datetime(times), "variable": "air_temp", "set": "set_1",
+                         "value": values, "qc": False})
+
+
+def test_hour_fingerprints_see_values_swapped_between_stations(tmp_path):
+    store = obs_store.ObservationStore(str(tmp_path / "obs.sqlite"))
+    store.upsert_observations(_obs(["KAAA", "KBBB"], ["2024-07-01T01:00", "2024-07-01T01:00"], [20.0, 22.0]))
+    before = store.hour_fingerprints(HOURS)
+    store.upsert_observations(_obs(["KAAA", "KBBB"], ["2024-07-01T01:00", "2024-07-01T01:00"], [22.0, 20.0]))
+    after = store.hour_fingerprints(HOURS)
+    assert list(before) == list(after) == [int(np.datetime64("2024-07-01T01", "s").astype(np.int64))]
+    assert before != after
+
+
+def test_hour_fingerprints_see_values_moved_within_the_hour(tmp_path):
+    store = obs_store.ObservationStore(str(tmp_path / "obs.sqlite"))
+    store.upsert_observations(_obs(["KAAA", "KAAA"], ["2024-07-01T01:00", "2024-07-01T01:30"], [20.0, 22.0]))
+    before = store.hour_fingerprints(HOURS)
+    store.upsert_observations(_obs(["KAAA", "KAAA"], ["2024-07-01T01:00", "2024-07-01T01:30"], [22.0, 20.0]))
+    assert store.hour_fingerprints(HOURS) != before
+
+
+def test_hour_fingerprints_do_not_depend_on_ingest_order(tmp_path):
+    obs = _obs(["KAAA", "KBBB", "KAAA"], ["2024-07-01T01:00", "2024-07-01T01:00", "2024-07-01T02:10"],
+               [20.0, np.nan, 21.0])
+    first = obs_store.ObservationStore(str(tmp_path / "a.sqlite"))
+    first.upsert_observations(obs)
+    second = obs_store.ObservationStore(str(tmp_path / "b.sqlite"))
+    second.upsert_observations(obs.iloc[::-1].reset_index(drop=True))
+    assert len(first.hour_fingerprints(HOURS)) == 2
+    assert first.hour_fingerprints(HOURS) == second.hour_fingerprints(HOURS)
+
+
+def _stations(rows):
+    return pd.DataFrame(rows, columns=["STID", "NAME", "LATITUDE", "LONGITUDE", "ELEVATION"]).set_index("STID")
+
+
+STATIONS = _stations([("KAAA", "Alpha", 34.0, -118.0, 100.0),
+                      ("KBBB", "Bravo", 36.0, -120.0, 200.0),
+                      ("KCCC", "Charlie", 40.0, -122.0, 300.0)])
+
+
+@pytest.fixture(params=["rtree", "fallback"])
+def store(request, tmp_path, monkeypatch):
+    """
+    A store holding two variables at three stations over three hours, once with the R*Tree and once with the plain
+    coordinate index a SQLite build without the rtree module falls back to
+    """
+    if request.param == "fallback":
+        monkeypatch.setattr(obs_store, "RTREE_SCHEMA", "CREATE VIRTUAL TABLE station_rtree USING no_such_module(x)")
+    store = obs_store.ObservationStore(str(tmp_path / "obs.sqlite"))
+    assert store.has_rtree == (request.param == "rtree")
+    times = ["2024-07-01T00:00", "2024-07-01T01:00", "2024-07-01T02:00"]
+    stids = np.repeat(STATIONS.index.to_numpy(), len(times))
+    obs = _obs(stids, times * len(STATIONS), np.arange(len(stids), dtype=float))  # KAAA 0-2, KBBB 3-5, KCCC 6-8
+    rh = obs.assign(variable="relative_humidity", value=obs["value"] + 50, qc=obs["time"] == times[1])
+    store.upsert_observations(pd.concat([obs, rh], ignore_index=True), STATIONS)
+    return store
+
+
+def test_query_filters_by_station_variable_and_time(store):
+    df = store.query(stations=["KBBB"], variables=["air_temp"], start="2024-07-01T01:00", end="2024-07-01T02:00")
+    assert list(df["station"]) == ["KBBB", "KBBB"]
+    assert list(df["variable"]) == ["air_temp", "air_temp"]
+    np.testing.assert_array_equal(df["time"], pd.to_datetime(["2024-07-01T01:00", "2024-07-01T02:00"]))
+    np.testing.assert_array_equal(df["value"], [4.0, 5.0])
+
+
+def test_query_without_filters_returns_everything_sorted(store):
+    df = store.query()
+    assert len(df) == 18
+    assert list(df["station"].astype(str)) == sorted(df["station"].astype(str))
+    assert (df.groupby("station", observed=True)["time"].apply(lambda t: t.is_monotonic_increasing)).all()
+
+
+def test_query_can_leave_out_qc_flagged_values(store):
+    assert store.query(variables=["relative_humidity"])["qc"].sum() == 3
+    df = store.query(variables=["relative_humidity"], include_qc=False)
+    assert len(df) == 6
+    assert not df["qc"].any()
+
+
+def test_query_by_bbox_includes_stations_on_the_edge(store):
+    df = store.query(bbox=[-120.0, 33.0, -117.0, 36.0], variables=["air_temp"])
+    assert sorted(df["station"].unique()) == ["KAAA", "KBBB"]
+    assert len(store.query(bbox=[-100.0, 30.0, -90.0, 35.0])) == 0
+
+
+def test_moved_station_moves_in_bbox_queries(store):
+    store.upsert_stations(_stations([("KCCC", "Charlie", 34.5, -118.5, 300.0)]))
+    df = store.query(bbox=[-119.0, 33.0, -117.0, 35.0], variables=["air_temp"])
+    assert sorted(df["station"].unique()) == ["KAAA", "KCCC"]
+    assert store.stations().loc["KCCC", "LATITUDE"] == 34.5
+
+
+def test_upsert_replaces_an_observation_instead_of_duplicating_it(tmp_path):
+    store = obs_store.ObservationStore(str(tmp_path / "obs.sqlite"))
+    store.upsert_observations(_obs(["KAAA", "KAAA"], ["2024-07-01T01:00", "2024-07-01T02:00"], [20.0, 21.0]))
+    again = _obs(["KAAA"], ["2024-07-01T01:00"], [np.nan]).assign(qc=True)
+    assert store.upsert_observations(again) == 1
+    df = store.query()
+    assert len(df) == 2
+    assert np.isnan(df["value"].iloc[0]) and df["qc"].iloc[0]
+    assert df["value"].iloc[1] == 21.0 and not df["qc"].iloc[1]
+
+
+def test_upsert_keeps_a_second_set_apart(tmp_path):
+    store = obs_store.ObservationStore(str(tmp_path / "obs.sqlite"))
+    store.upsert_observations(_obs(["KAAA"], ["2024-07-01T01:00"], [20.0]))
+    store.upsert_observations(_obs(["KAAA"], ["2024-07-01T01:00"], [20.5]).assign(set="set_2"))
+    df = store.query()
+    assert sorted(zip(df["set"], df["value"])) == [("set_1", 20.0), ("set_2", 20.5)]
+    assert store.upsert_observations(_obs([], [], [])) == 0
+    assert store.time_range() == (datetime(2024, 7, 1, 1), datetime(2024, 7, 1, 1))
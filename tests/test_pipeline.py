@@ -0,0 +1,106 @@
+# Tests for the incremental derived-dataset pipeline.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline  # noqa: E402
+
+HOURS = np.arange(np.datetime64("2020-08-01T00", "h"), np.datetime64("2020-08-01T04", "h"))
+
+
+def _seconds(hour):
+    return int(np.datetime64(hour, "s").astype(np.int64))
+
+
+class _Recorder:
+    """
+    Stands in for a stage's compute() or remove(), remembering the hours of each call
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, hours):
+        self.calls.append(list(hours))
+
+
+def _pipeline(tmp_path, data, remove=True):
+    """
+    Builds observations -> grid -> fire_weather, with the observations' fingerprints read from the data dictionary
+    (hour -> fingerprint) each run
+    """
+    derived = pipeline.Pipeline(str(tmp_path / "pipeline.sqlite"))
+    derived.add_source("observations", lambda hours: {_seconds(h): data[h] for h in hours if h in data})
+    recorders = {}
+    for name, inputs in (("grid", ["observations"]), ("fire_weather", ["grid"])):
+        recorders[name] = _Recorder(), _Recorder()
+        derived.add_stage(pipeline.Stage(name, inputs, recorders[name][0],
+                                         remove=recorders[name][1] if remove else None))
+    return derived, recorders
+
+
+def test_unchanged_hours_are_skipped(tmp_path):
+    data = {h: "v1" for h in HOURS}
+    derived, recorders = _pipeline(tmp_path, data)
+    rebuilt = derived.run(HOURS)
+    np.testing.assert_array_equal(rebuilt["fire_weather"], HOURS)
+
+    rebuilt = derived.run(HOURS)
+    assert all(len(h) == 0 for h in rebuilt.values())
+    assert len(recorders["grid"][0].calls) == len(recorders["fire_weather"][0].calls) == 1
+
+
+def test_changed_hour_is_rebuilt_downstream(tmp_path):
+    data = {h: "v1" for h in HOURS}
+    derived, recorders = _pipeline(tmp_path, data)
+    derived.run(HOURS)
+    data[HOURS[2]] = "v2"
+    rebuilt = derived.run(HOURS)
+    for name in ("grid", "fire_weather"):
+        np.testing.assert_array_equal(rebuilt[name], HOURS[[2]])
+        assert recorders[name][0].calls[-1] == [HOURS[2]]
+
+
+def test_stage_version_change_rebuilds_every_hour(tmp_path):
+    data = {h: "v1" for h in HOURS}
+    derived, _ = _pipeline(tmp_path, data)
+    derived.run(HOURS)
+    derived.stages["fire_weather"].version = "2"
+    rebuilt = derived.run(HOURS)
+    assert len(rebuilt["grid"]) == 0
+    np.testing.assert_array_equal(rebuilt["fire_weather"], HOURS)
+
+
+def test_outputs_of_vanished_hours_are_removed(tmp_path):
+    data = {h: "v1" for h in HOURS}
+    derived, recorders = _pipeline(tmp_path, data)
+    derived.run(HOURS)
+    del data[HOURS[1]]
+    rebuilt = derived.run(HOURS)
+    for name in ("grid", "fire_weather"):
+        assert len(rebuilt[name]) == 0
+        assert recorders[name][1].calls == [[HOURS[1]]]
+        assert _seconds(HOURS[1]) not in derived.fingerprints(name, HOURS)
+    np.testing.assert_array_equal(derived.hours(), HOURS[[0, 2, 3]])
+
+    # a second run has nothing left to remove, and the hour is built again once data for it turns up
+    derived.run(HOURS)
+    assert len(recorders["grid"][1].calls) == 1
+    data[HOURS[1]] = "v1"
+    rebuilt = derived.run(HOURS)
+    np.testing.assert_array_equal(rebuilt["fire_weather"], HOURS[[1]])
+
+
+def test_vanished_hours_are_forgotten_without_a_remove_function(tmp_path):
+    data = {h: "v1" for h in HOURS}
+    derived, _ = _pipeline(tmp_path, data, remove=False)
+    derived.run(HOURS)
+    del data[HOURS[0]]
+    derived.run(HOURS)
+    assert _seconds(HOURS[0]) not in derived.fingerprints("grid", HOURS)
+    np.testing.assert_array_equal(derived.hours(), HOURS[1:])
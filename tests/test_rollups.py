@@ -0,0 +1,60 @@
+# Tests for the rollup pyramid.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import obs_store  # noqa: E402
+import rollups  # noqa: E402
+
+
+def _obs(station, variable, set_name, times, values):
+    return pd.DataFrame({"station": pd.Categorical([station] * len(times)),
+                         "time": np.array(times, dtype="datetime64[s]"),
+                         "variable": pd.Categorical([variable] * len(times)),
+                         "set": pd.Categorical([set_name] * len(times)),
+                         "value": np.array(values, dtype=np.float32),
+                         "qc": np.zeros(len(times), dtype=bool)})
+
+
+def test_two_sets_are_not_double_counted(tmp_path):
+    store = obs_store.ObservationStore(str(tmp_path / "obs.sqlite"))
+    store.upsert_observations(_obs("KXYZ", "precip_accum", "set_1",
+                                   ["2024-07-01T01:00", "2024-07-01T02:00", "2024-07-01T03:00"], [1, 3, 6]))
+    store.upsert_observations(_obs("KXYZ", "precip_accum", "set_2", ["2024-07-01T01:00", "2024-07-01T03:00"], [1, 6]))
+    store.upsert_observations(_obs("KXYZ", "air_temp", "set_2", ["2024-07-01T01:00"], [30]))
+    store.upsert_observations(_obs("KXYZ", "air_temp", "set_1", ["2024-07-01T01:00", "2024-07-01T02:00"], [20, 22]))
+    ru = rollups.RollupStore(str(tmp_path / "rollups.sqlite"))
+    ru.update(store, np.array(["2024-07-01T01"], dtype="datetime64[h]"))
+
+    days = ru.query("day", datetime(2024, 7, 1), datetime(2024, 7, 2)).set_index("variable")
+    assert days.loc["precip_accum", "n"] == 3
+    assert days.loc["precip_accum", "total"] == 5.0
+    assert days.loc["air_temp", "n"] == 2
+    assert days.loc["air_temp", "max"] == 22.0
+    summary = ru.summarize(datetime(2024, 7, 1), datetime(2024, 7, 2))
+    assert summary.loc[("KXYZ", "precip_accum"), "total"] == 5.0
+
+
+def test_set_rank():
+    assert sorted(["set_10", "set_2", "set_1d", "value_1", "set_1"], key=rollups.set_rank) == \
+        ["set_1", "value_1", "set_1d", "set_2", "set_10"]
+
+
+def test_cover_keeps_months_and_years_on_their_boundaries():
+    pieces = rollups.cover(datetime(2015, 1, 15), datetime(2025, 1, 10))
+    levels = [level for level, _ in pieces]
+    assert len(pieces) == 40
+    assert levels.count("year") == 9 and levels.count("month") == 11 and levels.count("week") == 1
+    t = datetime(2015, 1, 15)
+    for level, start in pieces:
+        assert start == t
+        t = rollups.period_end(level, start)
+    assert t == datetime(2025, 1, 10)
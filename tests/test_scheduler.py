@@ -0,0 +1,111 @@
+# Tests for the daemon scheduler, run on a simulated clock.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler  # noqa: E402
+
+
+class _Clock:
+    """
+    Simulated monotonic clock. Waiting lets the quick jobs' runs finish first, as they would in real time, then jumps
+    straight to the end of the wait (plus any lateness queued up, to mimic an overloaded host waking up late).
+    """
+    def __init__(self, t=1000.0):
+        self.t = t
+        self.quick = []  # jobs whose runs should finish before time moves on
+        self.late = []  # extra seconds added to the next waits, one per wait
+        self.on_wait = None
+
+    def now(self):
+        return self.t
+
+    def sleep(self, seconds):
+        for job in self.quick:
+            if job.future is not None:
+                job.future.result()
+        self.t += seconds + (self.late.pop(0) if self.late else 0)
+        if self.on_wait is not None:
+            self.on_wait(self.t)
+        return False
+
+
+def _recording_job(clock, name, interval, **kwargs):
+    calls = []
+    return scheduler.Job(name, lambda: calls.append(clock.now()), interval, **kwargs), calls
+
+
+def test_runs_stay_on_their_tick_grid_when_one_is_late():
+    clock = _Clock()
+    job, calls = _recording_job(clock, "rt", 60)
+    clock.quick.append(job)
+    clock.late.extend([20])  # the wake-up for the second tick comes 20 s late
+    scheduler.Scheduler([job], clock=clock.now, sleep=clock.sleep).run(handle_signals=False, max_runtime=250)
+    assert calls == [1000.0, 1080.0, 1120.0, 1180.0, 1240.0]
+    assert job.n_runs == 5 and job.n_skipped == 0
+
+
+def test_run_on_start_false_waits_one_interval():
+    clock = _Clock()
+    job, calls = _recording_job(clock, "sat", 100, run_on_start=False)
+    clock.quick.append(job)
+    scheduler.Scheduler([job], clock=clock.now, sleep=clock.sleep).run(handle_signals=False, max_runtime=250)
+    assert calls == [1100.0, 1200.0]
+
+
+def test_ticks_gone_by_are_dropped_not_run_late():
+    job = scheduler.Job("rt", lambda: None, 60)
+    job.schedule_first(0.0)
+    assert job.advance(200.0) == 3  # ticks at 60, 120 and 180 went by
+    assert job.next_tick == 240.0
+
+
+def test_jitter_stays_within_bounds_and_never_accumulates():
+    random.seed(7)
+    job = scheduler.Job("rt", lambda: None, 60, jitter=10)
+    job.schedule_first(0.0)
+    delays = []
+    for n in range(1, 500):
+        delays.append(job.next_run - job.next_tick)
+        job.advance(job.next_run)
+        assert job.next_tick == 60.0 * n  # still on the grid after hundreds of jittered runs
+    assert min(delays) >= 0 and max(delays) <= 10
+    assert max(delays) - min(delays) > 5  # and it really is spread out
+
+
+def test_job_still_running_is_skipped_while_others_keep_their_schedule():
+    clock = _Clock()
+    release = threading.Event()
+    slow_calls = []
+
+    def slow():
+        slow_calls.append(clock.now())
+        release.wait(10)
+
+    slow_job = scheduler.Job("ldas", slow, 60)
+    quick_job, quick_calls = _recording_job(clock, "rt", 60)
+    clock.quick.append(quick_job)
+    clock.on_wait = lambda t: release.set() if t >= 1250 else None  # the slow run finishes after four more ticks
+    sched = scheduler.Scheduler([slow_job, quick_job], clock=clock.now, sleep=clock.sleep)
+    sched.run(handle_signals=False, max_runtime=300)
+    assert slow_calls == [1000.0]
+    assert slow_job.n_skipped == 4  # the ticks at 1060, 1120, 1180 and 1240
+    assert quick_calls == [1000.0, 1060.0, 1120.0, 1180.0, 1240.0]
+
+
+def test_failed_run_keeps_the_schedule():
+    clock = _Clock()
+
+    def boom():
+        raise RuntimeError("upstream down")
+
+    job = scheduler.Job("rt", boom, 60)
+    clock.quick.append(job)
+    scheduler.Scheduler([job], clock=clock.now, sleep=clock.sleep).run(handle_signals=False, max_runtime=130)
+    assert job.n_runs == 3 and job.n_failed == 3
@@ -0,0 +1,141 @@
+# Tests for the synoptic fetch cache and the resumable historical pull built on it.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synoptic_cache  # noqa: E402
+import synoptic_fetch  # noqa: E402
+import wildfire_probability_estimator  # noqa: E402
+
+DAY = datetime(2024, 7, 1)
+
+
+def _chunk(start_dt):
+    return {"UNITS": {"air_temp": "Celsius"},
+            "STATION": [{"STID": "KAAA", "LATITUDE": "37.0", "LONGITUDE": "-120.0",
+                         "OBSERVATIONS": {"date_time": [start_dt.strftime("%Y-%m-%dT%H:%M:%SZ")],
+                                          "air_temp_set_1": [float(start_dt.hour)]}}]}
+
+
+def _fake_fetch_planned(fail_after=None):
+    calls = {"windows": 0}
+
+    def fetch_planned(self, planner, extra_args=None, on_window=None, keep=True):
+        stations = {}
+        window = planner.next_window()
+        while window is not None:
+            if fail_after is not None and calls["windows"] == fail_after:
+                raise RuntimeError("interrupted")
+            calls["windows"] += 1
+            chunk = _chunk(window[0])
+            on_window(window[0], window[1], chunk)
+            synoptic_fetch.merge_station_chunk(stations, chunk)
+            window = planner.next_window()
+        if not keep:
+            return None
+        return {"UNITS": {}, "STATION": synoptic_fetch.finalize_stations(stations)}
+    return fetch_planned, calls
+
+
+def test_interrupted_pull_stores_its_cached_windows_on_the_next_run(tmp_path, monkeypatch):
+    wpe = wildfire_probability_estimator.wile("token", base_dir=str(tmp_path), print_to_console=False)
+    try:
+        fetch_planned, _ = _fake_fetch_planned(fail_after=2)
+        monkeypatch.setattr(synoptic_fetch.SynopticFetcher, "fetch_planned", fetch_planned)
+        with pytest.raises(RuntimeError):
+            wpe.pull_synoptic_hist(start="202407010000", end="202407020000", regions="CA")
+        assert len(wpe.query()) == 0
+
+        fetch_planned, calls = _fake_fetch_planned()
+        monkeypatch.setattr(synoptic_fetch.SynopticFetcher, "fetch_planned", fetch_planned)
+        df = wpe.pull_synoptic_hist(start="202407010000", end="202407020000", regions="CA")
+        assert calls["windows"] == 2  # only the half the interrupted run didn't get to
+        assert len(df) == 4
+        assert sorted(wpe.query()["time"].dt.hour) == [0, 6, 12, 18]
+
+        df = wpe.pull_synoptic_hist(start="202407010000", end="202407020000", regions="CA")
+        assert len(df) == 0  # everything is stored now, so nothing is handed out twice
+    finally:
+        wpe.close()
+
+
+def _station(stid, times, values):
+    return {"STID": stid, "OBSERVATIONS": {"date_time": times, "air_temp_set_1": values},
+            "QC": {"air_temp_set_1": [False] * len(times)}}
+
+
+def test_gaps_count_only_final_windows(tmp_path):
+    cache = synoptic_cache.FetchCache(str(tmp_path), settle=timedelta(hours=2))
+    cache.put("s", DAY, DAY + timedelta(hours=6), _chunk(DAY), fetched_at=DAY + timedelta(days=1))
+    # ends an hour before it was fetched: stations may still report late, so it's provisional
+    cache.put("s", DAY + timedelta(hours=12), DAY + timedelta(hours=18), _chunk(DAY + timedelta(hours=12)),
+              fetched_at=DAY + timedelta(hours=19))
+    assert cache.gaps("s", DAY, DAY + timedelta(days=1)) == [(DAY + timedelta(hours=6), DAY + timedelta(days=1))]
+    assert cache.gaps("s", DAY + timedelta(hours=2), DAY + timedelta(hours=5)) == []
+    assert cache.gaps("other", DAY, DAY + timedelta(hours=1)) == [(DAY, DAY + timedelta(hours=1))]
+    assert cache.last_complete("s") == DAY + timedelta(hours=6)
+
+
+def test_put_supersedes_provisional_windows_it_covers(tmp_path):
+    cache = synoptic_cache.FetchCache(str(tmp_path))
+    provisional = [(DAY + timedelta(hours=h), DAY + timedelta(hours=h + 3)) for h in (0, 3)]
+    for s, e in provisional:
+        cache.put("s", s, e, _chunk(s), fetched_at=e)
+    cache.put("s", DAY, DAY + timedelta(hours=6), _chunk(DAY), fetched_at=DAY + timedelta(days=1))
+    files = sorted(os.listdir(os.path.join(str(tmp_path), "s")))
+    assert files == ["202407010000_202407010600.json.gz"]  # the stale copies are gone from disk too
+    assert cache._windows("s", DAY, DAY + timedelta(hours=6), final_only=False) == [
+        (DAY, DAY + timedelta(hours=6), os.path.join("s", files[0]))]
+    with gzip.open(os.path.join(str(tmp_path), "s", files[0]), "rt") as f:
+        assert json.load(f) == _chunk(DAY)
+
+
+def test_final_windows_are_not_superseded(tmp_path):
+    cache = synoptic_cache.FetchCache(str(tmp_path))
+    cache.put("s", DAY, DAY + timedelta(hours=3), _chunk(DAY), fetched_at=DAY + timedelta(days=1))
+    cache.put("s", DAY, DAY + timedelta(hours=6), _chunk(DAY), fetched_at=DAY + timedelta(days=1))
+    assert len(cache._windows("s", DAY, DAY + timedelta(hours=6), final_only=True)) == 2
+
+
+def test_trim_stations_cuts_to_the_range():
+    times = ["2024-07-01T00:00:00Z", "2024-07-01T01:00:00Z", "2024-07-01T02:00:00Z"]
+    stations = [_station("KAAA", list(times), [1.0, 2.0, 3.0]), _station("KBBB", times[:1], [9.0])]
+    kept = synoptic_cache.trim_stations(stations, DAY + timedelta(hours=1), DAY + timedelta(hours=2))
+    assert [s["STID"] for s in kept] == ["KAAA"]  # nothing of KBBB's is left in range
+    assert kept[0]["OBSERVATIONS"] == {"date_time": times[1:], "air_temp_set_1": [2.0, 3.0]}
+    assert kept[0]["QC"] == {"air_temp_set_1": [False, False]}
+
+
+def test_load_merges_and_trims_windows(tmp_path):
+    cache = synoptic_cache.FetchCache(str(tmp_path))
+    for h in (0, 6):
+        cache.put("s", DAY + timedelta(hours=h), DAY + timedelta(hours=h + 6), _chunk(DAY + timedelta(hours=h)),
+                  fetched_at=DAY + timedelta(days=1))
+    resp = cache.load("s", DAY, DAY + timedelta(hours=12))
+    assert resp["STATION"][0]["OBSERVATIONS"]["air_temp_set_1"] == [0.0, 6.0]
+    resp = cache.load("s", DAY + timedelta(hours=1), DAY + timedelta(hours=12))
+    assert resp["STATION"][0]["OBSERVATIONS"]["air_temp_set_1"] == [6.0]
+
+
+def test_pending_until_marked_ingested(tmp_path):
+    cache = synoptic_cache.FetchCache(str(tmp_path))
+    final = (DAY, DAY + timedelta(hours=6))
+    cache.put("s", final[0], final[1], _chunk(DAY), fetched_at=DAY + timedelta(days=1))
+    cache.put("s", DAY + timedelta(hours=6), DAY + timedelta(hours=12), _chunk(DAY + timedelta(hours=6)),
+              fetched_at=DAY + timedelta(hours=12))  # provisional: fetched again anyway, so never pending
+    assert cache.pending("s", DAY, DAY + timedelta(days=1)) == [final]
+    assert cache.load_windows("s", [final])["STATION"][0]["OBSERVATIONS"]["air_temp_set_1"] == [0.0]
+    cache.mark_ingested("s", [final])
+    assert cache.pending("s", DAY, DAY + timedelta(days=1)) == []
+    # fetching the window again replaces its data, which then has to be stored again
+    cache.put("s", final[0], final[1], _chunk(DAY), fetched_at=DAY + timedelta(days=2))
+    assert cache.pending("s", DAY, DAY + timedelta(days=1)) == [final]
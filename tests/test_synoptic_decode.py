@@ -0,0 +1,41 @@
+# Tests for decoding synoptic responses.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import obs_store  # noqa: E402
+import synoptic_decode  # noqa: E402
+
+TIMESERIES = [{"STID": "KXYZ", "OBSERVATIONS": {"date_time": ["2024-07-01T01:00:00Z", "2024-07-01T02:00:00Z"],
+                                                "air_temp_set_1": [20.0, 22.0],
+                                                "dew_point_temperature_set_1d": [5.0, 6.0]}}]
+LATEST = [{"STID": "KXYZ", "OBSERVATIONS": {
+    "air_temp_value_1": {"value": 22.0, "date_time": "2024-07-01T02:00:00Z"},
+    "dew_point_temperature_value_1d": {"value": 6.0, "date_time": "2024-07-01T02:00:00Z"}}}]
+
+
+def test_split_obs_key_names_sets_the_same_for_both_endpoints():
+    assert synoptic_decode.split_obs_key("air_temp_set_1") == ("air_temp", "set_1")
+    assert synoptic_decode.split_obs_key("air_temp_value_1") == ("air_temp", "set_1")
+    assert synoptic_decode.split_obs_key("dew_point_temperature_value_1d") == ("dew_point_temperature", "set_1d")
+    assert synoptic_decode.split_obs_key("date_time") is None
+
+
+def test_latest_and_timeseries_upsert_to_the_same_rows(tmp_path):
+    store = obs_store.ObservationStore(str(tmp_path / "obs.sqlite"))
+    store.upsert_observations(synoptic_decode.decode_observations(TIMESERIES))
+    store.upsert_observations(synoptic_decode.decode_observations(LATEST))
+    df = store.query()
+    assert len(df) == 4
+    assert sorted(df["set"].astype(str).unique()) == ["set_1", "set_1d"]
+
+
+def test_keys_select_across_namings():
+    df = synoptic_decode.decode_observations(TIMESERIES, variables=["air_temp_value_1"])
+    assert list(df["variable"].astype(str).unique()) == ["air_temp"]
+    df = synoptic_decode.decode_observations(LATEST, variables=["dew_point_temperature_set_1d"])
+    assert list(df["set"].astype(str).unique()) == ["set_1d"]
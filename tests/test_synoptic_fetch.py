@@ -0,0 +1,196 @@
+# Tests for the synoptic timeseries fetch engine.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synoptic_fetch  # noqa: E402
+
+START = datetime(2024, 7, 1)
+OK = {"SUMMARY": {"RESPONSE_CODE": 1}, "STATION": [{"STID": "KAAA", "OBSERVATIONS": {"date_time": ["x"]}}]}
+
+
+class _Response:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self._body = body if body is not None else {}
+        self.content = json.dumps(self._body).encode()
+        self.text = self.content.decode()
+        self.headers = headers or {}
+
+    def json(self):
+        return self._body
+
+
+class _Session:
+    """
+    Hands back the queued responses in order; an exception in the queue is raised instead
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append(dict(params))
+        result = self.responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(synoptic_fetch.time, "sleep", slept.append)
+    return slept
+
+
+def _fetcher(session, **kwargs):
+    return synoptic_fetch.SynopticFetcher("https://api.example/v2/stations/timeseries", {"token": "t"},
+                                          session=session, **kwargs)
+
+
+def test_split_range_clips_the_last_window():
+    windows = synoptic_fetch.split_range(START, START + timedelta(hours=10), timedelta(hours=4))
+    assert windows == [(START, START + timedelta(hours=4)),
+                       (START + timedelta(hours=4), START + timedelta(hours=8)),
+                       (START + timedelta(hours=8), START + timedelta(hours=10))]
+
+
+def test_split_range_exact_multiple_and_empty():
+    windows = synoptic_fetch.split_range(START, START + timedelta(hours=8), timedelta(hours=4))
+    assert windows == [(START, START + timedelta(hours=4)), (START + timedelta(hours=4), START + timedelta(hours=8))]
+    assert synoptic_fetch.split_range(START, START, timedelta(hours=4)) == []
+    assert synoptic_fetch.split_range(START, START - timedelta(hours=1), timedelta(hours=4)) == []
+
+
+def test_server_errors_and_dropped_connections_are_retried(sleeps):
+    session = _Session([_Response(503), requests.ConnectionError("reset"), _Response(200, OK)])
+    fetcher = _fetcher(session, backoff_base=1.0, backoff_cap=60.0)
+    resp = fetcher.fetch_window(START, START + timedelta(hours=1))
+    assert resp["STATION"][0]["STID"] == "KAAA"
+    assert len(session.calls) == 3
+    assert session.calls[0]["START"] == "202407010000" and session.calls[0]["END"] == "202407010100"
+    # full jitter under a doubling ceiling: first wait up to 1 s, the second up to 2 s
+    assert len(sleeps) == 2 and 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+    assert fetcher._pause_until == 0.0  # nobody was rate limited, so the other workers weren't paused
+
+
+def test_retries_run_out(sleeps):
+    session = _Session([_Response(500)] * 3)
+    with pytest.raises(synoptic_fetch.SynopticFetchError, match="gave up"):
+        _fetcher(session, max_retries=2).fetch_window(START, START + timedelta(hours=1))
+    assert len(session.calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_client_errors_are_not_retried(sleeps):
+    session = _Session([_Response(400, {"error": "bad args"})])
+    with pytest.raises(synoptic_fetch.SynopticFetchError, match="HTTP 400"):
+        _fetcher(session).fetch_window(START, START + timedelta(hours=1))
+    assert len(session.calls) == 1
+    assert sleeps == []
+
+
+def test_rate_limiting_pauses_every_worker(sleeps):
+    session = _Session([_Response(429, headers={"Retry-After": "30"}), _Response(200, OK)])
+    fetcher = _fetcher(session)
+    fetcher.fetch_window(START, START + timedelta(hours=1))
+    assert 30.0 in sleeps
+    # the pause is shared, so any other worker's next request waits out what's left of it
+    assert 25 < fetcher._pause_until - time.monotonic() <= 30
+
+
+def test_429_without_retry_after_still_pauses_every_worker(sleeps):
+    session = _Session([_Response(429), _Response(200, OK)])
+    fetcher = _fetcher(session, backoff_base=4.0)
+    fetcher.fetch_window(START, START + timedelta(hours=1))
+    assert fetcher._pause_until > 0.0
+
+
+def test_backoff_is_capped():
+    fetcher = _fetcher(_Session([]), backoff_base=1.0, backoff_cap=5.0)
+    assert all(0 <= fetcher._backoff(10) <= 5.0 for _ in range(100))
+    assert fetcher._backoff(0, retry_after="120") == 5.0
+    assert 0 <= fetcher._backoff(0, retry_after="Wed, 21 Oct 2015 07:28:00 GMT") <= 1.0
+
+
+def test_no_data_response_is_an_empty_window(sleeps):
+    session = _Session([_Response(200, {"SUMMARY": {"RESPONSE_CODE": synoptic_fetch.SYNOPTIC_NO_DATA_CODE}})])
+    assert _fetcher(session).fetch_window(START, START + timedelta(hours=1))["STATION"] == []
+
+
+class _HourlySession:
+    """
+    Answers every timeseries request with one row per hour of the window asked for, like a dense region would
+    """
+    def get(self, url, params=None, timeout=None):
+        start = datetime.strptime(params["START"], "%Y%m%d%H%M")
+        end = datetime.strptime(params["END"], "%Y%m%d%H%M")
+        times = [w[0].strftime("%Y-%m-%dT%H:%M:%SZ") for w in synoptic_fetch.split_range(start, end,
+                                                                                         timedelta(hours=1))]
+        return _Response(200, {"SUMMARY": {"RESPONSE_CODE": 1},
+                               "STATION": [{"STID": "KAAA", "OBSERVATIONS": {"date_time": times,
+                                                                            "air_temp_set_1": [1.0] * len(times)}}]})
+
+
+def test_planner_sizes_windows_to_the_budget():
+    planner = synoptic_fetch.WindowPlanner(START, START + timedelta(days=30), max_rows=100, max_bytes=10 ** 9,
+                                           initial_window=timedelta(hours=10), fill=0.5)
+    window = planner.next_window()
+    assert window == (START + timedelta(days=30, hours=-10), START + timedelta(days=30))
+    assert planner.observe(window, 1000, 50)  # 5 rows an hour: half of 100 rows is 10 hours
+    assert planner.window == timedelta(hours=10)
+    assert planner.observe(planner.next_window(), 1000, 1)  # sparse: widens, but at most max_growth times
+    assert planner.window == timedelta(hours=80)
+    assert planner.next_window() == (START + timedelta(days=30, hours=-100), START + timedelta(days=30, hours=-20))
+
+
+def test_planner_covers_the_range_exactly_once():
+    planner = synoptic_fetch.WindowPlanner(START, START + timedelta(days=3), initial_window=timedelta(hours=7))
+    windows = []
+    while not planner.done():
+        windows.append(planner.next_window())
+        planner.observe(windows[-1], 10, 1)
+    windows.sort()
+    assert windows[0][0] == START and windows[-1][1] == START + timedelta(days=3)
+    assert all(a[1] == b[0] for a, b in zip(windows, windows[1:]))
+
+
+def test_over_budget_window_is_split_and_handed_out_again():
+    planner = synoptic_fetch.WindowPlanner(START, START + timedelta(hours=48), max_rows=10, max_bytes=10 ** 9,
+                                           initial_window=timedelta(hours=24), fill=1.0)
+    window = planner.next_window()
+    assert not planner.observe(window, 1000, 24)  # a row an hour: 24 rows blew a 10-row budget
+    assert planner.n_over_budget == 1 and planner.n_resplit == 1
+    pieces = [planner.next_window() for _ in range(3)]
+    assert sorted(pieces) == synoptic_fetch.split_range(window[0], window[1], timedelta(hours=10))
+    assert planner.next_window()[1] == window[0]  # then on to the rest of the range
+
+
+def test_over_budget_window_at_min_window_is_kept():
+    planner = synoptic_fetch.WindowPlanner(START, START + timedelta(hours=2), max_rows=10,
+                                           initial_window=timedelta(hours=1), min_window=timedelta(hours=1))
+    assert planner.observe(planner.next_window(), 1000, 500)
+    assert planner.n_over_budget == 1 and planner.n_resplit == 0
+
+
+def test_fetch_planned_keeps_only_windows_under_budget():
+    planner = synoptic_fetch.WindowPlanner(START, START + timedelta(hours=72), max_rows=5, max_bytes=10 ** 9,
+                                           initial_window=timedelta(hours=24))
+    kept = []
+    resp = _fetcher(_HourlySession(), max_workers=3).fetch_planned(
+        planner, on_window=lambda s, e, chunk: kept.append(synoptic_fetch.count_observations(chunk)))
+    assert planner.n_resplit > 0
+    assert max(kept) <= 5
+    times = resp["STATION"][0]["OBSERVATIONS"]["date_time"]
+    assert times == [(START + timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M:%SZ") for h in range(72)]
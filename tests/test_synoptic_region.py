@@ -0,0 +1,118 @@
+# Tests for splitting and fanning synoptic requests out over regions.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synoptic_region  # noqa: E402
+
+API_ROOT = "https://api.example/v2/"
+
+
+class _Response:
+    def __init__(self, body):
+        self.status_code = 200
+        self._body = body
+        self.content = json.dumps(body).encode()
+        self.text = self.content.decode()
+
+    def json(self):
+        return json.loads(self.text)  # a fresh copy each time, as from the wire
+
+
+class _Session:
+    """
+    Answers stations/metadata with the station list of the region asked for, and any other endpoint with one station
+    entry per stid (or per region station) tagged with the request that returned it
+    """
+    def __init__(self, regions):
+        self.regions = regions  # state code -> list of STIDs
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _stids(self, params):
+        if "stid" in params:
+            return params["stid"].split(",")
+        return self.regions[params["state"]]
+
+    def get(self, url, params=None, timeout=None):
+        endpoint = url[len(API_ROOT):]
+        with self._lock:
+            self.calls.append((endpoint, dict(params)))
+        stations = [{"STID": s, "FROM": params.get("state", "stid")} for s in self._stids(params)]
+        return _Response({"SUMMARY": {"RESPONSE_CODE": 1}, "UNITS": {"air_temp": "Celsius"}, "STATION": stations})
+
+
+def _stids(prefix, n):
+    return ["{}{:04d}".format(prefix, i) for i in range(n)]
+
+
+def _fanout(regions, **kwargs):
+    session = _Session(regions)
+    return synoptic_region.RegionFanout(session, API_ROOT, {"token": "t"}, **kwargs), session
+
+
+def test_dedupe_stations_keeps_the_first_of_each_stid():
+    first = [{"STID": "KAAA", "n": 1}, {"STID": "KBBB", "n": 1}]
+    second = [{"STID": "KBBB", "n": 2}, {"STID": "KCCC", "n": 2}, {"STID": "KAAA", "n": 2}]
+    merged = synoptic_region.dedupe_stations([first, [], second])
+    assert [(s["STID"], s["n"]) for s in merged] == [("KAAA", 1), ("KBBB", 1), ("KCCC", 2)]
+    assert synoptic_region.dedupe_stations([]) == []
+
+
+@pytest.mark.parametrize("n_stations, n_requests", [(500, 1), (501, 2), (1000, 2), (1001, 3), (1003, 3), (2345, 5)])
+def test_plan_splits_into_even_station_lists_of_at_most_500(n_stations, n_requests):
+    stids = _stids("CA", n_stations)
+    fanout, _ = _fanout({"CA": stids})
+    planned = fanout.plan([{"state": "CA"}])
+    assert len(planned) == n_requests
+    if n_requests == 1:
+        assert planned == [{"state": "CA"}]
+        return
+    parts = [p["stid"].split(",") for p in planned]
+    assert all(set(p) == {"stid"} for p in planned)
+    assert max(len(p) for p in parts) <= 500
+    assert max(len(p) for p in parts) - min(len(p) for p in parts) <= 1
+    assert [s for p in parts for s in p] == sorted(stids)
+
+
+def test_plan_leaves_short_station_lists_alone_and_splits_long_ones():
+    fanout, session = _fanout({}, max_stations=3)
+    short = {"stid": "KAAA,KBBB,KCCC"}
+    long_list = {"stid": ",".join(_stids("K", 7))}
+    planned = fanout.plan([short, long_list])
+    assert planned[0] is short
+    assert [p["stid"] for p in planned[1:]] == ["K0000,K0001", "K0002,K0003", "K0004,K0005,K0006"]
+    assert [endpoint for endpoint, _ in session.calls] == ["stations/metadata"]
+
+
+def test_station_lists_are_cached_for_the_ttl():
+    fanout, session = _fanout({"CA": _stids("CA", 3)})
+    fanout.plan([{"state": "CA"}])
+    fanout.plan([{"state": "CA"}])
+    assert len(session.calls) == 1
+    fanout.metadata_ttl = 0
+    fanout.plan([{"state": "CA"}])
+    assert len(session.calls) == 2
+    assert session.calls[0][1] == {"state": "CA", "status": "active", "token": "t"}
+
+
+def test_fetch_merges_overlapping_regions_once_per_station():
+    regions = {"CA": _stids("CA", 5) + ["KTAHOE"], "NV": _stids("NV", 4) + ["KTAHOE"]}
+    fanout, session = _fanout(regions, max_stations=4)
+    resp = fanout.fetch("stations/latest", {"vars": "air_temp", "token": "t"},
+                        synoptic_region.normalize_regions(["CA", "NV", {"state": "CA"}]))
+    stids = [s["STID"] for s in resp["STATION"]]
+    assert len(stids) == len(set(stids)) == 10
+    assert resp["SUMMARY"]["NUMBER_OF_OBJECTS"] == 10
+    assert resp["UNITS"] == {"air_temp": "Celsius"}
+    data_calls = [params for endpoint, params in session.calls if endpoint == "stations/latest"]
+    assert len(data_calls) == 4  # 6 CA and 5 NV stations, each split in two
+    assert all(len(p["stid"].split(",")) <= 4 and p["vars"] == "air_temp" for p in data_calls)
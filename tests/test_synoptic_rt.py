@@ -0,0 +1,82 @@
+# Tests for the real-time delta poller.
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synoptic_rt  # noqa: E402
+
+
+class _Response:
+    def __init__(self, body):
+        self.status_code = 200
+        self._body = body
+        self.content = json.dumps(body).encode()
+        self.text = self.content.decode()
+        self.headers = {}
+
+    def json(self):
+        return self._body
+
+
+class _Session:
+    def __init__(self, bodies):
+        self.bodies = list(bodies)
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None, **kwargs):
+        self.calls.append((dict(params), kwargs))
+        return _Response(self.bodies.pop(0))
+
+
+def _latest(**stations):
+    return {"SUMMARY": {"RESPONSE_CODE": 1},
+            "STATION": [{"STID": stid, "LATITUDE": "37.0", "LONGITUDE": "-120.0",
+                         "OBSERVATIONS": {"air_temp_value_1": {"value": value, "date_time": time}}}
+                        for stid, (time, value) in stations.items()]}
+
+
+def _poller(tmp_path, session):
+    return synoptic_rt.RealtimePoller("https://api.example/v2/stations/latest", {"state": "CA"},
+                                      str(tmp_path / "state.sqlite"), str(tmp_path / "log"), session=session)
+
+
+def test_second_poll_returns_only_what_changed(tmp_path):
+    session = _Session([_latest(KAAA=("2024-07-01T01:00:00Z", 20.0), KBBB=("2024-07-01T01:00:00Z", 15.0)),
+                        _latest(KAAA=("2024-07-01T02:00:00Z", 21.0), KBBB=("2024-07-01T01:00:00Z", 15.0))])
+    poller = _poller(tmp_path, session)
+    first, stations = poller.poll()
+    assert sorted(first["station"].astype(str)) == ["KAAA", "KBBB"]
+    assert sorted(stations.index) == ["KAAA", "KBBB"]
+
+    second, _ = poller.poll()
+    assert list(second["station"].astype(str)) == ["KAAA"]
+    assert list(second["value"]) == [21.0]
+
+    # the first poll asks for the widest window, the next one only for the time since plus the slack
+    assert session.calls[0][0]["within"] == 120
+    assert session.calls[1][0]["within"] <= 11
+    assert all("headers" not in kwargs for _, kwargs in session.calls)  # no validators that could never match
+
+    with open(tmp_path / "log" / "synoptic_rt_2024-07-01.csv") as f:
+        assert len(f.read().splitlines()) == 4  # header plus the three new observations
+
+
+def test_a_new_poller_on_the_same_state_file_remembers(tmp_path):
+    body = _latest(KAAA=("2024-07-01T01:00:00Z", 20.0))
+    assert len(_poller(tmp_path, _Session([body])).poll()[0]) == 1
+    assert len(_poller(tmp_path, _Session([body])).poll()[0]) == 0
+
+
+def test_state_files_with_the_old_validator_columns_still_work(tmp_path):
+    with sqlite3.connect(str(tmp_path / "state.sqlite")) as conn:
+        conn.execute("CREATE TABLE polls (series TEXT PRIMARY KEY, polled_at TEXT NOT NULL, etag TEXT, "
+                     "last_modified TEXT)")
+    poller = _poller(tmp_path, _Session([_latest(KAAA=("2024-07-01T01:00:00Z", 20.0))]))
+    assert len(poller.poll()[0]) == 1
+    assert poller._last_poll() is not None
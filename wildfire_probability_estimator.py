@@ -7,32 +7,33 @@ import os  # for operating on logs
            # for changing directories, such as when working with data
            # for getting current working directory
            # TODO: make the directory generation more robust: https://linuxize.com/post/python-get-change-current-working-directory/
+import itertools
 import logging
 import sys
+import threading
 from datetime import datetime, timedelta  # to mark files with the datetime their data was pulled and to iterate across time ranges
+import numpy as np
 import pandas as pd
 
 # additional modules needed for working with Earthdata LDAS
 import json
-import urllib3
-import certifi
-import requests
-from time import sleep
-from subprocess import Popen
 import platform
 import shutil
 
+# only what every synoptic pull goes through is imported here. The satellite, gridding, rollup, pipeline, scoring and
+# scheduling subsystems are imported by the methods (and lazily built attributes) that use them, so a pull that
+# doesn't touch them doesn't pay to load them
+import columnar_store
+import metrics
+import obs_store
+import synoptic_decode
+import synoptic_fetch
+import synoptic_region
+
+
+_AUTH_LOCK = threading.Lock()  # the Earthdata auth files live in the home directory and are shared by every instance
+_INSTANCE_IDS = itertools.count()  # numbers each wile object's logger
 
-def dir_return(d):
-    """
-    Checks if os.cwd is the desired dir. If so, return. If not, change to desired directory.
-    :param d: string giving the complete path of the desired dir.
-    :return: none
-    """
-    if os.getcwd() == d:
-        return
-    else:
-        os.chdir(d)
 
 def setup_new_dir(base_dir, new_dir):
     """
@@ -41,17 +42,30 @@ def setup_new_dir(base_dir, new_dir):
     :param new_dir:  string giving the name of a new directory to place under base directory
     :return new_dir_path:  string giving the full path of the new directory
     """
-    # Check if new_dir exists.  If it doesn't, create it
-    new_dir_path = os.path.join(base_dir, new_dir)
-    os.chdir(base_dir)
-    if not os.path.isdir(new_dir_path):
-        os.mkdir(new_dir_path)
+    # create new_dir if it doesn't exist; exist_ok makes this safe when two instances set up the same tree at once
+    new_dir_path = os.path.join(os.path.abspath(base_dir), new_dir)
+    os.makedirs(new_dir_path, exist_ok=True)
 
     return new_dir_path
 
+
+def _write_text_atomic(path, text, mode=None):
+    """
+    Writes a text file under a temporary name and renames it into place, so a concurrent reader sees either the old
+    file or the new one, never half of one
+    :param mode: optional permission bits to give the file before it appears under its real name
+    """
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    if mode is not None:
+        os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+
 def earthdata_setup_auth(auth,
                          dodsrc_dest,
-                         urs='urs.Earthdata.nasa.gov',  # Earthdata URL to call for authentication
+                         urs='urs.earthdata.nasa.gov',  # Earthdata URL to call for authentication
                          ):
     """
     Creates .netrc, .urs_cookies, and .dodsrc files in bash home directory; these files are prerequisite authenticators
@@ -61,31 +75,27 @@ def earthdata_setup_auth(auth,
     :param urs: string giving URL to call for Earthdata authentication. Defaults to 'urs.Earthdata.nasa.gov'
     :return: none
     """
-    auth_dir = os.path.expanduser("~") + os.sep
-
-    with open(auth_dir + '.netrc', 'w') as file:
-        file.write('machine {} login {} password {}'.format(urs,
-                                                            auth['login'],
-                                                            auth['password']))
-        file.close()
-    with open(auth_dir + '.urs_cookies', 'w') as file:
-        file.write('')
-        file.close()
-    with open(auth_dir + '.dodsrc', 'w') as file:
-        file.write('HTTP.COOKIEJAR={}.urs_cookies\n'.format(auth_dir))
-        file.write('HTTP.NETRC={}.netrc'.format(auth_dir))
-        file.close()
-
-    # TODO:
-    # print('Saved .netrc, .urs_cookies, and .dodsrc to:', auth_dir)
-
-    # Set appropriate permissions for Linux/macOS
-    if platform.system() != "Windows":
-        Popen('chmod og-rw ~/.netrc', shell=True)
-    else:
-        # Copy dodsrc to working directory in Windows
-        shutil.copy2(auth_dir + '.dodsrc', dodsrc_dest)
-        # print('Copied .dodsrc to:', dodsrc_dest)
+    auth_dir = os.path.expanduser("~")
+    netrc_path = os.path.join(auth_dir, '.netrc')
+    cookies_path = os.path.join(auth_dir, '.urs_cookies')
+    dodsrc_path = os.path.join(auth_dir, '.dodsrc')
+
+    with _AUTH_LOCK:
+        # Set appropriate permissions for Linux/macOS before the file appears, so it's never readable by others
+        _write_text_atomic(netrc_path,
+                           'machine {} login {} password {}'.format(urs, auth['login'], auth['password']),
+                           mode=0o600 if platform.system() != "Windows" else None)
+        if not os.path.exists(cookies_path):  # don't wipe out cookies saved by an earlier session
+            _write_text_atomic(cookies_path, '')
+        _write_text_atomic(dodsrc_path, 'HTTP.COOKIEJAR={}\nHTTP.NETRC={}'.format(cookies_path, netrc_path))
+
+        # TODO:
+        # print('Saved .netrc, .urs_cookies, and .dodsrc to:', auth_dir)
+
+        if platform.system() == "Windows":
+            # Copy dodsrc to working directory in Windows
+            shutil.copy2(dodsrc_path, dodsrc_dest)
+            # print('Copied .dodsrc to:', dodsrc_dest)
 
 def get_dict_from_file(d, fname):
     """
@@ -98,12 +108,9 @@ def get_dict_from_file(d, fname):
     # TODO: make dir optional (which defaults to working in cwd) and give fname a default
     # TODO: add error handling
     # https://www.quora.com/How-do-you-convert-a-text-file-into-a-dictionary-Python-syntax-file-dictionary-object-methods-and-development
-    caller_dir = os.getcwd()    # get caller dir to return to after data is pulled
-    os.chdir(d)   # go to target directory
-
     data = {}  # Create an empty dictionary to put the data in
 
-    with open(fname, 'r') as f:
+    with open(os.path.join(d, fname), 'r') as f:
         lines = f.readlines()   # Read the contents of the file into a list
 
         for line in lines:  # Loop through the list of lines
@@ -112,14 +119,17 @@ def get_dict_from_file(d, fname):
 
         # The dictionary 'data' now contains the contents of the text file
 
-    os.chdir(caller_dir)    # return to caller dir
-
     return data
 
 
 
 class wile:
     # TODO: change constants and other relevant objects to private
+    # Concurrency: any number of wile objects can live in one process, and one object can be shared between threads.
+    # Nothing here changes the process's working directory; every path is built from base_dir. Each object logs
+    # through a logger of its own. Sessions, pollers and other lazily built helpers are created under self._lock, and
+    # the stores underneath (SQLite files, parquet partitions, the pipeline manifest) serialize their own writes.
+    # From asyncio, call the blocking methods through asyncio.to_thread() or loop.run_in_executor().
     # Current data sources:
     # Synoptic MesoNet: weather station data
     # Earthdata GES DISC: satellite data sets such as NASA's LDAS. 
@@ -144,36 +154,63 @@ class wile:
                                 "OBSERVATIONS.dew_point_temperature_value_1.date_time",
                                 "OBSERVATIONS.dew_point_temperature_value_1.value",
                                 "OBSERVATIONS.relative_humidity_value_1.date_time",
-                                "OBSERVATIONS.relative_humidity_value_1.value"],
+                                "OBSERVATIONS.relative_humidity_value_1.value",
+                                "OBSERVATIONS.wind_speed_value_1.date_time",
+                                "OBSERVATIONS.wind_speed_value_1.value"],
                  gesdisc_auth_setup_flag=False,
                  gesdisc_auth_path='C:\\Users\\arche\\WilE certs\\Earthdata',   # TODO: talk about this in documentation
                  gesdisc_auth_fname='login.txt',
+                 gesdisc_svc_url=None,  # GES DISC subset service endpoint. Defaults to gesdisc.SUBSET_URL
                  auto_clean=True,  # whether to automatically clean data according to preprogrammed parameters
                  logger_level=20,
                  logname="output_log.txt",
                  logger_formatter_string="%(asctime)s:%(funcName)s:%(message)s",
                  delete_old_logs=True,
-                 print_to_console=True):
+                 print_to_console=True,
+                 grid_bbox=None,  # [minlon, minlat, maxlon, maxlat] area of the common analysis grid. Defaults to
+                                  # gridding.CA_BBOX
+                 grid_res=0.1,  # cell size of the common analysis grid, in degrees
+                 grid_vars=("air_temp", "relative_humidity", "dew_point_temperature", "precip_accum", "wind_speed"),
+                 regions=("CA",),  # area(s) synoptic data is pulled for; see synoptic_region.region_args()
+                 base_dir=None,  # directory data/, debug/ and outputs/ go under. Defaults to the running script's
+                 record_metrics=False,  # whether to record request/parse/write metrics under OUTPUT_DIR/metrics
+                 metrics_formats=metrics.FORMATS):  # 'jsonl' and/or 'prometheus'
 
         # set global constants for this class
-        self.CALLER_DIR = sys.path[0]  # gets location of the file calling/running this code
+        if base_dir is None:
+            base_dir = sys.path[0] or os.getcwd()  # gets location of the file calling/running this code
+        self.CALLER_DIR = os.path.abspath(base_dir)
         self.DATA_DIR = setup_new_dir(self.CALLER_DIR, "data")  # location of data for use
         self.DATA_RT_DIR = setup_new_dir(self.DATA_DIR, "rt")  # where to store "realtime" data, that is, the last
                                                                # available measurements for variables of interest
         self.DATA_HIST_DIR = setup_new_dir(self.DATA_DIR, "hist")  # where to store historical data sets
         self.DATA_DERIVED_DIR = setup_new_dir(self.DATA_DIR, "derived")  # where to store derived data sets
+        self.DATA_SAT_DIR = setup_new_dir(self.DATA_DIR, "sat")  # where downloaded satellite granules are kept
+        self.DATA_CACHE_DIR = setup_new_dir(self.DATA_DIR, "cache")  # completed request windows, so pulls can resume
         self.DATA_TMP_DIR = setup_new_dir(self.DATA_DIR, "tmp")  # if a file needs to be temporarily created
                                                                  # before being removed, it lives here while
                                                                  # it exists.
+        self.OBS_STORE = obs_store.ObservationStore(os.path.join(self.DATA_DIR, "observations.sqlite"))  # indexed
+                                                                  # store of every observation pulled, for query()
         self.DEBUG_DIR = setup_new_dir(self.CALLER_DIR, "debug")  # if any files are necessary for debugging purposes,
                                                                   # they'll be placed here
                                                                   # TODO: automatically clean this folder
         self.OUTPUT_DIR = setup_new_dir(self.CALLER_DIR, "outputs")  # location of any output files
+        # request latency, bytes, rows decoded, parse/write times, retries and queue depths for every pull; a no-op
+        # unless record_metrics is set
+        self.METRICS = metrics.Metrics(os.path.join(self.OUTPUT_DIR, "metrics"), formats=metrics_formats) \
+            if record_metrics else metrics.NULL_METRICS
         self.SYNOPTIC_API_TOKEN = syn_token
         self.SYNOPTIC_API_ROOT = syn_api_root  # this is unlikely to change anytime soon but I figured I should make it
                                                # easily changable just in case
         self.SYN_TIME_FORMAT = syn_time_format  # ditto
         self.SYNOPTIC_RT_FILTER = syn_rt_filter  # ditto x2
+        self.SYNOPTIC_STORE_NAME = "synoptic"  # name of the parquet store under DATA_RT_DIR/DATA_HIST_DIR
+        self.REGIONS = synoptic_region.normalize_regions(regions)  # list of request-argument dictionaries, one per area
+        self.GRID_BBOX = grid_bbox  # area and cell size of GRID, which every gridded data set is put on
+        self.GRID_RES = grid_res
+        self.GRID_VARS = list(grid_vars)  # synoptic variables grid_synoptic() rasterizes
+        self._idw = None  # IDW weights for the current station set, built on first use by grid_synoptic()
 
         # this const specifies which columns of the synoptic response to keep
         # TODO: make this a default that can be changed
@@ -186,6 +223,16 @@ class wile:
                                                                  # GES DISC data like LDAS
         self.GES_DISC_AUTH_PATH = gesdisc_auth_path
         self.GES_DISC_AUTH_FNAME = gesdisc_auth_fname
+        self.GES_DISC_SVC_URL = gesdisc_svc_url
+        self._earthdata_session = None  # created on first use by get_earthdata_session()
+        self._synoptic_session = None  # created on first use by get_synoptic_session()
+        self._rt_pollers = {}  # one per region, created on first use by poll_synoptic_rt()
+        self._region_fanout = None  # created on first use by get_region_fanout()
+        self._grid = self._grid_store = None  # created on first use by the GRID and GRID_STORE properties
+        self._granule_catalog = None  # ditto, GRANULE_CATALOG
+        self._rollups = self._pipeline = self._scorer = None  # ditto, ROLLUPS, PIPELINE and SCORER
+        self._lock = threading.RLock()  # guards creation of the lazily built helpers above
+        self._closed = False
 
         self.AUTO_CLEAN = auto_clean
 
@@ -193,17 +240,18 @@ class wile:
         self.logname = logname  # name of the .txt file to save log output.
         # TODO: consider replacing this such that each log gets now() in its title, and if folder size is too big old
         #  logs are deleted
-        if delete_old_logs:
-            if os.path.exists(self.OUTPUT_DIR + "\\" + self.logname):
-                os.chdir(self.OUTPUT_DIR)
-                os.remove(self.logname)
-                os.chdir(self.DATA_DIR)
+        log_path = os.path.join(self.OUTPUT_DIR, self.logname)
+        if delete_old_logs and os.path.exists(log_path):
+            os.remove(log_path)
         # logging levels are stored in the logging library as integer constants.
         # DEBUG = 10, INFO = 20, WARNING = 30, ERROR = 40, CRITICAL = 50
-        self.logger = logging.getLogger(__name__)
+        # each wile object gets its own logger, so a second object doesn't add its handlers to the first one's and
+        # every message isn't written twice
+        self.logger = logging.getLogger("{}.{}".format(__name__, next(_INSTANCE_IDS)))
         self.logger.setLevel(logger_level)
+        self.logger.propagate = False
         formatter = logging.Formatter(logger_formatter_string)  # TODO:  find link to documentation page for formatter strings and put here
-        file_handler = logging.FileHandler(self.OUTPUT_DIR + "\\" + self.logname)
+        file_handler = logging.FileHandler(log_path, delay=True)  # the file is only created once something is logged
         file_handler.setFormatter(formatter)
         self.logger.addHandler(file_handler)
         if print_to_console:
@@ -219,43 +267,48 @@ class wile:
 
         self.logger.info("beep beep settin up the tootle toot:\n" + "wile object instantiated")
 
-    def __del__(self):
-        self.logger.info("beep boop, takin down the tootle toot")
-
-        # delete GES DISC authentication files
-
-        # delete dodsrc that was copied to caller dir
-        os.chdir(self.CALLER_DIR)
+    def close(self):
+        """
+        Closes this wile object's log files and network sessions. Safe to call more than once
+        :return: none
+        """
+        logger = getattr(self, "logger", None)
+        if logger is None or self._closed:  # __init__ didn't get as far as the logger, or already closed
+            return
+        with self._lock:
+            self._closed = True
+            self.METRICS.flush()
+            if logger.handlers:
+                logger.info("beep boop, takin down the tootle toot")
+            for session in (self._synoptic_session, self._earthdata_session):
+                if session is not None:
+                    session.close()
+            self._synoptic_session = self._earthdata_session = self._region_fanout = None
+            self._rt_pollers = {}
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
 
-        os.chdir(os.path.expanduser("~") + os.sep)  # go to bash root where auth files were stored
-        # delete GES DISC authentication files if they exist
-        os.chdir(self.CALLER_DIR)  # return to whence we came
+    def __del__(self):
+        # TODO: delete GES DISC authentication files (and the dodsrc copied to the caller dir) if they exist
+        self.close()
 
-    def gesdisc_get_http_data(self, request, http, svcurl):
+    def gesdisc_get_http_data(self, request, session=None, svcurl=None):
         """
-        POSTs formatted JSON WSP requests to the GES DISC endpoint URL and returns the response
+        POSTs formatted JSON WSP requests to the GES DISC endpoint URL and returns the response; see
+        gesdisc.jsonwsp_call()
         :param request: JSON object giving a WSP request for a subset of data
-        :param http: URLLIB3 PoolManager object
-        :param svcurl: string giving the URL for the GES DISC subset service endpoint
-        :return: response JSON object giving API response to the request object
-        """
-        hdrs = urllib3.make_headers(basic_auth='Eshreth_of_Athshe:SONOlu4mi__._ne8scence')
-        hdrs['Content-Type'] = 'application/json'
-        hdrs['Accept'] = 'application/json'
-        # hdrs = {'Content-Type': 'application/json',
-        #         'Accept': 'application/json'}
-        data = json.dumps(request)
-        r = http.request('POST', svcurl, body=data, headers=hdrs)
-        response = json.loads(r.data)
-
-        # Check for errors
-        # TODO: update with more robust error handling
-        if response['type'] == 'jsonwsp/fault':
-            if self.logger.level == 10:  # if logger set to DEBUG give full detail of error
-                self.logger.error('API Error: faulty request', stack_info=True, exc_info=True)
-            else:  # otherwise just note that an error happened
-                self.logger.error('API Error: faulty request')
-        return response
+        :param session: optional gesdisc.EarthdataSession (or any requests Session) to send the request through.
+                        Defaults to this wile object's shared Earthdata session
+        :param svcurl: optional string giving the URL for the GES DISC subset service endpoint. Defaults to
+                       GES_DISC_SVC_URL
+        :return: response JSON object giving API response to the request object. A fault raises
+                 gesdisc.SubsetJobError
+        """
+        import gesdisc
+        return gesdisc.jsonwsp_call(session if session is not None else self.get_earthdata_session(),
+                                    svcurl or self.GES_DISC_SVC_URL or gesdisc.SUBSET_URL, request,
+                                    metrics=self.METRICS)
 
     def gesdisc_setup_auth(self, auth_path, auth_fname):
         """
@@ -266,12 +319,123 @@ class wile:
         """
         # how to make prereq files that you need in order to access GES DISC data like Earthdata's LDAS:
         # https://disc.gsfc.nasa.gov/information/howto?title=How%20to%20Generate%20Earthdata%20Prerequisite%20Files
-        if not self.GES_DISC_AUTH_SETUP_FLAG:  # if GES DISC authentication hasn't already been set up, do so
-            earthdata_auth = get_dict_from_file(auth_path, auth_fname)
-            earthdata_setup_auth(earthdata_auth, dodsrc_dest=self.CALLER_DIR)  # TODO: ascertain whether caller dir is
-                                                                               #       always appropriate place to put
-                                                                               #       dodsrc document
-            self.GES_DISC_AUTH_SETUP_FLAG = True
+        with self._lock:
+            if not self.GES_DISC_AUTH_SETUP_FLAG:  # if GES DISC authentication hasn't already been set up, do so
+                earthdata_auth = get_dict_from_file(auth_path, auth_fname)
+                earthdata_setup_auth(earthdata_auth, dodsrc_dest=self.CALLER_DIR)  # TODO: ascertain whether caller
+                                                                                   #       dir is always appropriate
+                                                                                   #       place to put dodsrc document
+                self.GES_DISC_AUTH_SETUP_FLAG = True
+
+    def get_earthdata_session(self):
+        """
+        Returns this wile object's authenticated Earthdata session, creating it the first time it's asked for. The
+        login file is only read, and the prerequisite auth files only written, once per wile object.
+        :return: gesdisc.EarthdataSession
+        """
+        import gesdisc
+        with self._lock:
+            if self._earthdata_session is None:
+                self.gesdisc_setup_auth(self.GES_DISC_AUTH_PATH, self.GES_DISC_AUTH_FNAME)
+                earthdata_auth = get_dict_from_file(self.GES_DISC_AUTH_PATH, self.GES_DISC_AUTH_FNAME)
+                self._earthdata_session = gesdisc.EarthdataSession(
+                    earthdata_auth['login'], earthdata_auth['password'],
+                    os.path.join(os.path.expanduser("~"), '.urs_cookies'))
+            return self._earthdata_session
+
+    def get_synoptic_session(self):
+        """
+        Returns this wile object's keep-alive session for the synoptic API, creating it the first time it's asked for,
+        so repeated real-time polls reuse one connection instead of a new TLS handshake each time
+        :return: requests.Session
+        """
+        with self._lock:
+            if self._synoptic_session is None:
+                self._synoptic_session = synoptic_fetch.make_session(pool_size=4)
+            return self._synoptic_session
+
+    def get_region_fanout(self):
+        """
+        Returns this wile object's synoptic_region.RegionFanout, creating it the first time it's asked for. It keeps
+        the station lists of big regions cached between pulls.
+        :return: synoptic_region.RegionFanout
+        """
+        with self._lock:
+            if self._region_fanout is None:
+                self._region_fanout = synoptic_region.RegionFanout(self.get_synoptic_session(), self.SYNOPTIC_API_ROOT,
+                                                                   {"syn_token": self.SYNOPTIC_API_TOKEN},
+                                                                   logger=self.logger, metrics=self.METRICS)
+            return self._region_fanout
+
+    @property
+    def GRID(self):
+        """
+        The common analysis grid every gridded data set is put on, created the first time it's asked for
+        :return: gridding.GridSpec
+        """
+        with self._lock:
+            if self._grid is None:
+                import gridding
+                self._grid = gridding.GridSpec(gridding.CA_BBOX if self.GRID_BBOX is None else self.GRID_BBOX,
+                                               self.GRID_RES)
+            return self._grid
+
+    @property
+    def GRID_STORE(self):
+        """
+        :return: gridding.GridStore under DATA_DERIVED_DIR holding the hourly grids on GRID
+        """
+        with self._lock:
+            if self._grid_store is None:
+                import gridding
+                self._grid_store = gridding.GridStore(os.path.join(self.DATA_DERIVED_DIR, "grid"), self.GRID)
+            return self._grid_store
+
+    @property
+    def GRANULE_CATALOG(self):
+        """
+        :return: granule_catalog.GranuleCatalog indexing every satellite granule on disk
+        """
+        with self._lock:
+            if self._granule_catalog is None:
+                import granule_catalog
+                self._granule_catalog = granule_catalog.GranuleCatalog(os.path.join(self.DATA_DIR, "granules.sqlite"))
+            return self._granule_catalog
+
+    @property
+    def ROLLUPS(self):
+        """
+        :return: rollups.RollupStore of daily/weekly/monthly/yearly station summaries
+        """
+        with self._lock:
+            if self._rollups is None:
+                import rollups
+                self._rollups = rollups.RollupStore(os.path.join(self.DATA_DERIVED_DIR, "rollups.sqlite"),
+                                                    logger=self.logger)
+            return self._rollups
+
+    @property
+    def PIPELINE(self):
+        """
+        :return: pipeline.Pipeline from build_pipeline(), which keeps everything under DATA_DERIVED_DIR up to date
+                 incrementally
+        """
+        with self._lock:
+            if self._pipeline is None:
+                self._pipeline = self.build_pipeline()
+            return self._pipeline
+
+    @property
+    def SCORER(self):
+        """
+        :return: batch_scoring.BatchScorer writing batch probability maps from the grids in GRID_STORE
+        """
+        with self._lock:
+            if self._scorer is None:
+                import batch_scoring
+                self._scorer = batch_scoring.BatchScorer(os.path.join(self.DATA_DERIVED_DIR, "probability"),
+                                                         self.GRID_STORE, logger=self.logger, metrics=self.METRICS)
+            return self._scorer
 
     def gesdisc_sort_results(self, results):
         """
@@ -279,16 +443,8 @@ class wile:
         :param results: JSON-formatted object derived from Requests response
         :return: docs and urls, arrays of strings giving links to documentation or to file URLs, respectively
         """
-        docs = []
-        urls = []
-
-        for item in results:
-            try:
-                if item['start'] and item['end']: urls.append(item)
-            except:
-                docs.append(item)
-
-        return docs, urls
+        import gesdisc
+        return gesdisc.sort_results(results)
 
     def pull_everything(self):
         # pull all data sources, including updating historical set
@@ -300,113 +456,127 @@ class wile:
         # pull realtime data
         self.logger.debug("pull_rt was called. This is still under construction!")
 
-    def pull_synoptic_rt(self, auto_clean=True, write=True):
+    def synoptic_api_args(self):
+        """
+        :return: dictionary of the arguments every synoptic request shares: units, variables and token. The area comes
+                 from the region each request is for
+        """
+        # TODO: find out how to measure sustained wind speed. wind_speed is instantaneous, which is what fire_weather
+        #  uses for now
+        return {"units": "metric,speed|kph,pres|mb", "varsoperator": "or",
+                "vars": "air_temp,sea_level_pressure,relative_humidity,dew_point_temperature,soil_temp,precip_accum,wind_speed",
+                "syn_token": self.SYNOPTIC_API_TOKEN}
+
+    def pull_synoptic_rt(self, auto_clean=True, write=True, derive=True, regions=None):
         self.logger.info("Pulling latest synoptic weather data.")
         self.logger.debug("Auto_clean = {} and write = {}".format(auto_clean, write))
 
-        syn_api_rt_req_url = os.path.join(self.SYNOPTIC_API_ROOT, self.SYNOPTIC_RT_FILTER)  # URL to request synoptic data
-        # arguments to pass to the synoptic API
-        # TODO: either make two CSVs or two separate requests so that all vars needed to calc dewpoint dep are present together
-        # TODO: find out how to measure sustained wind speed. Var to get instantaneous is wind_speed
-        syn_api_args = {"state": "CA", "units": "metric,speed|kph,pres|mb", "varsoperator": "or",
-                        "vars": "air_temp,sea_level_pressure,relative_humidity,dew_point_temperature,soil_temp,precip_accum",
-                        "syn_token": self.SYNOPTIC_API_TOKEN}
+        syn_api_args = self.synoptic_api_args()  # arguments to pass to the synoptic API
 
-        syn_resp = requests.get(syn_api_rt_req_url, params=syn_api_args)
-        syn_resp = syn_resp.json()  # despite it being called json(), this returns a dict object from the requests module
+        # every region is requested at once (big ones split into several requests) and stations are de-duplicated
+        syn_resp = self.get_region_fanout().fetch(self.SYNOPTIC_RT_FILTER, syn_api_args,
+                                                  self.REGIONS if regions is None else
+                                                  synoptic_region.normalize_regions(regions))
 
-        syn_df = pd.json_normalize(syn_resp['STATION'])
+        # decode straight to a tidy (station, time, variable, set, value, qc) table; when auto-cleaning, only the sets
+        # named in SYNOPTIC_RESPONSE_COLUMNS are decoded at all
+        keep_sets = synoptic_decode.obs_keys_from_columns(self.SYNOPTIC_RESPONSE_COLUMNS) if self.AUTO_CLEAN else None
+        with self.METRICS.timer("parse_seconds", source="synoptic_rt"):
+            syn_df = synoptic_decode.decode_observations(syn_resp['STATION'], variables=keep_sets)
+            syn_stations_df = synoptic_decode.decode_stations(syn_resp['STATION'])
+        self.METRICS.count("rows_decoded_total", len(syn_df), source="synoptic_rt")
         if self.AUTO_CLEAN:
-            syn_df = syn_df[syn_df.QC_FLAGGED != "TRUE"]  # this removes any row that was flagged for
-                                                          # quality control
-            syn_df = syn_df[self.SYNOPTIC_RESPONSE_COLUMNS]  # this removes all columns except the ones in
-                                                             # SYNOPTIC_RESPONSE_COLUMNS
+            syn_df = syn_df[~syn_df.qc]  # this removes any value that was flagged for quality control
 
-        # write the synoptic request to a CSV file
+        # write the synoptic request to the date-partitioned real-time store
         if write:
-            # TODO: decompose object to CSV file process
-            # TODO: decompose datetime retrieval and concatenation?
-            # TODO: consider making syn_csv_filename a global const
-            syn_csv_filename = "synoptic_rt_request.csv"
-            os.chdir(self.DATA_RT_DIR)
-            syn_df.to_csv(syn_csv_filename)
-            self.logger.info("Wrote latest synoptic data response to CSV file")
-
-            if self.logger.level == 10:  # if set to debug, open the historic csv to be sure it was retrieved properly
-                os.startfile(os.path.join(os.getcwd(), syn_csv_filename))
-            os.chdir(self.CALLER_DIR)
-
-    def pull_ldas_rt(self):
+            store_dir = os.path.join(self.DATA_RT_DIR, self.SYNOPTIC_STORE_NAME)
+            with self.METRICS.timer("write_seconds", store="parquet"):
+                paths = columnar_store.write_partitioned(syn_df, store_dir, partition_cols=("date",))
+                columnar_store.write_stations(syn_stations_df, store_dir)
+            with self.METRICS.timer("write_seconds", store="sqlite"):
+                self.OBS_STORE.upsert_observations(syn_df, syn_stations_df)
+            self.METRICS.count("rows_written_total", len(syn_df), store="parquet")
+            self.logger.info("Wrote latest synoptic data response to {} partition(s) under {}".format(len(paths),
+                                                                                                  store_dir))
+            if derive and len(syn_df):
+                # only the hours this pull touched are rebuilt
+                self.run_pipeline(hours=np.unique(syn_df["time"].to_numpy().astype("datetime64[h]")))
+
+        self.METRICS.flush()
+        return syn_df
+
+    def poll_synoptic_rt(self, derive=True, regions=None):
         """
-        Pulls most recent LDAS data from GES DISC Earthdata using authentication data stored in a text file at a location defined in __init__
+        Polls for synoptic observations that are new since the last poll. Unlike pull_synoptic_rt(), which downloads
+        and rewrites the full statewide stations/latest payload every time, each poll only asks for stations that
+        reported since the previous one, and only observations not seen before are kept. They're appended to the daily
+        logs under DATA_RT_DIR/synoptic_log and upserted into the observation store. Cheap enough to run every few
+        minutes.
+        Each region is polled separately and concurrently.
+        :param derive: whether to bring the derived datasets up to date for the hours that got new data
+        :param regions: optional region or list of regions to poll; see synoptic_region.region_args(). Defaults to
+                        REGIONS
+        :return: new_df, pandas DataFrame giving the new observations as a tidy (station, time, variable, set, value,
+                 qc) table
         """
-        
-
-
-        # Set up the GES DISC authentication files
-        earthdata_auth = get_dict_from_file(self.GES_DISC_AUTH_PATH, self.GES_DISC_AUTH_FNAME)
-
-        urs = 'urs.earthdata.nasa.gov'  # Earthdata URL to call for authentication
-        
-        homeDir = os.path.expanduser("~") + os.sep
-        print("Obtained homeDir: " + homeDir)
-
-        with open(homeDir + '.netrc', 'w') as file:
-            print("Attempting to create .netrc file...")
-            file.write('machine {} login {} password {}'.format(urs, earthdata_auth['login'], earthdata_auth['password']))
-            file.close()
-        with open(homeDir + '.urs_cookies', 'w') as file:
-            print("Attempting to create .urs_cookies file...")
-            file.write('')
-            file.close()
-        with open(homeDir + '.dodsrc', 'w') as file:
-            print("Attempting to create .dodsrc file...")
-            file.write('HTTP.COOKIEJAR={}.urs_cookies\n'.format(homeDir))
-            file.write('HTTP.NETRC={}.netrc'.format(homeDir))
-            file.close()
-
-        print('Saved .netrc, .urs_cookies, and .dodsrc to:', homeDir)
-
-
+        import synoptic_rt
+        regions = self.REGIONS if regions is None else synoptic_region.normalize_regions(regions)
+        keep_sets = synoptic_decode.obs_keys_from_columns(self.SYNOPTIC_RESPONSE_COLUMNS) if self.AUTO_CLEAN else None
+        pollers = []
+        with self._lock:
+            for region in regions:
+                label = synoptic_region.region_label(region)
+                if label not in self._rt_pollers:
+                    self._rt_pollers[label] = synoptic_rt.RealtimePoller(
+                        os.path.join(self.SYNOPTIC_API_ROOT, self.SYNOPTIC_RT_FILTER),
+                        dict(self.synoptic_api_args(), **region),
+                        os.path.join(self.DATA_RT_DIR, "poll_state.sqlite"),
+                        os.path.join(self.DATA_RT_DIR, "synoptic_log"),
+                        session=self.get_synoptic_session(), variables=keep_sets, logger=self.logger,
+                        metrics=self.METRICS)
+                pollers.append(self._rt_pollers[label])
+        results = self.get_region_fanout().map(lambda poller: poller.poll(), pollers)
+        new_df = pd.concat([r[0] for r in results], ignore_index=True) if len(results) > 1 else results[0][0]
+        station_dfs = [r[1] for r in results if r[1] is not None]
+        stations_df = pd.concat(station_dfs) if station_dfs else None
+        if stations_df is not None:
+            stations_df = stations_df[~stations_df.index.duplicated()]
+        if self.AUTO_CLEAN:
+            new_df = new_df[~new_df.qc]  # this removes any value that was flagged for quality control
+        if len(new_df):
+            with self.METRICS.timer("write_seconds", store="sqlite"):
+                self.OBS_STORE.upsert_observations(new_df, stations_df)
+            if derive:
+                self.run_pipeline(hours=np.unique(new_df["time"].to_numpy().astype("datetime64[h]")))
+        self.METRICS.flush()
+        self.logger.info("{} new synoptic observation(s) since the last poll".format(len(new_df)))
+        return new_df
+
+    def pull_ldas_rt(self,
+                     product='ML2T_004',
+                     start='2015-08-01T00:00:00.000Z',
+                     end='2015-08-03T23:59:59.999Z',
+                     box=(-180.0, -30.0, 180.0, 30.0),  # minlon, minlat, maxlon, maxlat
+                     days_per_job=1,
+                     max_jobs=4):
+        """
+        Pulls LDAS data from GES DISC Earthdata using authentication data stored in a text file at a location defined in __init__
+        The date range is split into several subset jobs that run concurrently; each job's granules start downloading
+        as soon as that job finishes. Jobs that fail are retried on their own and then reported, without stopping the
+        others.
+        :param product: string giving the GES DISC dataset ID
+        :param start: string giving the start of the range, e.g. '2015-08-01T00:00:00.000Z'
+        :param end: string giving the end of the range, e.g. '2015-08-03T23:59:59.999Z'
+        :param box: [minlon, minlat, maxlon, maxlat] list giving the area to crop to
+        :param days_per_job: number of days covered by each subset job
+        :param max_jobs: integer giving the number of subset jobs allowed in flight at once
+        :return: paths, list of strings giving the full paths of the granules in DATA_SAT_DIR
+        """
+        import gesdisc
+        # one authenticated session, reused for the subset service calls and every granule download
+        session = self.get_earthdata_session()
 
-        # Set appropriate permissions for Linux/macOS
-        if platform.system() != "Windows":
-            Popen('chmod og-rw ~/.netrc', shell=True)
-        else:
-            # Copy dodsrc to working directory in Windows
-            shutil.copy2(homeDir + '.dodsrc', os.getcwd())
-            print('Copied .dodsrc to:', os.getcwd())
-
-        # This method POSTs formatted JSON WSP requests to the GES DISC endpoint URL and returns the response
-        def get_http_data(request):
-
-            hdrs = {}
-            hdrs['Content-Type'] = 'application/json'
-            hdrs['Accept'] = 'application/json'
-            data = json.dumps(request)
-            r = http.request('POST', svcurl, body=data, headers=hdrs)
-            response = json.loads(r.data)
-
-            # Check for errors
-            if response['type'] == 'jsonwsp/fault':
-                print('API Error: faulty request')
-            return response
-
-        # Create a urllib PoolManager instance to make requests.
-        http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED',
-                                   ca_certs=certifi.where())
-
-        # Set the URL for the GES DISC subset service endpoint
-        svcurl = 'https://disc.gsfc.nasa.gov/service/subset/jsonwsp'
-
-        # Define the parameters for the data subset
-        product = 'ML2T_004'
-        begTime = '2015-08-01T00:00:00.000Z'
-        endTime = '2015-08-03T23:59:59.999Z'
-        minlon = -180.0
-        maxlon = 180.0
-        minlat = -30.0
-        maxlat = 30.0
         varNames = ['/HDFEOS/SWATHS/Temperature/Data Fields/Temperature',
                     '/HDFEOS/SWATHS/Temperature/Data Fields/TemperaturePrecision',
                     '/HDFEOS/SWATHS/Temperature/Data Fields/Quality']
@@ -417,219 +587,603 @@ class wile:
         dimSlice = []
         for i in range(len(dimVals)):
             dimSlice.append({'dimensionId': dimName, 'dimensionValue': dimVals[i]})
-
-        # Construct JSON WSP request for API method: subset
-        subset_request = {
-            'methodname': 'subset',
-            'type': 'jsonwsp/request',
-            'version': '1.0',
-            'args': {
-                'role': 'subset',
-                'start': begTime,
-                'end': endTime,
-                'box': [minlon, minlat, maxlon, maxlat],
-                'crop': True,
-                'data': [{'datasetId': product,
-                          'variable': varNames[0],
-                          'slice': dimSlice
-                          },
-                         {'datasetId': product,
-                          'variable': varNames[1],
-                          'slice': dimSlice
-                          },
-                         {'datasetId': product,
-                          'variable': varNames[2]
-                          }]
-            }
-        }
-
-        # Submit the subset request to the GES DISC Server
-        response = get_http_data(subset_request)
-
-        # Report the JobID and initial status
-        myJobId = response['result']['jobId']
-        print('Job ID: ' + myJobId)
-        print('Job status: ' + response['result']['Status'])
-
-        # Construct JSON WSP request for API method: GetStatus
-        status_request = {
-            'methodname': 'GetStatus',
-            'version': '1.0',
-            'type': 'jsonwsp/request',
-            'args': {'jobId': myJobId}
-        }
-
-        # Check on the job status after a brief nap
-        while response['result']['Status'] in ['Accepted', 'Running']:
-            sleep(5)
-            response = get_http_data(status_request)
-            status = response['result']['Status']
-            percent = response['result']['PercentCompleted']
-            print('Job status: %s (%d%c complete)' % (status, percent, '%'))
-
-        if response['result']['Status'] == 'Succeeded':
-            print('Job Finished:  %s' % response['result']['message'])
-        else:
-            print('Job Failed: %s' % response['fault']['code'])
-            sys.exit(1)
-
-        # Use the API method named GetResult. This method will return the URLs along with three additional attributes: a label,
-        # plus the beginning and ending time stamps for that particular data granule. The label serves as the filename for the
-        # downloaded subsets.
-
-        # Construct JSON WSP request for API method: GetResult
-        batchsize = 20
-        results_request = {
-            'methodname': 'GetResult',
-            'version': '1.0',
-            'type': 'jsonwsp/request',
-            'args': {
-                'jobId': myJobId,
-                'count': batchsize,
-                'startIndex': 0
-            }
-        }
-
-        # Retrieve the results in JSON in multiple batches
-        # Initialize variables, then submit the first GetResults request
-        # Add the results from this batch to the list and increment the count
-        results = []
-        count = 0
-        response = get_http_data(results_request)
-        count = count + response['result']['itemsPerPage']
-        results.extend(response['result']['items'])
-
-        # Increment the startIndex and keep asking for more results until we have them all
-        total = response['result']['totalResults']
-        while count < total:
-            results_request['args']['startIndex'] += batchsize
-            response = get_http_data(results_request)
-            count = count + response['result']['itemsPerPage']
-            results.extend(response['result']['items'])
-
-        # Check on the bookkeeping
-        print('Retrieved %d out of %d expected items' % (len(results), total))
-
-        # Sort the results into documents and URLs
-        docs = []
-        urls = []
-        for item in results:
-            try:
-                if item['start'] and item['end']: urls.append(item)
-            except:
-                docs.append(item)
-
-        # Print out the documentation links, but do not download them
-        print('\nDocumentation:')
-        for item in docs: print(item['label'] + ': ' + item['link'])
-
-        print(os.getcwd())
-
-        # Use the requests library to submit the HTTP_Services URLs and write out the results.
-        print('\nHTTP_services output:')
-        for item in urls:
-            URL = item['link']
-            result = requests.get(URL)
-            try:
-                result.raise_for_status()
-                outfn = item['label']
-                f = open(outfn, 'wb')
-                f.write(result.content)
-                f.close()
-                print(outfn)
-            except:
-                print('Error! Status code is %d for this URL:\n%s' % (result.status.code, URL))
-                print('Help for downloading data is at https://disc.gsfc.nasa.gov/information/documents?title=Data%20Access')
+        data = [{'variable': varNames[0], 'slice': dimSlice},
+                {'variable': varNames[1], 'slice': dimSlice},
+                {'variable': varNames[2]}]
+
+        # one subset request per job range
+        gesdisc_time_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+        job_ranges = gesdisc.split_date_range(datetime.strptime(start, gesdisc_time_format),
+                                              datetime.strptime(end, gesdisc_time_format),
+                                              timedelta(days=days_per_job))
+        subset_requests = [gesdisc.build_subset_request(product, s, e, box, data) for s, e in job_ranges]
+        self.logger.info("submitting {} subset job(s) for {} from {} to {}".format(len(subset_requests), product,
+                                                                                  start, end))
+
+        downloader = gesdisc.GranuleDownloader(self.DATA_SAT_DIR, session=session, logger=self.logger,
+                                               metrics=self.METRICS)
+        orchestrator = gesdisc.SubsetOrchestrator(session, downloader, svcurl=self.GES_DISC_SVC_URL or gesdisc.SUBSET_URL,
+                                                  max_jobs=max_jobs, logger=self.logger, metrics=self.METRICS)
+        docs, paths, failed_jobs, failed_items = orchestrator.run(subset_requests)
+        session.save_cookies()  # so the next run skips the URS login redirects
+        with self.METRICS.timer("write_seconds", store="granule_catalog"):
+            n_cataloged = self.GRANULE_CATALOG.ingest(paths)  # only granules that are new or changed get opened
+        self.METRICS.flush()
+
+        # Log the documentation links, but do not download them
+        for item in docs:
+            self.logger.debug('Documentation: ' + item['label'] + ': ' + item['link'])
+
+        self.logger.info("downloaded {} granule(s) ({} bytes) to {}; {} granule(s) and {} job(s) failed; "
+                         "{} new granule(s) cataloged".format(len(paths), downloader.bytes_downloaded,
+                                                              self.DATA_SAT_DIR, len(failed_items), len(failed_jobs),
+                                                              n_cataloged))
+        for e in failed_jobs:
+            self.logger.error("failed subset job {} to {}: {}".format(e.request['args']['start'],
+                                                                      e.request['args']['end'], e))
+
+        return paths
+
+    def read_mls(self, paths=None, levels=None, pressure_range=None, bbox=None, start=None, end=None):
+        """
+        Scans MLS L2GP temperature granules one at a time, reading only the requested level/lat-lon window from each,
+        so memory use is bounded by the slice rather than by the number of granules
+        :param paths: optional list of granule paths. Defaults to the granules in DATA_SAT_DIR and DATA_DIR that the
+                      granule catalog says intersect bbox and start/end; granules that don't are never opened
+        :param levels: optional slice, integer, or list of nLevels indices
+        :param pressure_range: optional (min hPa, max hPa) tuple limiting the levels read
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list limiting the profiles read
+        :param start: optional datetime or string giving the start of the time range to look for granules in (UTC)
+        :param end: optional datetime or string giving the end of the time range to look for granules in (UTC)
+        :return: generator of (path, dictionary of NumPy arrays) tuples; see mls_reader.MLSGranule.read()
+        """
+        import mls_reader
+        if paths is None:
+            # pick up anything that landed outside pull_ldas_rt, then answer from the catalog
+            self.GRANULE_CATALOG.ingest(mls_reader.find_granules([self.DATA_SAT_DIR, self.DATA_DIR]))
+            paths = self.GRANULE_CATALOG.find(bbox=bbox, start=start, end=end, product="MLS-Aura_L2GP-Temperature")
+        self.logger.debug("scanning {} MLS granule(s)".format(len(paths)))
+        return mls_reader.scan_granules(paths, levels=levels, pressure_range=pressure_range, bbox=bbox)
 
     def pull_historic(self):
         # pull historic data
         self.logger.debug("pull_historic() was called")
 
-    def pull_synoptic_hist(self):
-        # TODO
-        # pull synoptic data as far back as arg
-        self.logger.debug("pulling synoptic timeseries data \n" +
-                          "NOTE: this function isn't complete and doesn't work yet! \n" +
-                          "WARNING: it may take up to several hours to fulfill a timeseries request longer than one day!")
+    def pull_synoptic_hist(self, start=None, end=None, max_bytes=16 * 2 ** 20, max_rows=200000, max_workers=8,
+                           use_cache=True, regions=None, load_cached=False):
+        """
+        Pulls synoptic timeseries data for every station in REGIONS between two times. The range is cut into windows that are
+        requested concurrently through a bounded pool of workers sharing one keep-alive session, then merged back
+        together station by station. Window sizes adapt to how much data each era actually has, so sparse years are
+        covered by a handful of wide requests while dense recent ones are split finely.
+        Every finished window is saved to the fetch cache in DATA_CACHE_DIR as soon as it arrives, so an interrupted
+        backfill picks up where it left off and a rerun only fetches hours the cache doesn't already have. Only what
+        this run fetched, plus any cached windows an interrupted run never got to store, is decoded, stored and
+        returned, so a nightly run costs a night's data however big the cache is; pass load_cached=True to get the
+        whole range back from the cache instead. Windows are marked ingested in the cache only once they're stored.
+        :param start: string in SYN_TIME_FORMAT giving the earliest time to pull. Defaults to 3 hours ago if logging is
+                      set to debug, otherwise 1990/01/01 00:00
+        :param end: string in SYN_TIME_FORMAT giving the latest time to pull. Defaults to now
+        :param max_bytes: integer giving the largest response body, in bytes, any one window should return
+        :param max_rows: integer giving the most (station, time) rows any one window should return
+        :param max_workers: integer giving the number of requests allowed in flight at once
+        :param use_cache: whether to read from and write to the fetch cache. Defaults to True
+        :param regions: optional region or list of regions to pull; see synoptic_region.region_args(). Defaults to
+                        REGIONS. Regions are pulled concurrently, each with its own share of max_workers and its own
+                        cache series, and stations appearing in more than one are kept once
+        :param load_cached: whether to decode, store and return everything the cache holds between start and end, not
+                            just the windows fetched by this run. Defaults to False
+        :return: syn_hist_df, pandas DataFrame giving the response as a tidy (station, time, variable, set, value, qc)
+                 table
+        """
+        import synoptic_cache
+        self.logger.debug("pulling synoptic timeseries data")
 
         SYNOPTIC_HIST_FILTER = "stations/timeseries"  # filter for timeseries data TODO: refactor so that this is function argument
-        # SYN_HIST_START not needed
-        if self.logger.level == 10:  # if logging level set to debug, only retrieve a little historic data
-            syn_hist_start_dt = datetime.now()
-            syn_hist_start_dt -= timedelta(hours=3)  # only go back a bit from now
-            SYN_HIST_START = syn_hist_start_dt.strftime(self.SYN_TIME_FORMAT)
-        else:  # otherwise go waaaay back
-            SYN_HIST_START = "199001010000"  # earliest time to seek to is 1990/01/01, 00:00.
-                                             # Most data will be nowhere near that.
-                                             # TODO: make this function arg.
-
-        # TODO: these might need to be function args
-        syn_api_args = {"state": "CA", "units": "metric,speed|kph,pres|mb", "varsoperator": "or",
-                        "vars": "air_temp,sea_level_pressure,relative_humidity,dew_point_temperature,soil_temp,precip_accum",
-                        "syn_token": self.SYNOPTIC_API_TOKEN}  # TODO: this might need to go someplace else
-        syn_hist_end = datetime.now().strftime(self.SYN_TIME_FORMAT)  # string giving current datetime; pull up to the absolute most recent data
+        # synoptic timeseries START/END are always interpreted as UTC
+        if end is None:
+            end = datetime.utcnow().strftime(self.SYN_TIME_FORMAT)  # pull up to the absolute most recent data
+        if start is None:
+            if self.logger.level == 10:  # if logging level set to debug, only retrieve a little historic data
+                start_dt = datetime.strptime(end, self.SYN_TIME_FORMAT) - timedelta(hours=3)  # only go back a bit from now
+                start = start_dt.strftime(self.SYN_TIME_FORMAT)
+            else:  # otherwise go waaaay back
+                start = "199001010000"  # earliest time to seek to is 1990/01/01, 00:00.
+                                        # Most data will be nowhere near that.
+
+        syn_api_args = self.synoptic_api_args()
         syn_api_hist_req_url = os.path.join(self.SYNOPTIC_API_ROOT, SYNOPTIC_HIST_FILTER)  # URL to request synoptic data
-        syn_hist_args = syn_api_args
-
-        # Requesting all recorded timeseries for CA is too much at once. Instead, request timeseries in day-long chunks.
-        # This uses the datetime module to create 2 datetime objects that will outline each chunk.
-        chunk_range_end = syn_hist_end  # string; first end of range should be datetime.now()
-        chunk_end_dt = datetime.strptime(chunk_range_end, self.SYN_TIME_FORMAT)  # datetime object giving the end of the chunk timerange
-        chunk_end_dt -= timedelta(hours=1)  # run the chunk end dt (but not the string!) back 1 day
-        chunk_range_start = chunk_end_dt.strftime(self.SYN_TIME_FORMAT)  # datetime object giving the start of the chunk timerange
-        # chunk_start_dt not needed
-
-        start_dt = datetime.strptime(SYN_HIST_START, self.SYN_TIME_FORMAT)  # datetime giving the very earliest date to seek to
-        range_delta = chunk_end_dt - start_dt  # time difference in complete target range
-        min_delta = timedelta(hours=1)  # set minimum distance between the current chunk and the earliest date
-
-        syn_hist_args["START"] = chunk_range_start
-        syn_hist_args["END"] = chunk_range_end
-        syn_resp = requests.get(syn_api_hist_req_url, params=syn_hist_args, headers={'Accept': 'application/json'})
-        syn_dict = syn_resp.json()  # convert to dict of dicts
-
-        self.logger.debug("start={}, end={} \n\nbeginning while loop:".format(SYN_HIST_START, syn_hist_end))
-
-        while range_delta > min_delta:
-            self.logger.debug("iterating: chunk start={}, chunk end={}".format(chunk_range_start,
-                                                                               chunk_range_end))
-
-            # construct timeseries query
-            syn_hist_args["START"] = chunk_range_start
-            syn_hist_args["END"] = chunk_range_end
-            chunk_resp = requests.get(syn_api_hist_req_url, params=syn_hist_args)  # send request and store response
-                                                                                   # for this chunk
-            chunk_dict = chunk_resp.json()
-            syn_dict.update(chunk_dict)
-
-            # update chunk boundaries and distance from next chunk to the earliest date
-            chunk_range_end = chunk_range_start
-            chunk_end_dt = datetime.strptime(chunk_range_end, self.SYN_TIME_FORMAT)  # temporary datetime object of the chunk range end
-            chunk_end_dt -= timedelta(hours=1)  # run back one day
-            chunk_range_start = chunk_end_dt.strftime(self.SYN_TIME_FORMAT)
-            range_delta = chunk_end_dt - start_dt
-
-            self.logger.debug("retrieved one chunk")
+
+        start_dt = datetime.strptime(start, self.SYN_TIME_FORMAT)
+        end_dt = datetime.strptime(end, self.SYN_TIME_FORMAT)
+        self.logger.debug("start={}, end={}".format(start, end))
+
+        regions = self.REGIONS if regions is None else synoptic_region.normalize_regions(regions)
+        region_workers = max(max_workers // len(regions), 1)
+        session = synoptic_fetch.make_session(max(max_workers, len(regions)))
+        to_mark = []  # (cache, series, windows) for every region, marked ingested once the writes below succeed
+
+        # Requesting all recorded timeseries for a region is too much at once. Instead, request timeseries in chunks,
+        # several at a time, and stitch each station's observation arrays back together afterwards. The planner picks
+        # each chunk's size from the size of the responses seen so far, which also keeps big regions' responses small.
+        def pull_region(region):
+            region_args = dict(syn_api_args, **region)
+            fetcher = synoptic_fetch.SynopticFetcher(syn_api_hist_req_url, region_args,
+                                                     time_format=self.SYN_TIME_FORMAT,
+                                                     max_workers=region_workers,
+                                                     session=session,
+                                                     logger=self.logger,
+                                                     metrics=self.METRICS)
+            if use_cache:
+                cache = synoptic_cache.FetchCache(self.DATA_CACHE_DIR)
+                series = synoptic_cache.series_key(SYNOPTIC_HIST_FILTER, region_args)
+                gaps = cache.gaps(series, start_dt, end_dt)
+                self.logger.debug("{}: {} gap(s) to fetch; cache complete up to {}".format(
+                    synoptic_region.region_label(region), len(gaps), cache.last_complete(series)))
+                leftover = cache.pending(series, start_dt, end_dt)  # cached by an interrupted run but never stored
+                windows = []  # every window this run caches
+
+                def on_window(s, e, chunk):
+                    cache.put(series, s, e, chunk)
+                    windows.append((s, e))
+
+                fetched = {}  # STID -> station, for just the windows fetched now and the leftover ones
+                units = {}
+                if leftover and not load_cached:
+                    part = cache.load_windows(series, leftover)
+                    units.update(part["UNITS"])
+                    synoptic_fetch.merge_station_chunk(fetched, part)
+                for gap_start, gap_end in gaps:
+                    planner = synoptic_fetch.WindowPlanner(gap_start, gap_end, max_bytes=max_bytes, max_rows=max_rows)
+                    part = fetcher.fetch_planned(planner, on_window=on_window, keep=not load_cached)
+                    if part is not None:
+                        units.update(part["UNITS"])
+                        synoptic_fetch.merge_station_chunk(fetched, part)
+                if load_cached:
+                    # what spills over the ends of the range is trimmed off, so only windows inside it count as stored
+                    to_mark.append((cache, series, windows + [(s, e) for s, e in leftover
+                                                              if start_dt <= s and e <= end_dt]))
+                    return cache.load(series, start_dt, end_dt)
+                to_mark.append((cache, series, windows + leftover))
+                station_list = synoptic_fetch.finalize_stations(fetched)
+                return {"UNITS": units,
+                        "STATION": station_list,
+                        "SUMMARY": {"RESPONSE_CODE": 1, "NUMBER_OF_OBJECTS": len(station_list)}}
+            planner = synoptic_fetch.WindowPlanner(start_dt, end_dt, max_bytes=max_bytes, max_rows=max_rows)
+            return fetcher.fetch_planned(planner)
+
+        region_dicts = self.get_region_fanout().map(pull_region, regions)
+        syn_dict = {"STATION": synoptic_region.dedupe_stations([d["STATION"] for d in region_dicts])}
 
         # if set to debug, save raw response as text file
         if self.logger.level == 10:
-            os.chdir(self.DEBUG_DIR)
-            with open("synoptic historic raw response.txt", 'w') as f:
+            with open(os.path.join(self.DEBUG_DIR, "synoptic historic raw response.txt"), 'w') as f:
                 f.write(json.dumps(syn_dict, indent=4))
 
-        os.chdir(self.DATA_HIST_DIR)
+        # convert JSON to a tidy (station, time, variable, set, value, qc) pandas df
+        with self.METRICS.timer("parse_seconds", source="synoptic_hist"):
+            syn_hist_df = synoptic_decode.decode_observations(syn_dict['STATION'])
+            syn_stations_df = synoptic_decode.decode_stations(syn_dict['STATION'])
+        self.METRICS.count("rows_decoded_total", len(syn_hist_df), source="synoptic_hist")
+
+        # upsert into the historical store, partitioned by date and variable; re-pulling a range replaces rather than
+        # duplicates what's already there
+        store_dir = os.path.join(self.DATA_HIST_DIR, self.SYNOPTIC_STORE_NAME)
+        with self.METRICS.timer("write_seconds", store="parquet"):
+            paths = columnar_store.write_partitioned(syn_hist_df, store_dir, partition_cols=("date", "variable"))
+            columnar_store.write_stations(syn_stations_df, store_dir)
+        with self.METRICS.timer("write_seconds", store="sqlite"):
+            n_indexed = self.OBS_STORE.upsert_observations(syn_hist_df, syn_stations_df)
+        for cache, series, windows in to_mark:
+            cache.mark_ingested(series, windows)
+        self.METRICS.count("rows_written_total", len(syn_hist_df), store="parquet")
+        self.METRICS.flush()
+
+        self.logger.info("saved historical measurements to parquet\n" +
+                         "partitions written = {}\n".format(len(paths)) +
+                         "observations indexed = {}\n".format(n_indexed) +
+                         "path = {}\n".format(store_dir))
+
+        return syn_hist_df
+
+    def read_synoptic(self, hist=True, columns=None, start=None, end=None, variables=None, stations=None):
+        """
+        Reads a slice of stored synoptic observations. Only the partitions overlapping the time range (and variable
+        list, for historical data) are opened, and only the requested columns are decoded.
+        :param hist: whether to read the historical store (True) or the real-time store (False)
+        :param columns: optional list of columns to return, from station, time, variable, set, value, qc
+        :param start: optional datetime or string giving the earliest time to return (UTC)
+        :param end: optional datetime or string giving the latest time to return (UTC)
+        :param variables: optional list of variable names to return, such as ['air_temp', 'relative_humidity']
+        :param stations: optional list of station IDs to return
+        :return: pandas DataFrame of the matching observations
+        """
+        base_dir = self.DATA_HIST_DIR if hist else self.DATA_RT_DIR
+        return columnar_store.read_partitioned(os.path.join(base_dir, self.SYNOPTIC_STORE_NAME), columns=columns,
+                                               start=start, end=end, variables=variables, stations=stations)
 
-        # convert JSON to pandas df
-        syn_hist_df = pd.json_normalize(syn_dict['STATION'])
+    def query(self, stations=None, vars=None, start=None, end=None, bbox=None, include_qc=True):
+        """
+        Looks up pulled observations in the indexed observation store without touching the parquet files
+        :param stations: optional list of station IDs, such as ['KSFO', 'KLAX']
+        :param vars: optional list of variable names, such as ['air_temp', 'relative_humidity']
+        :param start: optional datetime or string giving the earliest time to return (UTC)
+        :param end: optional datetime or string giving the latest time to return (UTC)
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list giving the area to return stations from
+        :param include_qc: whether to return values flagged for quality control. Defaults to True
+        :return: pandas DataFrame with station, time, variable, set, value and qc columns
+        """
+        return self.OBS_STORE.query(stations=stations, variables=vars, start=start, end=end, bbox=bbox,
+                                    include_qc=include_qc)
 
+    def load_compact(self, start=None, end=None, stations=None, vars=None, bbox=None, include_qc=True):
+        """
+        Loads observations from the indexed observation store into compact arrays: integer station/variable/set IDs,
+        int64 epoch seconds, float32 values and bit-packed QC flags, about 12 bytes an observation, so years of
+        statewide history fit in memory. Call .to_frame() on the result for the usual tidy DataFrame, or .save() it
+        and compact_obs.CompactObservations.load() it later as memory-mapped arrays
+        :param start: optional datetime or string giving the earliest time to load (UTC). Defaults to the first stored
+        :param end: optional datetime or string giving the latest time to load (UTC). Defaults to the last stored
+        :param stations: optional list of station IDs
+        :param vars: optional list of variable names, such as ['air_temp', 'relative_humidity']
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list giving the area to load stations from
+        :param include_qc: whether to keep values flagged for quality control. Defaults to True
+        :return: compact_obs.CompactObservations
+        """
+        import compact_obs
+        return compact_obs.CompactObservations.from_store(self.OBS_STORE, start=start, end=end, stations=stations,
+                                                          variables=vars, bbox=bbox, include_qc=include_qc)
 
-        now = datetime.now()  # get current datetime
-        now_str = now.strftime("%m.%d.%Y_%H.%M.%S")  # convert the datetime to a string
-        syn_hist_filename = "synoptic_historical_retrieved_" + now_str + ".csv"
-        syn_hist_df.to_csv(syn_hist_filename)
+    def station_index(self, cell_deg=0.25):
+        """
+        :param cell_deg: float giving the grid cell size of the index in degrees
+        :return: colocation.StationIndex over every station in the observation store. The index is cached and only
+                 rebuilt when the station set changes
+        """
+        import colocation
+        stations = self.OBS_STORE.stations()
+        return colocation.get_station_index(stations.index.to_numpy(), stations["LATITUDE"].to_numpy(dtype=float),
+                                            stations["LONGITUDE"].to_numpy(dtype=float), cell_deg=cell_deg)
 
-        self.logger.info("saved historical measurements to csv\n" +
-                         "filename = {}\n".format(syn_hist_filename) +
-                         "path = {}\n".format(os.getcwd()))
+    def colocate(self, lat, lon, time, radius_km=50, window=timedelta(hours=1), vars=None, include_qc=False):
+        """
+        Matches satellite points (e.g. MLS profiles from read_mls()) with station observations: for every point, every
+        station within radius_km, paired with that station's observation closest in time within the window
+        :param lat: array of point latitudes in degrees
+        :param lon: array of point longitudes in degrees
+        :param time: datetime64 array of point times (UTC)
+        :param radius_km: float giving the largest station distance to match, in km
+        :param window: timedelta giving the largest time difference to match
+        :param vars: optional list of variable names to match, such as ['air_temp']. Each variable is matched on its own
+        :param include_qc: whether to match values flagged for quality control. Defaults to False
+        :return: pandas DataFrame with point (index into lat/lon/time), station, distance_km, variable, obs_time, dt_s
+                 and value columns
+        """
+        import colocation
+        index = self.station_index()
+        pair_point, pair_station, dist = index.query_radius(lat, lon, radius_km)
+        columns = ["point", "station", "distance_km", "variable", "obs_time", "dt_s", "value"]
+        if pair_point.size == 0:
+            return pd.DataFrame(columns=columns)
+
+        time = np.asarray(time).astype("datetime64[s]")
+        stids = index.stids[np.unique(pair_station)]
+        obs = self.OBS_STORE.query(stations=stids.tolist(), variables=vars,
+                                   start=time.min() - np.timedelta64(window), end=time.max() + np.timedelta64(window),
+                                   include_qc=include_qc)
+        # stations in the index are numbered by position; put the observations on the same numbering
+        station_pos = pd.Series(np.arange(len(index)), index=index.stids)
+        frames = []
+        for variable, var_obs in obs.groupby("variable", observed=True):
+            obs_station = station_pos.reindex(var_obs["station"].astype(str)).to_numpy()
+            pair_idx, obs_idx, dt = colocation.match_times(pair_point, pair_station, time, obs_station,
+                                                           var_obs["time"].to_numpy(), window)
+            matched = var_obs.iloc[obs_idx]
+            frames.append(pd.DataFrame({"point": pair_point[pair_idx],
+                                        "station": index.stids[pair_station[pair_idx]],
+                                        "distance_km": dist[pair_idx],
+                                        "variable": str(variable),
+                                        "obs_time": matched["time"].to_numpy(),
+                                        "dt_s": dt,
+                                        "value": matched["value"].to_numpy()}))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def grid_synoptic(self, hours=None, start=None, end=None, method="idw", radius_km=50):
+        """
+        Rasterizes stored synoptic observations of GRID_VARS onto GRID, one file per hour under DATA_DERIVED_DIR/grid.
+        Each hour gets the average of everything a station reported in it; QC-flagged values are left out. Only the
+        hours asked for are re-gridded, so after an hourly pull just that hour's file is rewritten.
+        :param hours: optional list/array of hours (datetime64 or datetime) to grid
+        :param start: optional datetime or string giving the first hour to grid, if hours isn't given (UTC)
+        :param end: optional datetime or string giving the last hour to grid, if hours isn't given (UTC)
+        :param method: 'idw' to interpolate between stations, or 'bin' to average the stations inside each cell
+        :param radius_km: float giving how far a station reaches when method is 'idw'
+        :return: list of strings giving the paths written
+        """
+        import colocation
+        import gridding
+        hours = self._hours(hours, start, end)
+        if hours.size == 0:
+            return []
+
+        stations = self.OBS_STORE.stations()
+        stids = stations.index.to_numpy()
+        lat = stations["LATITUDE"].to_numpy(dtype=float)
+        lon = stations["LONGITUDE"].to_numpy(dtype=float)
+        if method == "idw":
+            fingerprint = colocation.station_fingerprint(stids, lat, lon)
+            with self._lock:
+                idw = self._idw
+                if idw is None or idw.fingerprint != fingerprint or idw.radius_km != radius_km:
+                    idw = self._idw = gridding.IDWInterpolator(self.GRID, stids, lat, lon, radius_km=radius_km)
+
+        paths = []
+        # one query per contiguous day of hours, so a backfill doesn't hold the whole archive in memory
+        for day in np.unique(hours.astype("datetime64[D]")):
+            day_hours = hours[hours.astype("datetime64[D]") == day]
+            obs = self.OBS_STORE.query(variables=self.GRID_VARS, start=day_hours[0],
+                                       end=day_hours[-1] + np.timedelta64(1, "h") - np.timedelta64(1, "s"),
+                                       include_qc=False)
+            found, values = gridding.hourly_matrix(obs, stids, self.GRID_VARS)
+            for hour in day_hours:
+                i = np.searchsorted(found, hour)
+                arrays = {}
+                for name in self.GRID_VARS:
+                    row = values[name][i] if i < len(found) and found[i] == hour else np.full(len(stids), np.nan)
+                    if method == "idw":
+                        arrays[name] = idw.interpolate(row)
+                    else:
+                        arrays[name] = gridding.bin_mean(self.GRID, lat, lon, row)
+                paths.append(self.GRID_STORE.write(self.SYNOPTIC_STORE_NAME, hour, arrays))
+        self.logger.info("gridded {} hour(s) of synoptic data onto a {} grid".format(len(paths), self.GRID.shape))
+        return paths
+
+    def grid_mls(self, start=None, end=None, levels=None, pressure_range=None):
+        """
+        Bins MLS temperature profiles onto GRID, one file per hour holding a (levels, ny, nx) 'temperature' array and
+        the matching 'pressure' levels. Profiles are read only over the grid's bbox.
+        :param start: optional datetime or string giving the start of the time range to grid (UTC)
+        :param end: optional datetime or string giving the end of the time range to grid (UTC)
+        :param levels: optional slice, integer, or list of nLevels indices
+        :param pressure_range: optional (min hPa, max hPa) tuple limiting the levels gridded
+        :return: list of strings giving the paths written
+        """
+        import gridding
+        bbox = [self.GRID.minlon, self.GRID.minlat, self.GRID.maxlon, self.GRID.maxlat]
+        paths = []
+        for path, profiles in self.read_mls(levels=levels, pressure_range=pressure_range, bbox=bbox, start=start,
+                                            end=end):
+            good = profiles["quality"] > 0 if "quality" in profiles else np.ones(len(profiles["time"]), dtype=bool)
+            value = np.where(good[:, None], profiles["value"], np.nan)
+            hour = profiles["time"].astype("datetime64[h]")
+            for h in np.unique(hour):
+                sel = hour == h
+                paths.append(self.GRID_STORE.write("mls", h, {
+                    "temperature": gridding.bin_mean(self.GRID, profiles["latitude"][sel], profiles["longitude"][sel],
+                                                     value[sel]),
+                    "pressure": profiles["pressure"].astype(np.float32)}))
+        self.logger.info("gridded {} hour(s) of MLS temperature".format(len(paths)))
+        return paths
+
+    def fire_weather_indices(self, start=None, end=None, stations=None, bbox=None):
+        """
+        Computes fire-weather indices for every station and hour in a range, all at once over (hours, stations) arrays.
+        Each station's reports are averaged per hour first; QC-flagged values are left out, and any index whose
+        inputs are missing for a station-hour is NaN there.
+        :param start: optional datetime or string giving the earliest time to score (UTC)
+        :param end: optional datetime or string giving the latest time to score (UTC)
+        :param stations: optional list of station IDs
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list giving the area to score stations from
+        :return: (hours, stids, indices) tuple: a datetime64[h] array, an array of station IDs, and a dictionary of
+                 index name -> float32 (hours, stations) array; see fire_weather.compute_indices()
+        """
+        import fire_weather
+        import gridding
+        inputs = ["air_temp", "relative_humidity", "dew_point_temperature", "wind_speed"]
+        obs = self.OBS_STORE.query(stations=stations, variables=inputs, start=start, end=end, bbox=bbox,
+                                   include_qc=False)
+        stids = np.asarray(obs["station"].cat.categories.astype(str)) if len(obs) else np.array([], dtype=str)
+        hours, arrays = gridding.hourly_matrix(obs, stids, inputs)
+        indices = fire_weather.compute_indices(arrays)
+        self.logger.debug("scored {} station(s) over {} hour(s)".format(len(stids), len(hours)))
+        return hours, stids, indices
+
+    def summarize(self, start, end, stations=None, vars=None, bbox=None):
+        """
+        Summarizes every station and variable over a range of whole days from the rollup pyramid instead of the raw
+        observations: a decade reads about ten yearly rows per station and variable plus the partial months and days at
+        either end. Kept current by run_pipeline(); QC-flagged values are left out.
+        :param start: datetime or string giving the first day of the range (UTC)
+        :param end: datetime or string giving the end of the range (UTC, exclusive)
+        :param stations: optional list of station IDs
+        :param vars: optional list of variable names, such as ['air_temp', 'relative_humidity', 'precip_accum']
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list giving the area to summarize stations from
+        :return: pandas DataFrame indexed by (station, variable) with n, min, max, sum, mean and total columns. total
+                 is the precipitation that fell over the range, for precip_accum; see rollups.ACCUMULATED_VARS
+        """
+        if bbox is not None:
+            stations = self._stations_in(bbox, stations)
+        return self.ROLLUPS.summarize(start, end, stations=stations, variables=vars)
+
+    def rollup(self, level, start, end, stations=None, vars=None, bbox=None):
+        """
+        Reads per-period station summaries from the rollup pyramid, e.g. daily min/max air_temp or monthly
+        precipitation totals
+        :param level: string giving the period: 'day', 'week', 'month' or 'year'
+        :param start: datetime or string giving the start of the range (UTC)
+        :param end: datetime or string giving the end of the range (UTC, exclusive)
+        :param stations: optional list of station IDs
+        :param vars: optional list of variable names
+        :param bbox: optional [minlon, minlat, maxlon, maxlat] list giving the area to read stations from
+        :return: pandas DataFrame with level, variable, period, station, n, min, max, sum, total and mean columns
+        """
+        if bbox is not None:
+            stations = self._stations_in(bbox, stations)
+        return self.ROLLUPS.query(level, start, end, stations=stations, variables=vars)
+
+    def _stations_in(self, bbox, stations=None):
+        """
+        :return: list of the station IDs inside bbox, limited to stations if that's given
+        """
+        minlon, minlat, maxlon, maxlat = bbox
+        meta = self.OBS_STORE.stations()
+        inside = meta[meta["LONGITUDE"].between(minlon, maxlon) & meta["LATITUDE"].between(minlat, maxlat)].index
+        return list(inside) if stations is None else list(inside.intersection(list(stations)))
 
-        os.chdir(self.CALLER_DIR)
+    def _hours(self, hours=None, start=None, end=None):
+        """
+        :return: sorted datetime64[h] array of the hours asked for, defaulting to every hour the observation store covers
+        """
+        if hours is None:
+            if start is None or end is None:
+                lo, hi = self.OBS_STORE.time_range()
+                start = lo if start is None else start
+                end = hi if end is None else end
+                if start is None:
+                    return np.array([], dtype="datetime64[h]")
+            hours = np.arange(np.datetime64(pd.Timestamp(start), "h"), np.datetime64(pd.Timestamp(end), "h") + 1)
+        return np.unique(np.asarray(hours).astype("datetime64[h]"))
+
+    def grid_fire_weather(self, hours):
+        """
+        Computes fire-weather indices from the gridded synoptic fields, one file per hour under
+        DATA_DERIVED_DIR/grid/fire_weather
+        :param hours: list/array of hours (datetime64 or datetime) to compute
+        :return: list of strings giving the paths written
+        """
+        import fire_weather
+        paths = []
+        for hour in np.asarray(hours).astype("datetime64[h]"):
+            fields = self.GRID_STORE.read(self.SYNOPTIC_STORE_NAME, hour)
+            if fields is None:
+                continue
+            paths.append(self.GRID_STORE.write("fire_weather", hour, fire_weather.compute_indices(fields)))
+        return paths
+
+    def build_pipeline(self):
+        """
+        Declares the derived datasets and what each is built from:
+            observations (OBS_STORE) -> grid (grid_synoptic) -> fire_weather (grid_fire_weather)
+            observations (OBS_STORE) -> rollups (ROLLUPS)
+        New derived products are added here as another stage naming its inputs.
+        :return: pipeline.Pipeline
+        """
+        import colocation
+        import pipeline
+        def grid_params():
+            stations = self.OBS_STORE.stations()
+            return "{}|{}|{}".format(self.GRID.to_dict(), self.GRID_VARS, colocation.station_fingerprint(
+                stations.index.to_numpy(), stations["LATITUDE"].to_numpy(dtype=float),
+                stations["LONGITUDE"].to_numpy(dtype=float)))
+
+        def update_rollups(hours):
+            return self.ROLLUPS.update(self.OBS_STORE, hours)
+
+        derived = pipeline.Pipeline(os.path.join(self.DATA_DERIVED_DIR, "pipeline.sqlite"), logger=self.logger,
+                                    metrics=self.METRICS)
+        derived.add_source("observations", self.OBS_STORE.hour_fingerprints)
+        derived.add_stage(pipeline.Stage("grid", ["observations"], lambda hours: self.grid_synoptic(hours=hours),
+                                         params=grid_params,
+                                         remove=lambda hours: self.GRID_STORE.remove(self.SYNOPTIC_STORE_NAME, hours)))
+        derived.add_stage(pipeline.Stage("fire_weather", ["grid"], self.grid_fire_weather,
+                                         remove=lambda hours: self.GRID_STORE.remove("fire_weather", hours)))
+        # a day's rollups are rebuilt from whatever is left of it, which also clears out hours that vanished
+        derived.add_stage(pipeline.Stage("rollups", ["observations"], update_rollups, remove=update_rollups))
+        return derived
+
+    def run_pipeline(self, hours=None, start=None, end=None, targets=None, force=False):
+        """
+        Brings the derived datasets up to date. Only the (stage, hour) outputs whose inputs changed since they were
+        last built are recomputed, so after an hourly pull this costs about one hour of work however big the archive is.
+        :param hours: optional list/array of hours (datetime64 or datetime) to check
+        :param start: optional datetime or string giving the first hour to check, if hours isn't given (UTC)
+        :param end: optional datetime or string giving the last hour to check, if hours isn't given (UTC). With
+                    neither hours nor start/end, every hour in the observation store or already derived is checked
+        :param targets: optional list of stage names to bring up to date, along with whatever they depend on
+        :param force: whether to rebuild everything regardless of fingerprints
+        :return: dictionary of stage name -> datetime64[h] array of the hours rebuilt
+        """
+        checked = self._hours(hours, start, end)
+        if hours is None and start is None and end is None:
+            # hours built before but since emptied out of the store, so their outputs get removed
+            checked = np.union1d(checked, self.PIPELINE.hours())
+        rebuilt = self.PIPELINE.run(checked, targets=targets, force=force)
+        self.logger.info("derived datasets rebuilt: " + ", ".join(
+            "{} ({} hour(s))".format(name, len(h)) for name, h in rebuilt.items()))
+        return rebuilt
+
+    def score_archive(self, hours=None, start=None, end=None, max_workers=None, force=False):
+        """
+        Backfills wildfire probability maps from the gridded fire-weather archive, spread over a pool of worker
+        processes (see batch_scoring). Shards already scored from the same inputs are skipped, so an interrupted or
+        extended backfill only does what's left. Workers are spawned, so a script calling this needs the usual
+        if __name__ == "__main__": guard.
+        :param hours: optional list/array of hours (datetime64 or datetime) to score
+        :param start: optional datetime or string giving the first hour to score, if hours isn't given (UTC)
+        :param end: optional datetime or string giving the last hour to score, if hours isn't given (UTC). With neither
+                    hours nor start/end, every hour with fire-weather grids is scored
+        :param max_workers: optional integer giving the number of worker processes. Defaults to one per core
+        :param force: whether to re-score shards that are already done
+        :return: dictionary with 'shards', 'scored', 'skipped' and 'failed' (list of shard keys) entries
+        """
+        if hours is None and start is None and end is None:
+            hours = self.GRID_STORE.hours("fire_weather")
+        else:
+            hours = self._hours(hours, start, end)
+        if hours.size == 0:
+            return {"shards": 0, "scored": 0, "skipped": 0, "failed": []}
+        return self.SCORER.run(hours, max_workers=max_workers, force=force)
+
+    def read_probability(self, hours=None, start=None, end=None):
+        """
+        Reads backfilled probability maps written by score_archive()
+        :param hours: optional list/array of hours (datetime64 or datetime) to read
+        :param start: optional datetime or string giving the first hour to read, if hours isn't given (UTC)
+        :param end: optional datetime or string giving the last hour to read, if hours isn't given (UTC)
+        :return: (hours, probability) tuple: a sorted datetime64[h] array and a float32 (hours, ny, nx) array on GRID,
+                 NaN wherever nothing has been scored
+        """
+        hours = self._hours(hours, start, end)
+        return hours, self.SCORER.read(hours)
+
+    def pull_ldas_recent(self, days=2, **pull_args):
+        """
+        Pulls the last few days of satellite data, for running on a schedule. Granules already on disk are skipped by
+        the downloader, so overlapping windows from one run to the next cost only the subset job calls.
+        :param days: integer giving how many days back from now to pull
+        :param pull_args: keyword arguments passed to pull_ldas_rt()
+        :return: paths, list of strings giving the full paths of the granules in DATA_SAT_DIR
+        """
+        end = datetime.utcnow()
+        start = (end - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        gesdisc_time_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+        return self.pull_ldas_rt(start=start.strftime(gesdisc_time_format)[:-4] + 'Z',
+                                 end=end.strftime(gesdisc_time_format)[:-4] + 'Z', **pull_args)
+
+    def run_daemon(self,
+                   rt_interval=timedelta(minutes=5),
+                   sat_interval=timedelta(hours=6),
+                   rt_jitter=timedelta(seconds=30),
+                   sat_jitter=timedelta(minutes=5),
+                   pull_satellite=True,
+                   max_runtime=None):
+        """
+        Runs as a resident daemon: real-time synoptic polls and satellite pulls each on their own fixed cadence, in this
+        one wile object, so the HTTP sessions, Earthdata cookies, station index and IDW weights built by one cycle are
+        still there for the next instead of being rebuilt by a cold start. A run still going when its next tick comes
+        is skipped rather than overlapped. Stops on SIGINT/SIGTERM.
+        :param rt_interval: timedelta between real-time synoptic polls
+        :param sat_interval: timedelta between satellite pulls
+        :param rt_jitter: timedelta giving the most each real-time poll is randomly delayed from its tick
+        :param sat_jitter: timedelta giving the most each satellite pull is randomly delayed from its tick
+        :param pull_satellite: whether to schedule satellite pulls at all
+        :param max_runtime: optional timedelta after which to stop
+        :return: none
+        """
+        import scheduler
+        jobs = [scheduler.Job("synoptic_rt", self.poll_synoptic_rt, rt_interval, jitter=rt_jitter)]
+        if pull_satellite:
+            jobs.append(scheduler.Job("ldas", self.pull_ldas_recent, sat_interval, jitter=sat_jitter))
+        scheduler.Scheduler(jobs, logger=self.logger, metrics=self.METRICS).run(max_runtime=max_runtime)
@@ -0,0 +1,283 @@
+# Command-line entry point for the Wildfire probability Estimator (WilE).
+# Last editor: Ben Hoffman
+# Contact: blhoff97@gmail.com
+#
+# Usage:
+#   python wile_cli.py [--base-dir DIR] [--log-level N] [--quiet] [--metrics] <command> [options]
+# Commands:
+#   pull-rt     pull (or, with --poll, delta-poll) the latest synoptic observations
+#   pull-hist   pull synoptic timeseries between two times
+#   pull-ldas   pull satellite granules from GES DISC
+#   query       print stored observations as CSV
+#   status      summarize what's on disk
+#   daemon      stay resident and pull on a schedule
+#
+# Nothing heavy is imported at module level. status only needs sqlite3, query only the observation store, and only
+# the pull commands import and construct a wile object (with its directories, log handlers and HTTP stack), so a
+# cron job asking for status starts in tens of milliseconds instead of waiting on pandas and requests.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+SYN_TOKEN_ENV = "WILE_SYN_TOKEN"  # environment variable the synoptic token is read from when --token isn't given
+
+# where wile keeps things under its base directory; these mirror wile.__init__
+OBS_DB = os.path.join("data", "observations.sqlite")
+GRANULE_DB = os.path.join("data", "granules.sqlite")
+POLL_DB = os.path.join("data", "rt", "poll_state.sqlite")
+PIPELINE_DB = os.path.join("data", "derived", "pipeline.sqlite")
+
+
+def _default_base_dir():
+    return os.path.dirname(os.path.abspath(__file__))  # same place wile_main.py puts things
+
+
+def _make_wile(args):
+    """
+    Imports the main module and builds a wile object; only the pull commands pay for this
+    """
+    token = args.token or os.environ.get(SYN_TOKEN_ENV)
+    if not token:
+        sys.exit("a synoptic token is needed: pass --token or set {}".format(SYN_TOKEN_ENV))
+    import wildfire_probability_estimator
+    return wildfire_probability_estimator.wile(token, base_dir=args.base_dir, logger_level=args.log_level,
+                                               print_to_console=not args.quiet, record_metrics=args.metrics)
+
+
+def _regions(args):
+    return args.region or None  # None means the wile object's default regions
+
+
+def _connect_ro(path):
+    """
+    :return: read-only sqlite3 connection, or None if the file doesn't exist yet. Read-only so status never creates
+             or locks anything
+    """
+    if not os.path.exists(path):
+        return None
+    return sqlite3.connect("file:{}?mode=ro".format(path.replace("?", "%3f")), uri=True, timeout=10)
+
+
+def _iso(seconds):
+    if seconds is None:
+        return None
+    from datetime import datetime
+    return datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def cmd_pull_rt(args):
+    wpe = _make_wile(args)
+    try:
+        if args.poll:
+            df = wpe.poll_synoptic_rt(derive=not args.no_derive, regions=_regions(args))
+        else:
+            df = wpe.pull_synoptic_rt(derive=not args.no_derive, regions=_regions(args))
+    finally:
+        wpe.close()
+    print("{} observation(s)".format(len(df)))
+
+
+def cmd_pull_hist(args):
+    wpe = _make_wile(args)
+    try:
+        df = wpe.pull_synoptic_hist(start=args.start, end=args.end, max_workers=args.max_workers,
+                                    use_cache=not args.no_cache, regions=_regions(args),
+                                    load_cached=args.load_cached)
+        if not args.no_derive and len(df):
+            wpe.run_pipeline(hours=df["time"].to_numpy().astype("datetime64[h]"))  # just the hours pulled
+    finally:
+        wpe.close()
+    print("{} observation(s)".format(len(df)))
+
+
+def cmd_pull_ldas(args):
+    wpe = _make_wile(args)
+    pull_args = {"product": args.product, "max_jobs": args.max_jobs}
+    try:
+        if args.start is not None or args.end is not None:
+            if args.start is None or args.end is None:
+                sys.exit("--start and --end go together")
+            paths = wpe.pull_ldas_rt(start=args.start, end=args.end, **pull_args)
+        else:
+            paths = wpe.pull_ldas_recent(days=args.days, **pull_args)
+    finally:
+        wpe.close()
+    print("{} granule(s)".format(len(paths)))
+
+
+def cmd_query(args):
+    db_path = os.path.join(args.base_dir, OBS_DB)
+    if not os.path.exists(db_path):
+        sys.exit("no observation store at {}; pull something first".format(db_path))
+    import obs_store
+    df = obs_store.ObservationStore(db_path).query(stations=args.stations, variables=args.vars, start=args.start,
+                                                   end=args.end, bbox=args.bbox, include_qc=not args.no_qc)
+    if args.limit is not None:
+        df = df.head(args.limit)
+    df.to_csv(args.output if args.output else sys.stdout, index=False, date_format="%Y-%m-%dT%H:%M:%SZ")
+
+
+def status(base_dir):
+    """
+    Summarizes the stores under base_dir using nothing but sqlite3
+    :return: dictionary of store name -> summary dictionary (None for stores that don't exist yet)
+    """
+    out = {"base_dir": base_dir}
+
+    conn = _connect_ro(os.path.join(base_dir, OBS_DB))
+    if conn is None:
+        out["observations"] = None
+    else:
+        with conn:
+            n_obs, first, last = conn.execute("SELECT COUNT(*), MIN(time), MAX(time) FROM observations").fetchone()
+            n_stations = conn.execute("SELECT COUNT(*) FROM stations").fetchone()[0]
+        conn.close()
+        out["observations"] = {"rows": n_obs, "stations": n_stations, "first": _iso(first), "last": _iso(last)}
+
+    conn = _connect_ro(os.path.join(base_dir, GRANULE_DB))
+    if conn is None:
+        out["granules"] = None
+    else:
+        with conn:
+            rows = conn.execute("SELECT product, COUNT(*), SUM(n_bytes), MIN(start_time), MAX(end_time) "
+                                "FROM granules GROUP BY product ORDER BY product").fetchall()
+        conn.close()
+        out["granules"] = {product: {"files": n, "bytes": n_bytes, "first": _iso(first), "last": _iso(last)}
+                           for product, n, n_bytes, first, last in rows}
+
+    conn = _connect_ro(os.path.join(base_dir, POLL_DB))
+    if conn is None:
+        out["polls"] = None
+    else:
+        with conn:
+            rows = conn.execute("SELECT series, polled_at FROM polls ORDER BY polled_at DESC").fetchall()
+        conn.close()
+        out["polls"] = {"series": len(rows), "last": rows[0][1] if rows else None}
+
+    conn = _connect_ro(os.path.join(base_dir, PIPELINE_DB))
+    if conn is None:
+        out["derived"] = None
+    else:
+        with conn:
+            rows = conn.execute("SELECT stage, COUNT(*), MIN(hour), MAX(hour), MAX(computed_at) FROM partitions "
+                                "GROUP BY stage ORDER BY stage").fetchall()
+        conn.close()
+        out["derived"] = {stage: {"hours": n, "first": _iso(first), "last": _iso(last), "built": _iso(built)}
+                          for stage, n, first, last, built in rows}
+    return out
+
+
+def cmd_status(args):
+    summary = status(args.base_dir)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print("base directory: {}".format(summary["base_dir"]))
+    for name in ("observations", "granules", "polls", "derived"):
+        section = summary[name]
+        if section is None:
+            print("{}: none yet".format(name))
+        elif name in ("granules", "derived"):
+            print("{}:".format(name))
+            for key, values in section.items():
+                print("  {}: {}".format(key, ", ".join("{}={}".format(k, v) for k, v in values.items())))
+        else:
+            print("{}: {}".format(name, ", ".join("{}={}".format(k, v) for k, v in section.items())))
+
+
+def cmd_daemon(args):
+    from datetime import timedelta
+    wpe = _make_wile(args)
+    try:
+        wpe.run_daemon(rt_interval=timedelta(minutes=args.rt_minutes), sat_interval=timedelta(hours=args.sat_hours),
+                       pull_satellite=not args.no_satellite,
+                       max_runtime=timedelta(hours=args.max_hours) if args.max_hours is not None else None)
+    finally:
+        wpe.close()
+
+
+def _bbox(text):
+    try:
+        bbox = [float(v) for v in text.split(",")]
+    except ValueError:
+        bbox = []
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError("expected minlon,minlat,maxlon,maxlat")
+    return bbox
+
+
+def _csv_list(text):
+    return [v for v in text.split(",") if v]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="wile", description="Wildfire probability Estimator")
+    parser.add_argument("--base-dir", default=_default_base_dir(),
+                        help="directory data/, debug/ and outputs/ live under (default: next to this file)")
+    parser.add_argument("--token", help="synoptic API token (default: ${})".format(SYN_TOKEN_ENV))
+    parser.add_argument("--log-level", type=int, default=20, help="logging level; 10 is debug (default: 20)")
+    parser.add_argument("--quiet", action="store_true", help="log to the log file only, not the console")
+    parser.add_argument("--metrics", action="store_true", help="record metrics under outputs/metrics")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    p = commands.add_parser("pull-rt", help="pull the latest synoptic observations")
+    p.add_argument("--poll", action="store_true", help="only ask for what's new since the last poll")
+    p.add_argument("--region", action="append", help="two-letter state to pull; repeatable (default: CA)")
+    p.add_argument("--no-derive", action="store_true", help="don't rebuild derived datasets afterwards")
+    p.set_defaults(func=cmd_pull_rt)
+
+    p = commands.add_parser("pull-hist", help="pull synoptic timeseries")
+    p.add_argument("--start", help="earliest time, YYYYmmddHHMM UTC")
+    p.add_argument("--end", help="latest time, YYYYmmddHHMM UTC (default: now)")
+    p.add_argument("--region", action="append", help="two-letter state to pull; repeatable (default: CA)")
+    p.add_argument("--max-workers", type=int, default=8, help="requests in flight at once (default: 8)")
+    p.add_argument("--no-cache", action="store_true", help="ignore the fetch cache")
+    p.add_argument("--load-cached", action="store_true",
+                   help="store everything cached between --start and --end, not just what this run fetches")
+    p.add_argument("--no-derive", action="store_true", help="don't rebuild derived datasets afterwards")
+    p.set_defaults(func=cmd_pull_hist)
+
+    p = commands.add_parser("pull-ldas", help="pull satellite granules from GES DISC")
+    p.add_argument("--product", default="ML2T_004", help="GES DISC dataset ID (default: ML2T_004)")
+    p.add_argument("--start", help="start, e.g. 2015-08-01T00:00:00.000Z")
+    p.add_argument("--end", help="end, e.g. 2015-08-03T23:59:59.999Z")
+    p.add_argument("--days", type=int, default=2, help="without --start/--end, pull this many days back (default: 2)")
+    p.add_argument("--max-jobs", type=int, default=4, help="subset jobs in flight at once (default: 4)")
+    p.set_defaults(func=cmd_pull_ldas)
+
+    p = commands.add_parser("query", help="print stored observations as CSV")
+    p.add_argument("--stations", type=_csv_list, help="comma-separated STIDs")
+    p.add_argument("--vars", type=_csv_list, help="comma-separated variable names")
+    p.add_argument("--start", help="earliest time (UTC)")
+    p.add_argument("--end", help="latest time (UTC)")
+    p.add_argument("--bbox", type=_bbox, help="minlon,minlat,maxlon,maxlat")
+    p.add_argument("--no-qc", action="store_true", help="leave out values flagged for quality control")
+    p.add_argument("--limit", type=int, help="print at most this many rows")
+    p.add_argument("--output", help="file to write instead of stdout")
+    p.set_defaults(func=cmd_query)
+
+    p = commands.add_parser("status", help="summarize what's on disk")
+    p.add_argument("--json", action="store_true", help="print JSON")
+    p.set_defaults(func=cmd_status)
+
+    p = commands.add_parser("daemon", help="stay resident and pull on a schedule")
+    p.add_argument("--rt-minutes", type=float, default=5, help="minutes between real-time polls (default: 5)")
+    p.add_argument("--sat-hours", type=float, default=6, help="hours between satellite pulls (default: 6)")
+    p.add_argument("--no-satellite", action="store_true", help="don't schedule satellite pulls")
+    p.add_argument("--max-hours", type=float, help="stop after this many hours")
+    p.set_defaults(func=cmd_daemon)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.base_dir = os.path.abspath(args.base_dir)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
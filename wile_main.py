@@ -2,7 +2,7 @@
 # Last editor: Ben Hoffman
 # Contact: blhoff97@gmail.com
 
-
+import sys
 
 import wildfire_probability_estimator
 
@@ -10,5 +10,8 @@ SYN_TOKEN = "eb977b5f24ed48b585ccb4e520906425"  # https://api.synopticdata.com/v
 
 wpe = wildfire_probability_estimator.wile(SYN_TOKEN, logger_level=10)  # instantiate class object; logger level 10 means debug
 
-wpe.pull_ldas_rt()
+if "--daemon" in sys.argv:  # stay resident and pull on a schedule instead of pulling once and exiting
+    wpe.run_daemon()
+else:
+    wpe.pull_ldas_rt()
 